@@ -11,6 +11,40 @@ const char* password = "#Tseleng@1";    //password
 
 // Flask server configuration
 const char* serverUrl = "http://192.168.0.149:5000/esp/update";  // Endpoint for sensor data
+const char* binaryUrl = "http://192.168.0.149:5000/esp/update_bin";  // Endpoint for binary sensor data
+const char* commandsUrl = "http://192.168.0.149:5000/esp/commands";  // Long-poll endpoint for commands
+const char* deviceId = "default";  // Device ID known to the server (up to 16 characters)
+
+// Seconds the server may hold a command long-poll open
+#define COMMAND_POLL_TIMEOUT 20
+
+// Backoff when the server sheds load or cannot be reached
+#define MAX_BACKOFF_MS 60000       // Longest wait between failed sends
+#define RECONNECT_SPREAD_MS 10000  // First send after (re)connecting is delayed by up to this
+
+// Set to 1 to send readings as a 24-byte binary packet instead of JSON
+#define USE_BINARY_PROTOCOL 0
+
+// Binary protocol (must match Flask_app/binary_protocol.py, little-endian)
+#define PROTOCOL_VERSION 1
+#define READING_MOTION 1      // Reading flag: motion detected
+#define READING_HAS_TEMP 2    // Reading flag: temperature is valid
+#define CONTROL_AUTO_MODE 1   // Reply flag: auto mode on
+#define CONTROL_LED_ON 2      // Reply flag: LED on
+
+struct __attribute__((packed)) SensorPacket {
+  uint8_t version;
+  char deviceId[16];     // NUL-padded device ID
+  uint16_t lightLevel;
+  uint8_t flags;
+  float temperature;
+};
+
+struct __attribute__((packed)) ControlPacket {
+  uint8_t version;
+  uint8_t flags;
+  uint8_t servoAngle;
+};
 
 // Hardware pin configuration
 #define LDR_PIN 39        // Analog pin for Light Dependent Resistor (LDR)
@@ -20,7 +54,8 @@ const char* serverUrl = "http://192.168.0.149:5000/esp/update";  // Endpoint for
 #define DHT_PIN 14        // Pin for DHT11 temperature sensor
 #define DHT_TYPE DHT11    // Specifying i am using DHT11 sensor
 
-// Threshold values for automatic control
+// Fallback threshold values, only used while the Flask server (which runs the
+// automation rules) cannot be reached
 #define LIGHT_THRESHOLD 2000    // If light level < 2000, turn LED on
 #define TEMP_THRESHOLD 25.0     // If temp > 25°C and motion detected, turn servo
 
@@ -35,6 +70,18 @@ float temperature = 0.0;     // Current temperature
 int servoAngle = 0;          // Current servo position (0-180°)
 bool ledState = false;       // Current LED state (on/off)
 bool autoMode = true;        // Current control mode (auto/manual)
+bool temperatureValid = false; // Whether the last DHT11 read succeeded
+
+// The command task and loop() both change the outputs
+SemaphoreHandle_t stateMutex;
+// Sequence number of the last command batch applied (-1: none yet, ask for a full sync)
+long lastCommandSeq = -1;
+
+// Earliest time (millis) the next reading may be sent, and the current backoff
+unsigned long nextSendAt = 0;
+unsigned long backoffMs = 0;
+// Whether WiFi was up on the previous loop (a reconnect spreads out the next send)
+bool wifiConnected = false;
 
 void setup() {
   Serial.begin(115200);  // Start serial communication for debugging
@@ -57,13 +104,20 @@ void setup() {
   // Print connection details
   Serial.println("\nConnected with IP: ");
   Serial.println(WiFi.localIP());
+
+  // Manual commands arrive through a long-poll on its own task, so they are
+  // applied as soon as they are issued instead of on the next 2-second loop
+  stateMutex = xSemaphoreCreateMutex();
+  xTaskCreatePinnedToCore(commandTask, "commands", 8192, NULL, 1, NULL, 0);
 }
 
 void loop() {
   //  Read all sensor values
   readSensors();
   
-  //  Automatic control logic (only in auto mode)
+  //  Local fallback control logic (only in auto mode); replaced by the
+  //  server's decision whenever sendSensorData() gets a response
+  xSemaphoreTake(stateMutex, portMAX_DELAY);
   if (autoMode) {
     // LED control: Turn on if light level below threshold
     ledState = (lightLevel < LIGHT_THRESHOLD);
@@ -71,28 +125,66 @@ void loop() {
     // Servo control: Activate (90°) if motion AND high temperature detected
     servoAngle = (motionDetected && temperature > TEMP_THRESHOLD) ? 90 : 0;
   }
+  xSemaphoreGive(stateMutex);
   
   //  Communication with Flask server
   if (WiFi.status() == WL_CONNECTED) {
-    // Send sensor data to server
-    sendSensorData();
-    // Only check for manual updates if not in auto mode
-    if (!autoMode) {
-      getControlUpdates();
+    if (!wifiConnected) {
+      // Just (re)connected: every device in the building may be too, so wait
+      // a random moment instead of all posting at once
+      wifiConnected = true;
+      nextSendAt = millis() + random(0, RECONNECT_SPREAD_MS);
+    }
+    // Send sensor data to server, unless it asked us to wait
+    if ((long)(millis() - nextSendAt) >= 0) {
+#if USE_BINARY_PROTOCOL
+      sendSensorDataBinary();
+#else
+      sendSensorData();
+#endif
     }
   } else {
     // Handle WiFi disconnection
     Serial.println("WiFi Disconnected");
+    wifiConnected = false;
     WiFi.reconnect();
   }
   
   //  Update physical outputs
-  digitalWrite(LED_PIN, ledState ? HIGH : LOW);  // Set LED state
-  myServo.write(servoAngle);                     // Move servo to position
+  writeOutputs();
   
   delay(2000); // Wait 2 seconds between loops
 }
 
+// Decide when to send again after a response (or after failing to get one)
+void scheduleNextSend(HTTPClient& http, int httpResponseCode) {
+  if (httpResponseCode == HTTP_CODE_OK) {
+    backoffMs = 0;
+    return;
+  }
+  unsigned long waitMs;
+  if (httpResponseCode == 429 || httpResponseCode == 503) {
+    // The server is shedding load: wait as long as its Retry-After asks
+    long retryAfter = http.header("Retry-After").toInt();
+    waitMs = (retryAfter > 0 ? retryAfter : 1) * 1000UL;
+  } else {
+    // No usable answer: back off exponentially
+    backoffMs = backoffMs ? min(backoffMs * 2, (unsigned long)MAX_BACKOFF_MS) : 2000;
+    waitMs = backoffMs;
+  }
+  // Random jitter, so devices told the same thing don't all come back together
+  nextSendAt = millis() + waitMs + random(0, waitMs / 2 + 1);
+  Serial.print("Next send in ms: ");
+  Serial.println(nextSendAt - millis());
+}
+
+void writeOutputs() {
+  xSemaphoreTake(stateMutex, portMAX_DELAY);
+  digitalWrite(LED_PIN, ledState ? HIGH : LOW);  // Set LED state
+  myServo.write(servoAngle);                     // Move servo to position
+  xSemaphoreGive(stateMutex);
+}
+
 void readSensors() {
   // Read light level from LDR (0-4095, higher = darker)
   lightLevel = analogRead(LDR_PIN);
@@ -103,7 +195,8 @@ void readSensors() {
   // Read temperature from DHT11
   float newTemp = dht.readTemperature();
   // Only update if reading is valid
-  if (!isnan(newTemp)) {
+  temperatureValid = !isnan(newTemp);
+  if (temperatureValid) {
     temperature = newTemp;
   }
   
@@ -126,8 +219,10 @@ void sendSensorData() {
     return;
   }
   
-  // Set content type header
+  // Set content type header, and keep Retry-After from the response
   http.addHeader("Content-Type", "application/json");
+  const char* responseHeaders[] = {"Retry-After"};
+  http.collectHeaders(responseHeaders, 1);
   
   // Create JSON document for sensor data
   DynamicJsonDocument doc(256);
@@ -149,52 +244,133 @@ void sendSensorData() {
     DynamicJsonDocument responseDoc(128);
     deserializeJson(responseDoc, response);
     
+    xSemaphoreTake(stateMutex, portMAX_DELAY);
     // Update auto mode if changed by server
     if (responseDoc.containsKey("auto_mode")) {
       autoMode = responseDoc["auto_mode"];
     }
+    // In auto mode the server's rules decide the outputs
+    if (autoMode && responseDoc.containsKey("led_on")) {
+      ledState = responseDoc["led_on"];
+      servoAngle = responseDoc["servo_angle"];
+    }
+    xSemaphoreGive(stateMutex);
   } else {
     // Print HTTP error if request failed
     Serial.print("HTTP Error: ");
     Serial.println(httpResponseCode);
   }
+  scheduleNextSend(http, httpResponseCode);
   
   http.end();  // Free resources
 }
 
-void getControlUpdates() {
+void sendSensorDataBinary() {
+  HTTPClient http;  // Create HTTP client
+
+  // Attempt to connect to server
+  if (!http.begin(binaryUrl)) {
+    Serial.println("Failed to connect to server");
+    return;
+  }
+  http.addHeader("Content-Type", "application/octet-stream");
+  const char* responseHeaders[] = {"Retry-After"};
+  http.collectHeaders(responseHeaders, 1);
+
+  // Fill the fixed-layout packet (24 bytes instead of a JSON document)
+  SensorPacket packet;
+  memset(&packet, 0, sizeof(packet));
+  packet.version = PROTOCOL_VERSION;
+  strncpy(packet.deviceId, deviceId, sizeof(packet.deviceId));
+  packet.lightLevel = lightLevel;
+  packet.flags = (motionDetected ? READING_MOTION : 0) | (temperatureValid ? READING_HAS_TEMP : 0);
+  packet.temperature = temperature;
+
+  // Send POST request with the raw packet
+  int httpResponseCode = http.POST((uint8_t*)&packet, sizeof(packet));
+
+  // Process the 3-byte control reply
+  if (httpResponseCode == HTTP_CODE_OK && http.getSize() == sizeof(ControlPacket)) {
+    ControlPacket reply;
+    http.getStream().readBytes((uint8_t*)&reply, sizeof(reply));
+    if (reply.version == PROTOCOL_VERSION) {
+      xSemaphoreTake(stateMutex, portMAX_DELAY);
+      autoMode = reply.flags & CONTROL_AUTO_MODE;
+      // In auto mode the server's rules decide the outputs
+      if (autoMode) {
+        ledState = reply.flags & CONTROL_LED_ON;
+        servoAngle = reply.servoAngle;
+      }
+      xSemaphoreGive(stateMutex);
+    }
+  } else {
+    // Print HTTP error if request failed
+    Serial.print("HTTP Error: ");
+    Serial.println(httpResponseCode);
+  }
+  scheduleNextSend(http, httpResponseCode);
+
+  http.end();  // Free resources
+}
+
+void commandTask(void* parameter) {
+  for (;;) {
+    if (WiFi.status() == WL_CONNECTED) {
+      pollCommands();
+    } else {
+      delay(1000);
+    }
+  }
+}
+
+void pollCommands() {
   HTTPClient http;
-  String url = "http://192.168.0.149:5000/esp/control";
-  
-  // Attempt to connect to control endpoint
+  // Acknowledge the last batch; without ?ack the server sends every control field
+  String url = String(commandsUrl) + "?timeout=" + COMMAND_POLL_TIMEOUT;
+  if (lastCommandSeq >= 0) {
+    url += "&ack=" + String(lastCommandSeq);
+  }
+
+  // Attempt to connect to the commands endpoint
   if (!http.begin(url)) {
-    Serial.println("Failed to connect to control endpoint");
+    Serial.println("Failed to connect to commands endpoint");
+    delay(1000);
     return;
   }
-  
-  // Send GET request for control updates
+  // Leave room for the server to hold the request open
+  http.setTimeout((COMMAND_POLL_TIMEOUT + 5) * 1000);
+
+  // Wait for commands (returns early as soon as one is issued)
   int httpResponseCode = http.GET();
-  
-  // Process response
+
+  // Process response: {"seq": N, "commands": {"auto_mode": ..., "led_on": ..., "servo_angle": ...}}
   if (httpResponseCode == HTTP_CODE_OK) {
     String response = http.getString();
-    DynamicJsonDocument doc(128);
-    deserializeJson(doc, response);
-    
-    // Only update outputs if in manual mode
-    if (!autoMode) {
-      ledState = doc["led_on"];
-      servoAngle = doc["servo_angle"];
-    }
-    // Always allow auto mode changes
-    if (doc.containsKey("auto_mode")) {
-      autoMode = doc["auto_mode"];
+    DynamicJsonDocument doc(256);
+    if (!deserializeJson(doc, response)) {
+      JsonObject commands = doc["commands"];
+      xSemaphoreTake(stateMutex, portMAX_DELAY);
+      // Mode changes always apply; LED and servo commands only in manual mode
+      if (commands.containsKey("auto_mode")) {
+        autoMode = commands["auto_mode"];
+      }
+      if (!autoMode && commands.containsKey("led_on")) {
+        ledState = commands["led_on"];
+      }
+      if (!autoMode && commands.containsKey("servo_angle")) {
+        servoAngle = commands["servo_angle"];
+      }
+      xSemaphoreGive(stateMutex);
+      lastCommandSeq = doc["seq"];
+      // Apply right away instead of waiting for the next loop
+      writeOutputs();
     }
   } else {
-    // Print HTTP error if request failed
+    // Print HTTP error if request failed, and back off before retrying
     Serial.print("HTTP Error: ");
     Serial.println(httpResponseCode);
+    delay(2000);
   }
-  
+
   http.end();  // Free resources
-}
\ No newline at end of file
+}
@@ -0,0 +1,114 @@
+# Admission control for the ingest path: per-device token buckets and a bounded
+# telemetry queue that gives way to control changes
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Defaults (overridable through environment variables in backend.py)
+DEFAULT_RATE = 1.0           # Readings per second per device (the ESP32 sends one every 2 s)
+DEFAULT_BURST = 5            # Readings a device may send back to back
+DEFAULT_MAX_INFLIGHT = 8     # Telemetry requests processed at once
+DEFAULT_MAX_QUEUE = 32       # Telemetry requests waiting for a slot
+DEFAULT_QUEUE_TIMEOUT = 1.0  # Longest a telemetry request waits for a slot (seconds)
+
+# Longest Retry-After sent to a device (seconds)
+MAX_RETRY_AFTER = 30
+
+
+def retry_seconds(seconds):
+    # Retry-After takes whole seconds
+    return max(1, min(MAX_RETRY_AFTER, math.ceil(seconds)))
+
+
+class TokenBuckets:
+    """One token bucket per device: rate tokens per second, at most burst saved up"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._lock = threading.Lock()
+        self._buckets = {}  # device_id -> [tokens, time of the last refill]
+
+    def take(self, device_id, now=None):
+        """Take a token and return 0, or return the seconds until one is available"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(device_id)
+            if bucket is None:
+                bucket = self._buckets[device_id] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+
+
+class AdmissionGate:
+    """Bounded slots for telemetry; while control changes run, telemetry waits"""
+
+    def __init__(self, max_inflight=DEFAULT_MAX_INFLIGHT, max_queue=DEFAULT_MAX_QUEUE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self.inflight = 0   # Telemetry requests being processed
+        self.waiting = 0    # Telemetry requests queued for a slot
+        self.controls = 0   # Control changes being processed
+        self._service_time = 0.01  # Moving average of a telemetry request (seconds)
+
+    def _blocked(self):
+        return self.controls or self.inflight >= self.max_inflight
+
+    def _retry_after(self):
+        # Caller holds the lock: time to work through the current backlog
+        backlog = self.inflight + self.waiting
+        return retry_seconds(backlog * self._service_time / self.max_inflight)
+
+    def acquire(self):
+        """Take a telemetry slot and return None, or return the Retry-After seconds when shedding"""
+        with self._lock:
+            if self._blocked():
+                if self.waiting >= self.max_queue:
+                    return self._retry_after()
+                self.waiting += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self._blocked():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return self._retry_after()
+                        self._ready.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.inflight += 1
+            return None
+
+    def release(self, elapsed):
+        """Give back a telemetry slot after a request that took elapsed seconds"""
+        with self._lock:
+            self.inflight -= 1
+            self._service_time += 0.1 * (elapsed - self._service_time)
+            self._ready.notify()
+
+    @contextmanager
+    def control(self):
+        """Run a control change ahead of queued telemetry"""
+        with self._lock:
+            self.controls += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.controls -= 1
+                if not self.controls:
+                    self._ready.notify_all()
+
+    def queued(self):
+        return self.waiting
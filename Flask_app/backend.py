@@ -1,13 +1,56 @@
 # Import required Flask modules and other dependencies
-from flask import Flask, request, jsonify, Response  # type: ignore
+import atexit
+import functools
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+from flask import Flask, request, jsonify, Response, g, stream_with_context  # type: ignore
 from flask_cors import CORS  # type: ignore
+from werkzeug.routing import BaseConverter  # type: ignore
+
+from device_registry import DeviceRegistry, DEFAULT_DEVICE_ID
+from shared_state import SharedStateStore, SharedDeviceRegistry
+from history import SensorHistory, LogHistory
+import reading_log as rlog
+from live_updates import StateBroadcaster
+from rules import RuleEngine
+from fleet import FleetColumns
+import admission
+import binary_protocol
+import command_outbox
+import config_tree
+import signal_filters
+import log_export
+import metrics
+from udp_ingest import UdpIngestServer
 
 # Create a Flask application instance
 app = Flask(__name__)
 # Enable CORS (Cross-Origin Resource Sharing) for the app
 CORS(app)
 
-# Global state dictionary to store the current system state
+
+# Device IDs are short, URL- and HTML-safe names
+DEVICE_ID_REGEX = r"[A-Za-z0-9_.:-]{1,32}"
+DEVICE_ID_PATTERN = re.compile(DEVICE_ID_REGEX)
+
+
+# URL converter restricting device IDs in routes
+class DeviceIdConverter(BaseConverter):
+    regex = DEVICE_ID_REGEX
+
+
+app.url_map.converters['device'] = DeviceIdConverter
+
+# Template state dictionary copied for every newly registered device
 initial_state = {
     "light_level": 0,             # Current light level from LDR sensor (0-4095)
     "motion_detected": False,     # Motion detection status from PIR sensor
@@ -18,107 +61,712 @@ initial_state = {
     "temp_threshold": 25.0,       # Temperature threshold for servo activation
     "light_threshold": 2000       # Light threshold for LED activation
 }
+# Control commands waiting to be delivered to the device (see command_outbox.py)
+initial_state.update(command_outbox.OUTBOX_STATE)
+# Filter settings, filtered readings and output dwell times used by auto mode (see signal_filters.py)
+initial_state.update(signal_filters.FILTER_SETTINGS)
+initial_state.update(signal_filters.FILTERED_STATE)
+initial_state.update(signal_filters.DWELL_STATE)
 
-# Define the root route that serves the HTML dashboard
-@app.route('/')
-def dashboard():
-    # Return an HTML response with embedded CSS and JavaScript
-    return Response(f"""
+# Under serve.py (SHARED_STATE_CAPACITY set), state lives in shared memory
+# created here in the master process and inherited by every forked worker
+SHARED_STATE_CAPACITY = os.environ.get('SHARED_STATE_CAPACITY')
+shared_store = SharedStateStore(initial_state, int(SHARED_STATE_CAPACITY)) if SHARED_STATE_CAPACITY else None
+
+# Registry holding the state of every device, keyed by device ID
+if shared_store is not None:
+    registry = SharedDeviceRegistry(shared_store, initial_state)
+    atexit.register(shared_store.close)
+else:
+    registry = DeviceRegistry(initial_state)
+
+# Durable log of readings and control changes (set READING_LOG_DIR to move it)
+READING_LOG_DIR = os.environ.get(
+    'READING_LOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'log')
+)
+reading_log = rlog.ReadingLog(READING_LOG_DIR, process_lock=shared_store.log_lock if shared_store else None)
+
+# Bounded per-device, per-sensor history of readings; worker processes
+# answer from the shared log instead, so they all give the same answer
+history = LogHistory(reading_log) if shared_store is not None else SensorHistory()
+
+# Rules, locations and configuration are saved next to the log as one JSON document,
+# by a background thread once changes have been quiet for CONFIG_SAVE_DELAY seconds
+CONFIG_SNAPSHOT_PATH = os.path.join(READING_LOG_DIR, 'config.json')
+CONFIG_SAVE_DELAY = 0.5
+config_changed = threading.Event()
+# Held while saving; under serve.py shared by every worker, so the newest document is written last
+config_save_lock = shared_store.snapshot_lock if shared_store is not None else threading.Lock()
+
+# Automation rules (auto mode), compiled once and evaluated per device
+rule_engine = RuleEngine(known_fields=set(initial_state))
+
+# Median/EWMA filter windows (per process under serve.py; dwell times live in the state)
+conditioner = signal_filters.SignalConditioner()
+
+# Settings per building, floor, room and device, resolved per device over the template values
+config = config_tree.ConfigTree({key: initial_state[key] for key in config_tree.SETTINGS})
+
+# Columnar copy of every device's latest state for fleet-wide analytics
+fleet = FleetColumns()
+
+# Live subscribers (dashboards, Flet apps) receiving state changes as they happen
+broadcaster = StateBroadcaster()
+
+# Versions restart with the process, so ETags also carry a per-boot ID
+BOOT_ID = uuid.uuid4().hex[:8]
+
+# Longest a ?since=<version> long-poll may block (seconds)
+MAX_LONG_POLL = 60
+
+# Oldest buffered reading accepted in a batch, and how far ahead of the
+# server clock a device's clock may run (seconds)
+MAX_READING_AGE = 7 * 24 * 3600
+MAX_CLOCK_SKEW = 300
+
+# Hot-path instrumentation exposed at /metrics (per process under serve.py)
+metric_registry = metrics.MetricsRegistry()
+request_latency = metric_registry.histogram(
+    "smartroom_http_request_duration_seconds", "Time spent handling a request", ("route", "method")
+)
+request_errors = metric_registry.counter(
+    "smartroom_http_errors_total", "Requests answered with an error status", ("route", "method", "status")
+)
+readings_ingested = metric_registry.counter(
+    "smartroom_readings_total", "Sensor readings applied, per device", ("device_id",)
+)
+auto_mode_latency = metric_registry.histogram(
+    "smartroom_auto_mode_evaluation_seconds", "Time spent evaluating automation rules for a reading",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+)
+long_polls = metric_registry.gauge(
+    "smartroom_long_polls", "Requests currently waiting in a long-poll"
+)
+metric_registry.gauge(
+    "smartroom_stream_subscribers", "Connected event-stream clients", broadcaster.subscriber_count
+)
+metric_registry.gauge("smartroom_devices", "Registered devices", lambda: len(registry))
+
+# Admission control for telemetry (per process under serve.py): per-device
+# rate limits and a bounded queue that gives way to control changes.
+# INGEST_RATE=0 turns the rate limit off.
+ingest_buckets = admission.TokenBuckets(
+    float(os.environ.get('INGEST_RATE', admission.DEFAULT_RATE)),
+    float(os.environ.get('INGEST_BURST', admission.DEFAULT_BURST))
+)
+ingest_gate = admission.AdmissionGate(
+    int(os.environ.get('INGEST_MAX_INFLIGHT', admission.DEFAULT_MAX_INFLIGHT)),
+    int(os.environ.get('INGEST_MAX_QUEUE', admission.DEFAULT_MAX_QUEUE)),
+    float(os.environ.get('INGEST_QUEUE_TIMEOUT', admission.DEFAULT_QUEUE_TIMEOUT))
+)
+readings_shed = metric_registry.counter(
+    "smartroom_readings_shed_total", "Telemetry requests turned away with Retry-After", ("reason",)
+)
+metric_registry.gauge("smartroom_ingest_queue", "Telemetry requests waiting for a slot", ingest_gate.queued)
+
+
+def shed_response(status, retry_after, reason):
+    # Tell the device when to come back instead of letting requests pile up
+    readings_shed.inc(reason)
+    return jsonify({"status": "error", "message": reason, "retry_after": retry_after}), status, {
+        'Retry-After': str(retry_after)
+    }
+
+
+def url_device(device_id):
+    # The reading belongs to the device in the URL
+    return device_id
+
+
+def packet_device(device_id):
+    # A binary packet may name its own device; a malformed one is rejected by the view
+    try:
+        packet_id = binary_protocol.parse_reading(request.get_data())[0]
+    except ValueError:
+        return device_id
+    return packet_id if packet_id is not None else device_id
+
+
+def telemetry_admission(device_of):
+    # Rate-limit the device device_of(device_id) picks from the request (None: the
+    # view charges the devices itself), then wait (briefly) for a telemetry slot
+    def decorator(view):
+        @functools.wraps(view)
+        def admitted(device_id):
+            charged = device_of(device_id) if device_of is not None else None
+            wait = ingest_buckets.take(charged) if charged is not None else 0
+            if wait:
+                return shed_response(429, admission.retry_seconds(wait), "rate limit exceeded")
+            retry_after = ingest_gate.acquire()
+            if retry_after is not None:
+                return shed_response(503, retry_after, "server busy")
+            started = time.perf_counter()
+            try:
+                return view(device_id)
+            finally:
+                ingest_gate.release(time.perf_counter() - started)
+        return admitted
+    return decorator
+
+
+def control_priority(view):
+    # Control changes skip the telemetry queue and hold back new telemetry while they run
+    @functools.wraps(view)
+    def prioritized(*args, **kwargs):
+        with ingest_gate.control():
+            return view(*args, **kwargs)
+    return prioritized
+
+
+def apply_auto_mode(device_id, state, now=None):
+    # Automatic control logic (only in auto mode), driven by the device's rules
+    if state["auto_mode"]:
+        started = time.perf_counter()
+        outputs = {field: state[field] for field in signal_filters.DWELL_OUTPUTS}
+        rule_engine.evaluate(device_id, state)
+        # Outputs that changed too recently keep their value
+        conditioner.hold_outputs(outputs, state, state["min_dwell"], now or time.time())
+        auto_mode_latency.observe(time.perf_counter() - started)
+
+
+def commit_change(device_id, before, state, kind, present=0, timestamp=None):
+    # Append the resulting state to the durable log and the fleet columns
+    reading_log.append(device_id, kind, state, present, timestamp)
+    fleet.update(device_id, state)
+    publish_change(device_id, before, state)
+
+
+def publish_change(device_id, before, state):
+    # Bump the version and push only the fields that actually changed
+    changes = {key: value for key, value in state.items() if before.get(key) != value}
+    if changes:
+        registry.mark_changed(device_id)
+        broadcaster.publish(device_id, changes)
+
+
+def versioned_state_response(device_id):
+    # Long-poll: with ?since=<version>, wait until the state moves past that version
+    since = request.args.get('since', type=int)
+    if since is not None:
+        timeout = min(request.args.get('timeout', 30, type=float), MAX_LONG_POLL)
+        # A version from before a restart is already stale: answer immediately
+        if since <= registry.version(device_id):
+            with long_polls.track():
+                registry.wait_for_change(device_id, since, timeout)
+
+    # Serialized bytes are cached per version, so N pollers cost one json.dumps
+    version, body = registry.versioned_json(device_id)
+    etag = f'"{BOOT_ID}-{version}"'
+    headers = {'ETag': etag, 'X-State-Version': str(version), 'Cache-Control': 'no-cache'}
+
+    # Nothing changed since the client's copy: answer 304 without a body
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def apply_reading(device_id, state, light_level=None, motion_detected=None, temperature=None,
+                  timestamp=None):
+    # Keep the raw reading in the history before it is merged into the state
+    readings_ingested.inc(device_id)
+    timestamp = timestamp or time.time()
+    history.record(device_id, timestamp, light_level, motion_detected, temperature)
+
+    # Update sensor values, keeping current values if not provided
+    before = dict(state)
+    if light_level is not None:
+        state["light_level"] = light_level
+    if motion_detected is not None:
+        state["motion_detected"] = motion_detected
+    if temperature is not None:
+        state["temperature"] = temperature
+    # Smooth the new samples before the rules see them
+    if light_level is not None:
+        conditioner.condition(device_id, state, "light_level", light_level)
+    if temperature is not None:
+        conditioner.condition(device_id, state, "temperature", temperature)
+    apply_auto_mode(device_id, state, timestamp)
+
+    # Log and publish the result, noting which sensors were sent
+    present = ((rlog.FLAG_HAS_LIGHT if light_level is not None else 0)
+               | (rlog.FLAG_HAS_MOTION if motion_detected is not None else 0)
+               | (rlog.FLAG_HAS_TEMPERATURE if temperature is not None else 0))
+    commit_change(device_id, before, state, rlog.KIND_READING, present, timestamp)
+
+
+def control_response(state):
+    # Control states the device should apply
+    return {
+        "auto_mode": state["auto_mode"],
+        "led_on": state["led_on"],
+        "servo_angle": state["servo_angle"]
+    }
+
+
+def ingest_reading(device_id, light_level=None, motion_detected=None, temperature=None):
+    # Apply one reading to a device and return its control states
+    with registry.locked(device_id) as state:
+        apply_reading(device_id, state, light_level, motion_detected, temperature)
+        return control_response(state)
+
+
+def reading_timestamp(value, now):
+    # Time a buffered reading was taken, in seconds since the epoch (None means now)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError("timestamp must be a number of seconds since the epoch")
+    if not now - MAX_READING_AGE <= value <= now + MAX_CLOCK_SKEW:
+        raise ValueError("timestamp is too far from the current time")
+    return float(value)
+
+
+def reading_values(reading):
+    # Sensor values of a buffered reading, checked before any reading of the batch is applied
+    light_level, motion_detected, temperature = (
+        reading.get("light_level"), reading.get("motion_detected"), reading.get("temperature"))
+    if light_level is not None and (isinstance(light_level, bool) or not isinstance(light_level, (int, float))
+                                    or not math.isfinite(light_level) or abs(light_level) >= 2 ** 31):
+        raise ValueError("light_level must be a finite 32-bit number")
+    if motion_detected is not None and motion_detected not in (True, False):
+        raise ValueError("motion_detected must be true or false")
+    if temperature is not None and (isinstance(temperature, bool) or not isinstance(temperature, (int, float))
+                                    or not math.isfinite(temperature)):
+        raise ValueError("temperature must be a finite number")
+    return light_level, None if motion_detected is None else bool(motion_detected), temperature
+
+
+def ingest_batch(readings, default_device_id):
+    # Group readings by device, keeping their original order within a device;
+    # every reading is checked before any is applied
+    by_device = {}
+    errors = []
+    waits = {}  # device_id -> seconds until its rate limit allows a reading (0: admitted)
+    now = time.time()
+    for index, reading in enumerate(readings):
+        if not isinstance(reading, dict):
+            errors.append({"index": index, "message": "reading must be an object"})
+            continue
+        device_id = reading.get("device_id", default_device_id)
+        if not isinstance(device_id, str) or not DEVICE_ID_PATTERN.fullmatch(device_id):
+            errors.append({"index": index, "message": "invalid device_id"})
+            continue
+        try:
+            values = reading_values(reading)
+            timestamp = reading_timestamp(reading.get("timestamp"), now)
+        except ValueError as e:
+            errors.append({"index": index, "message": str(e)})
+            continue
+        # A batch takes one token per device, however many buffered readings it carries
+        if device_id not in waits:
+            waits[device_id] = ingest_buckets.take(device_id)
+            if waits[device_id]:
+                readings_shed.inc("rate limit exceeded")
+        if waits[device_id]:
+            errors.append({"index": index, "message": "rate limit exceeded",
+                           "retry_after": admission.retry_seconds(waits[device_id])})
+            continue
+        by_device.setdefault(device_id, []).append((values, timestamp))
+
+    # Take each device lock once and apply all of its readings in order
+    decisions = {}
+    for device_id, device_readings in by_device.items():
+        with registry.locked(device_id) as state:
+            for (light_level, motion_detected, temperature), timestamp in device_readings:
+                apply_reading(
+                    device_id,
+                    state,
+                    light_level=light_level,
+                    motion_detected=motion_detected,
+                    temperature=temperature,
+                    # Buffered readings may carry the time they were taken
+                    timestamp=timestamp
+                )
+            decisions[device_id] = control_response(state)
+    return decisions, errors
+
+
+def apply_controls(device_id, data):
+    # Apply mode/LED/servo changes for one device
+    if 'auto_mode' in data:
+        # A mode switch is device-level configuration, so a change at a broader scope doesn't undo it
+        values = config_tree.validate_values({"auto_mode": data['auto_mode']})
+        share_config("config", config.update([({"device_id": device_id}, values)]))
+    with registry.locked(device_id) as state:
+        before = dict(state)
+        # Update auto mode if provided
+        if 'auto_mode' in data:
+            state['auto_mode'] = bool(data['auto_mode'])
+            # Outputs may have been changed by hand: re-run every rule on the next reading
+            if state['auto_mode'] and not before['auto_mode']:
+                rule_engine.reset(device_id)
+
+        # Only update LED and servo if in manual mode
+        if not state['auto_mode']:
+            if 'led_on' in data:
+                state['led_on'] = bool(data['led_on'])
+            if 'servo_angle' in data:
+                # Constrain servo angle between 0 and 180
+                angle = int(data['servo_angle'])
+                state['servo_angle'] = max(0, min(180, angle))
+        # Queue the changes for the device's command long-poll
+        command_outbox.enqueue(before, state)
+        commit_change(device_id, before, state, rlog.KIND_CONTROLS)
+
+
+def wait_for_commands(device_id, ack=None, timeout=0):
+    # Acknowledge delivered commands, then wait until there are commands to deliver
+    deadline = time.monotonic() + timeout
+    # Without an acknowledgement (device just booted) every control field is sent
+    full = ack is None
+    while True:
+        # Read the version first, so a command queued meanwhile ends the wait
+        version = registry.version(device_id)
+        with registry.locked(device_id) as state:
+            if ack is not None:
+                before = dict(state)
+                command_outbox.acknowledge(state, ack)
+                publish_change(device_id, before, state)
+                ack = None
+            seq, commands = command_outbox.pending(state, full)
+        remaining = deadline - time.monotonic()
+        if commands or remaining <= 0:
+            return seq, commands
+        with long_polls.track():
+            registry.wait_for_change(device_id, version, remaining)
+
+
+def apply_thresholds(device_id, data):
+    # Thresholds and filter settings sent for one device are device-level configuration
+    values = {key: value for key, value in data.items() if key in config_tree.SETTINGS and key != 'auto_mode'}
+    configure([{"scope": {"device_id": device_id}, "values": values}])
+
+
+def configure(changes):
+    # Validate every change before applying any, then apply them as one update
+    if not isinstance(changes, list):
+        raise ValueError("changes must be a list")
+    parsed = []
+    for change in changes:
+        values = change.get("values")
+        parsed.append((change.get("scope"), None if values is None else config_tree.validate_values(values)))
+    updated = config.update(parsed)
+    share_config("config", updated)
+
+    # Push the new effective values to every device under a changed scope
+    devices = {key[len("device:"):] for key in updated if key.startswith("device:")}
+    for device_id, location in fleet.locations().items():
+        if not updated.keys().isdisjoint(config_tree.location_keys(device_id, location)):
+            devices.add(device_id)
+    return sum(apply_config(device_id) for device_id in devices)
+
+
+def apply_config(device_id):
+    # Copy the device's effective settings into its state, where auto mode reads them
+    values = config.resolve(device_id, fleet.location(device_id))
+    with registry.locked(device_id) as state:
+        changes = {key: value for key, value in values.items() if state[key] != value}
+        if not changes:
+            return False
+        before = dict(state)
+        state.update(changes)
+        if state['auto_mode'] and not before['auto_mode']:
+            rule_engine.reset(device_id)
+        command_outbox.enqueue(before, state)
+        commit_change(device_id, before, state,
+                      rlog.KIND_CONTROLS if 'auto_mode' in changes else rlog.KIND_THRESHOLDS)
+    return True
+
+
+def ingest_datagram(device_id, light_level, motion_detected, temperature):
+    # UDP readings go through the same state update and auto-mode logic as /esp/update
+    if not DEVICE_ID_PATTERN.fullmatch(device_id):
+        raise ValueError("invalid device_id")
+    ingest_reading(device_id, light_level, motion_detected, temperature)
+
+
+def start_udp_ingest(reuse_port=False):
+    # Optional UDP listener, enabled by setting UDP_INGEST_PORT
+    port = os.environ.get('UDP_INGEST_PORT')
+    if port:
+        return UdpIngestServer(ingest_datagram, port=int(port), reuse_port=reuse_port).start()
+    return None
+
+
+def restore_from_log():
+    # Rebuild device states and the last day of history from the durable log;
+    # restore_config() has already reinstalled locations and configuration
+    in_memory = isinstance(history, SensorHistory)
+    states, readings = reading_log.replay(history_start=time.time() - 24 * 3600 if in_memory else None)
+    for device_id, saved in states.items():
+        with registry.locked(device_id) as state:
+            # Settings the log doesn't record (filter settings) come from the configuration
+            values = config.resolve(device_id, fleet.location(device_id))
+            state.update({key: value for key, value in values.items() if key not in saved})
+            state.update(saved)
+            # The log holds raw readings; start the filters from the last ones
+            for sensor, (field, _) in signal_filters.FILTERED_SENSORS.items():
+                state[field] = float(state[sensor])
+            fleet.update(device_id, state)
+
+    # Readings are sorted by device and time: fill each sensor series in one go
+    raw_ids = readings["device_id"]
+    bounds = np.flatnonzero(raw_ids[1:] != raw_ids[:-1]) + 1
+    for device_readings in np.split(readings, bounds) if len(readings) else []:
+        device_id = device_readings["device_id"][0].decode("utf-8")
+        flags = device_readings["flags"]
+        for sensor, has_flag, values in (
+                ("light_level", rlog.FLAG_HAS_LIGHT, device_readings["light_level"]),
+                ("motion_detected", rlog.FLAG_HAS_MOTION, (flags & rlog.FLAG_MOTION) != 0),
+                ("temperature", rlog.FLAG_HAS_TEMPERATURE, device_readings["temperature"])):
+            present = (flags & has_flag) != 0
+            if present.any():
+                history.load(device_id, sensor,
+                             np.ascontiguousarray(device_readings["timestamp"][present], dtype=np.float64),
+                             np.ascontiguousarray(values[present], dtype=np.float64))
+
+
+# Rules, locations and configuration as (generation, document) last applied here;
+# under serve.py the document is shared by every worker through shared_store
+shared_config = (0, {})
+shared_config_lock = threading.Lock()
+
+
+def apply_config_document(document, applied):
+    # Apply the rules, locations and configuration of a document that differ from those applied
+    for device_id, definitions in document.get("rules", {}).items():
+        if applied.get("rules", {}).get(device_id) != definitions:
+            rule_engine.set_rules(device_id, definitions)
+    for device_id, location in document.get("locations", {}).items():
+        if applied.get("locations", {}).get(device_id) != location:
+            fleet.set_location(device_id, **location)
+            config.invalidate(device_id)
+    if document.get("config", {}) != applied.get("config", {}):
+        # The worker making a change also copied it into the shared device states
+        config.load(document.get("config", {}))
+
+
+def sync_shared_config():
+    # Apply rules, locations and configuration that other worker processes changed
+    global shared_config
+    if shared_store is None or shared_store.config_generation() == shared_config[0]:
+        return
+    with shared_config_lock:
+        generation, document = shared_store.read_config()
+        apply_config_document(document, shared_config[1])
+        shared_config = (generation, document)
+
+
+def save_config_snapshot():
+    # Save the current document; it is read under the save lock, so a slower save
+    # never overwrites a newer one
+    with config_save_lock:
+        if shared_store is not None:
+            text = json.dumps(shared_store.read_config()[1])
+        else:
+            with shared_config_lock:
+                text = json.dumps(shared_config[1])
+        # Write to a temporary file first so a crash never leaves half a document
+        temp_path = f"{CONFIG_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, CONFIG_SNAPSHOT_PATH)
+
+
+def config_save_loop():
+    # Requests only flag a change; changes in quick succession are saved once
+    while True:
+        config_changed.wait()
+        time.sleep(CONFIG_SAVE_DELAY)
+        config_changed.clear()
+        try:
+            save_config_snapshot()
+        except Exception:
+            # Retried with the next change
+            app.logger.exception("saving %s failed", CONFIG_SNAPSHOT_PATH)
+
+
+def save_pending_config():
+    # At exit: save a change the background thread hasn't written yet
+    if config_changed.is_set():
+        save_config_snapshot()
+
+
+def start_config_saver():
+    threading.Thread(target=config_save_loop, daemon=True).start()
+    atexit.register(save_pending_config)
+
+
+def share_config(section, entries):
+    # Publish rules/location/configuration changes to the other worker processes;
+    # config.json is saved off the request path
+    if shared_store is not None:
+        shared_store.update_config(lambda document: document.setdefault(section, {}).update(entries))
+        sync_shared_config()
+    else:
+        with shared_config_lock:
+            shared_config[1].setdefault(section, {}).update(entries)
+    config_changed.set()
+
+
+def restore_config():
+    # Reinstall the rules, locations and configuration saved by the previous run
+    global shared_config
+    try:
+        with open(CONFIG_SNAPSHOT_PATH) as f:
+            document = json.load(f)
+    except FileNotFoundError:
+        return
+    if shared_store is not None:
+        shared_store.update_config(lambda shared: shared.update(document))
+        sync_shared_config()
+    else:
+        with shared_config_lock:
+            apply_config_document(document, {})
+            shared_config = (0, document)
+
+
+@app.before_request
+def apply_shared_config():
+    # Every request sees rules, locations and configuration changed through other workers
+    sync_shared_config()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Label by route template (not the raw path) to keep the number of series bounded
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    started = g.get('request_started')
+    if started is not None:
+        request_latency.observe(time.perf_counter() - started, route, request.method)
+    if response.status_code >= 400:
+        request_errors.inc(route, request.method, str(response.status_code))
+    return response
+
+
+def after_fork():
+    # Called by serve.py in every worker: threads and sockets don't survive fork
+    reading_log.open()
+    start_config_saver()
+    start_udp_ingest(reuse_port=True)
+
+
+# With debug=True, `python backend.py` also runs as the reloader's file watcher,
+# which only restarts the server process (the one with WERKZEUG_RUN_MAIN set)
+RELOADER_WATCHER = __name__ == '__main__' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+
+# Restore the previous state; under serve.py workers open the log after forking
+if not RELOADER_WATCHER:
+    restore_config()
+    restore_from_log()
+    if shared_store is None:
+        reading_log.open()
+        start_config_saver()
+
+
+# Static dashboard shell: live values are filled in by its JavaScript from the data endpoints
+DASHBOARD_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
         <title>Smart Room Controller Dashboard</title>
         <style>
             /* Basic page styling */
-            body {{
+            body {
                 font-family: Arial, sans-serif;
                 margin: 20px;
                 background-color: #f5f5f5;
-            }}
+            }
             /* Dashboard container styling */
-            .dashboard {{
+            .dashboard {
                 max-width: 800px;
                 margin: 0 auto;
                 background: white;
                 padding: 20px;
                 border-radius: 8px;
                 box-shadow: 0 0 10px rgba(0,0,0,0.1);
-            }}
+            }
             /* Styling for sensor and control sections */
-            .sensor-data, .controls {{
+            .sensor-data, .controls {
                 margin-bottom: 20px;
                 padding: 15px;
                 border: 1px solid #ddd;
                 border-radius: 5px;
-            }}
+            }
             /* Status indicator styling */
-            .status {{
+            .status {
                 font-weight: bold;
-            }}
+            }
             /* Color coding for different states */
-            .on {{ color: green; }}    /* LED on state */
-            .off {{ color: red; }}     /* LED off state */
-            .auto {{ color: blue; }}   /* Auto mode */
-            .manual {{ color: orange; }} /* Manual mode */
+            .on { color: green; }    /* LED on state */
+            .off { color: red; }     /* LED off state */
+            .auto { color: blue; }   /* Auto mode */
+            .manual { color: orange; } /* Manual mode */
             /* Button styling */
-            button {{
+            button {
                 padding: 8px 15px;
                 margin: 5px;
                 cursor: pointer;
-            }}
+            }
             /* Threshold control section styling */
-            .threshold-control {{
+            .threshold-control {
                 margin-top: 10px;
-            }}
+            }
             /* Input field styling */
-            input[type="number"] {{
+            input[type="number"] {
                 width: 80px;
                 padding: 5px;
-            }}
+            }
         </style>
     </head>
     <body>
         <!-- Main dashboard container -->
         <div class="dashboard">
             <h1>IoT System Dashboard</h1>
+            <p>Device: <span id="device-id">--</span></p>
             
             <!-- Sensor readings section -->
             <div class="sensor-data">
                 <h2>Sensor Readings</h2>
                 <!-- Light level display -->
-                <p>Light Level: <span id="light-level">{initial_state["light_level"]}</span></p>
+                <p>Light Level: <span id="light-level">--</span></p>
                 <!-- Motion detection display -->
-                <p>Motion Detected: <span id="motion" class="status">{'YES' if initial_state["motion_detected"] else 'NO'}</span></p>
+                <p>Motion Detected: <span id="motion" class="status">--</span></p>
                 <!-- Temperature display -->
-                <p>Temperature: <span id="temperature">{initial_state["temperature"]} °C</span></p>
+                <p>Temperature: <span id="temperature">-- °C</span></p>
             </div>
             
             <!-- Control status section -->
             <div class="controls">
                 <h2>Control Status</h2>
                 <!-- Mode display (Auto/Manual) -->
-                <p>Mode: <span id="mode" class="status {'auto' if initial_state["auto_mode"] else 'manual'}">
-                    {'AUTO' if initial_state["auto_mode"] else 'MANUAL'}
+                <p>Mode: <span id="mode" class="status">
+                    --
                 </span></p>
                 <!-- LED status display -->
-                <p>LED: <span id="led-status" class="status {'on' if initial_state["led_on"] else 'off'}">
-                    {'ON' if initial_state["led_on"] else 'OFF'}
+                <p>LED: <span id="led-status" class="status">
+                    --
                 </span></p>
                 <!-- Servo angle display -->
-                <p>Servo Angle: <span id="servo-angle">{initial_state["servo_angle"]}°</span></p>
+                <p>Servo Angle: <span id="servo-angle">--°</span></p>
                 
                 <!-- Threshold settings section -->
                 <div class="threshold-control">
                     <h3>Threshold Settings</h3>
                     <!-- Temperature threshold control -->
                     <label>Temperature Threshold (°C): 
-                        <input type="number" id="temp-threshold" value="{initial_state["temp_threshold"]}" step="0.1">
+                        <input type="number" id="temp-threshold" step="0.1">
                         <button onclick="updateThreshold('temp')">Update</button>
                     </label>
                     <br>
                     <!-- Light threshold control -->
                     <label>Light Threshold: 
-                        <input type="number" id="light-threshold" value="{initial_state["light_threshold"]}">
+                        <input type="number" id="light-threshold" >
                         <button onclick="updateThreshold('light')">Update</button>
                     </label>
                 </div>
@@ -132,7 +780,7 @@ def dashboard():
                 <!-- Toggle mode button -->
                 <button onclick="toggleAutoMode()">Toggle Auto/Manual</button>
                 <!-- Manual controls (only visible in manual mode) -->
-                <div id="manual-controls" style="{'display:none;' if initial_state["auto_mode"] else ''}">
+                <div id="manual-controls" style="display:none;">
                     <button onclick="toggleLED()">Toggle LED</button>
                     <button onclick="setServo(90)">Servo 90°</button>
                     <button onclick="setServo(0)">Servo 0°</button>
@@ -142,137 +790,288 @@ def dashboard():
 
         <!-- JavaScript for dynamic functionality -->
         <script>
+            // API base of this dashboard: '' for '/', '/devices/<id>' for '/devices/<id>/'
+            const API = window.location.pathname.replace(/\/$/, '');
+            const DEVICE_ID = API ? API.split('/').pop() : 'default';
+
+            // Latest known state, merged from full snapshots and pushed changes
+            const state = {};
+            // Polling timer, only used while the live stream is unavailable
+            let pollTimer = null;
+            let streaming = false;
+
+            // Function to merge new data and update the elements whose values changed
+            function render(data) {
+                Object.assign(state, data);
+                if ('light_level' in data) {
+                    document.getElementById('light-level').textContent = state.light_level;
+                }
+                if ('motion_detected' in data) {
+                    document.getElementById('motion').textContent = state.motion_detected ? 'YES' : 'NO';
+                }
+                if ('temperature' in data) {
+                    document.getElementById('temperature').textContent = state.temperature + ' °C';
+                }
+                if ('auto_mode' in data) {
+                    document.getElementById('mode').textContent = state.auto_mode ? 'AUTO' : 'MANUAL';
+                    document.getElementById('mode').className = 'status ' + (state.auto_mode ? 'auto' : 'manual');
+                    document.getElementById('manual-controls').style.display = state.auto_mode ? 'none' : 'block';
+                }
+                if ('led_on' in data) {
+                    document.getElementById('led-status').textContent = state.led_on ? 'ON' : 'OFF';
+                    document.getElementById('led-status').className = 'status ' + (state.led_on ? 'on' : 'off');
+                }
+                if ('servo_angle' in data) {
+                    document.getElementById('servo-angle').textContent = state.servo_angle + '°';
+                }
+                if ('temp_threshold' in data) {
+                    document.getElementById('temp-threshold').value = state.temp_threshold;
+                }
+                if ('light_threshold' in data) {
+                    document.getElementById('light-threshold').value = state.light_threshold;
+                }
+            }
+
             // Function to refresh all data from the server
-            function refreshData() {{
-                fetch('/api/system_status')
+            function refreshData() {
+                fetch(API + '/api/system_status')
                     .then(response => response.json())
-                    .then(data => {{
-                        // Update all display elements with new data
-                        document.getElementById('light-level').textContent = data.light_level;
-                        document.getElementById('motion').textContent = data.motion_detected ? 'YES' : 'NO';
-                        document.getElementById('temperature').textContent = data.temperature + ' °C';
-                        document.getElementById('mode').textContent = data.auto_mode ? 'AUTO' : 'MANUAL';
-                        document.getElementById('mode').className = 'status ' + (data.auto_mode ? 'auto' : 'manual');
-                        document.getElementById('led-status').textContent = data.led_on ? 'ON' : 'OFF';
-                        document.getElementById('led-status').className = 'status ' + (data.led_on ? 'on' : 'off');
-                        document.getElementById('servo-angle').textContent = data.servo_angle + '°';
-                        document.getElementById('manual-controls').style.display = data.auto_mode ? 'none' : 'block';
-                        document.getElementById('temp-threshold').value = data.temp_threshold;
-                        document.getElementById('light-threshold').value = data.light_threshold;
-                    }});
-            }}
+                    .then(render);
+            }
+
+            // After an action, the live stream delivers the change; poll only without it
+            function afterAction() {
+                if (!streaming) {
+                    refreshData();
+                }
+            }
+
+            // Fall back to polling every 2 seconds while the stream is down
+            function startPolling() {
+                if (pollTimer === null) {
+                    pollTimer = setInterval(refreshData, 2000);
+                }
+            }
+
+            function stopPolling() {
+                if (pollTimer !== null) {
+                    clearInterval(pollTimer);
+                    pollTimer = null;
+                }
+            }
+
+            // Subscribe to pushed state changes (EventSource reconnects by itself)
+            function startStream() {
+                if (!window.EventSource) {
+                    startPolling();
+                    return;
+                }
+                const source = new EventSource(API + '/api/stream');
+                source.onopen = () => {
+                    streaming = true;
+                    stopPolling();
+                };
+                source.onmessage = event => render(JSON.parse(event.data));
+                source.onerror = () => {
+                    streaming = false;
+                    startPolling();
+                };
+            }
 
             // Function to toggle between auto and manual mode
-            function toggleAutoMode() {{
+            function toggleAutoMode() {
                 const newMode = !(document.getElementById('mode').textContent === 'AUTO');
-                fetch('/flet/update', {{
+                fetch(API + '/flet/update', {
                     method: 'POST',
-                    headers: {{ 'Content-Type': 'application/json' }},
-                    body: JSON.stringify({{ auto_mode: newMode }})
-                }}).then(refreshData);
-            }}
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ auto_mode: newMode })
+                }).then(afterAction);
+            }
 
             // Function to toggle LED state
-            function toggleLED() {{
+            function toggleLED() {
                 const newState = !(document.getElementById('led-status').textContent === 'ON');
-                fetch('/flet/update', {{
+                fetch(API + '/flet/update', {
                     method: 'POST',
-                    headers: {{ 'Content-Type': 'application/json' }},
-                    body: JSON.stringify({{ led_on: newState }})
-                }}).then(refreshData);
-            }}
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ led_on: newState })
+                }).then(afterAction);
+            }
 
             // Function to set servo angle
-            function setServo(angle) {{
-                fetch('/flet/update', {{
+            function setServo(angle) {
+                fetch(API + '/flet/update', {
                     method: 'POST',
-                    headers: {{ 'Content-Type': 'application/json' }},
-                    body: JSON.stringify({{ servo_angle: angle }})
-                }}).then(refreshData);
-            }}
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ servo_angle: angle })
+                }).then(afterAction);
+            }
 
             // Function to update thresholds
-            function updateThreshold(type) {{
+            function updateThreshold(type) {
                 const value = parseFloat(document.getElementById(type + '-threshold').value);
-                fetch('/flet/update_thresholds', {{
+                fetch(API + '/flet/update_thresholds', {
                     method: 'POST',
-                    headers: {{ 'Content-Type': 'application/json' }},
-                    body: JSON.stringify({{ 
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ 
                         temp_threshold: type === 'temp' ? value : undefined,
                         light_threshold: type === 'light' ? value : undefined
-                    }})
-                }}).then(refreshData);
-            }}
+                    })
+                }).then(afterAction);
+            }
 
-            // Set up automatic data refresh every 2 seconds
-            setInterval(refreshData, 2000);
-            
-            // Refresh data when page loads
-            document.addEventListener('DOMContentLoaded', refreshData);
+            // Load the current state and subscribe to live updates when the page loads
+            document.addEventListener('DOMContentLoaded', () => {
+                document.getElementById('device-id').textContent = DEVICE_ID;
+                refreshData();
+                startStream();
+            });
         </script>
     </body>
     </html>
-    """, mimetype='text/html')
+    """
+
+# Rendered once at startup and kept precompressed, with a strong ETag
+DASHBOARD_BYTES = DASHBOARD_HTML.encode('utf-8')
+DASHBOARD_GZIP = gzip.compress(DASHBOARD_BYTES, compresslevel=9, mtime=0)
+# The gzip and plain copies are different bodies, so each has its own ETag
+DASHBOARD_ETAG = hashlib.sha256(DASHBOARD_BYTES).hexdigest()[:32]
+DASHBOARD_GZIP_ETAG = DASHBOARD_ETAG + '-gz'
+
+# Define the root route that serves the HTML dashboard
+@app.route('/', defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/')
+def dashboard(device_id):
+    # Every device shares the same cached shell; it finds its device from the URL.
+    # Clients that accept gzip get the precompressed copy
+    gzipped = 'gzip' in request.accept_encodings
+    etag = DASHBOARD_GZIP_ETAG if gzipped else DASHBOARD_ETAG
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': 'public, max-age=600',
+        'Vary': 'Accept-Encoding'
+    }
+    # The browser already has this version in this encoding
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(DASHBOARD_GZIP, mimetype='text/html', headers=headers)
+    return Response(DASHBOARD_BYTES, mimetype='text/html', headers=headers)
 
 # API endpoint for ESP32 to send sensor data
-@app.route('/esp/update', methods=['POST'])
-def receive_sensor_data():
+@app.route('/esp/update', methods=['POST'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/esp/update', methods=['POST'])
+@telemetry_admission(url_device)
+def receive_sensor_data(device_id):
     try:
         # Get JSON data from the request
         data = request.get_json()
-        
-        # Update sensor values from ESP32, keeping current values if not provided
-        initial_state["light_level"] = data.get("light_level", initial_state["light_level"])
-        initial_state["motion_detected"] = data.get("motion_detected", initial_state["motion_detected"])
-        initial_state["temperature"] = data.get("temperature", initial_state["temperature"])
-
-        # Automatic control logic (only in auto mode)
-        if initial_state["auto_mode"]:
-            # Turn LED on if light level below threshold
-            initial_state["led_on"] = initial_state["light_level"] < initial_state["light_threshold"]
-            # Set servo to 90° if motion detected and temperature above threshold
-            if initial_state["motion_detected"] and initial_state["temperature"] > initial_state["temp_threshold"]:
-                initial_state["servo_angle"] = 90
-            else:
-                initial_state["servo_angle"] = 0
+
+        # Update sensor values and run the automatic control logic
+        controls = ingest_reading(
+            device_id,
+            light_level=data.get("light_level"),
+            motion_detected=data.get("motion_detected"),
+            temperature=data.get("temperature")
+        )
 
         # Return success response with current control states
+        return jsonify({"status": "success", **controls})
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# API endpoint for ESP32 nodes using the compact binary protocol
+@app.route('/esp/update_bin', methods=['POST'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/esp/update_bin', methods=['POST'])
+@telemetry_admission(packet_device)
+def receive_sensor_binary(device_id):
+    try:
+        # 24-byte struct in, 3-byte struct out: no JSON on either side
+        packet_id, light_level, motion_detected, temperature = binary_protocol.parse_reading(request.get_data())
+        if packet_id is not None:
+            if not DEVICE_ID_PATTERN.fullmatch(packet_id):
+                raise ValueError("invalid device_id")
+            device_id = packet_id
+
+        with registry.locked(device_id) as state:
+            apply_reading(device_id, state, light_level, motion_detected, temperature)
+            body = binary_protocol.pack_controls(state)
+        return Response(body, mimetype=binary_protocol.BINARY_MIMETYPE)
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# API endpoint for gateways and reconnecting devices to send many readings at once
+@app.route('/esp/update_batch', methods=['POST'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/esp/update_batch', methods=['POST'])
+# Each device in the batch is charged by ingest_batch
+@telemetry_admission(None)
+def receive_sensor_batch(device_id):
+    try:
+        # Accept either a JSON array or newline-delimited JSON (one reading per line)
+        if request.mimetype == 'application/x-ndjson':
+            lines = request.get_data(as_text=True).splitlines()
+            readings = [json.loads(line) for line in lines if line.strip()]
+        else:
+            readings = request.get_json()
+            if not isinstance(readings, list):
+                raise ValueError("expected a JSON array of readings")
+
+        # Readings without a device_id belong to the device in the URL
+        decisions, errors = ingest_batch(readings, device_id)
+
+        # Nothing applied because every device was over its rate limit
+        retry_after = [error["retry_after"] for error in errors if "retry_after" in error]
+        if retry_after and not decisions:
+            return jsonify({"status": "error", "message": "rate limit exceeded", "retry_after": min(retry_after),
+                            "errors": errors}), 429, {'Retry-After': str(min(retry_after))}
+
+        # Return the latest control states of every device in the batch
         return jsonify({
-            "status": "success",
-            "auto_mode": initial_state["auto_mode"],
-            "led_on": initial_state["led_on"],
-            "servo_angle": initial_state["servo_angle"]
+            "status": "success" if not errors else "partial",
+            "processed": len(readings) - len(errors),
+            "devices": decisions,
+            "errors": errors
         })
     except Exception as e:
         # Return error response if something goes wrong
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # API endpoint for ESP32 to get current state
-@app.route('/esp/control', methods=['GET'])
-def send_to_esp():
-    # Return the complete system state as JSON
-    return jsonify(initial_state)
+@app.route('/esp/control', methods=['GET'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/esp/control', methods=['GET'])
+def send_to_esp(device_id):
+    # Return the complete device state as JSON (supports ETag and ?since= long-polls)
+    return versioned_state_response(device_id)
+
+# Long-poll endpoint delivering queued control commands to the ESP32
+@app.route('/esp/commands', methods=['GET'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/esp/commands', methods=['GET'])
+def deliver_commands(device_id):
+    try:
+        # ?ack=<seq> confirms the last delivery; ?timeout=<seconds> waits for new commands
+        ack = request.args.get('ack', type=int)
+        timeout = min(request.args.get('timeout', 0, type=float), MAX_LONG_POLL)
+        seq, commands = wait_for_commands(device_id, ack, timeout)
+        return jsonify({"seq": seq, "commands": commands})
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
 
 # API endpoint for frontend to update controls
-@app.route('/flet/update', methods=['POST'])
-def update_controls():
+@app.route('/flet/update', methods=['POST'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/flet/update', methods=['POST'])
+@control_priority
+def update_controls(device_id):
     try:
         # Get JSON data from the request
         data = request.get_json()
-        
-        # Update auto mode if provided
-        if 'auto_mode' in data:
-            initial_state['auto_mode'] = bool(data['auto_mode'])
-        
-        # Only update LED and servo if in manual mode
-        if not initial_state['auto_mode']:
-            if 'led_on' in data:
-                initial_state['led_on'] = bool(data['led_on'])
-            if 'servo_angle' in data:
-                # Constrain servo angle between 0 and 180
-                angle = int(data['servo_angle'])
-                initial_state['servo_angle'] = max(0, min(180, angle))
-        
+
+        # Update mode, LED and servo for this device
+        apply_controls(device_id, data)
+
         # Return success response
         return jsonify({"status": "success"})
     except Exception as e:
@@ -280,20 +1079,17 @@ def update_controls():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # API endpoint for updating thresholds
-@app.route('/flet/update_thresholds', methods=['POST'])
-def update_thresholds():
+@app.route('/flet/update_thresholds', methods=['POST'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/flet/update_thresholds', methods=['POST'])
+@control_priority
+def update_thresholds(device_id):
     try:
         # Get JSON data from the request
         data = request.get_json()
-        
-        # Update temperature threshold if provided
-        if 'temp_threshold' in data:
-            initial_state['temp_threshold'] = float(data['temp_threshold'])
-        
-        # Update light threshold if provided
-        if 'light_threshold' in data:
-            initial_state['light_threshold'] = int(data['light_threshold'])
-        
+
+        # Update temperature and/or light threshold if provided
+        apply_thresholds(device_id, data)
+
         # Return success response
         return jsonify({"status": "success"})
     except Exception as e:
@@ -301,12 +1097,182 @@ def update_thresholds():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 # API endpoint to get complete system status
-@app.route('/api/system_status', methods=['GET'])
-def system_status():
-    # Return the complete system state as JSON
-    return jsonify(initial_state)
+@app.route('/api/system_status', methods=['GET'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/api/system_status', methods=['GET'])
+def system_status(device_id):
+    # Return the complete device state as JSON (supports ETag and ?since= long-polls)
+    return versioned_state_response(device_id)
+
+# Server-Sent Events stream pushing state changes to dashboards and apps
+@app.route('/api/stream', methods=['GET'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/api/stream', methods=['GET'])
+def state_stream(device_id):
+    # The first event holds the full state, later events only the changed fields
+    # With several worker processes, changes made elsewhere are found through the version
+    events = broadcaster.stream(
+        device_id,
+        lambda: registry.snapshot(device_id),
+        version=registry.version if shared_store is not None else None
+    )
+    return Response(events, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Disable buffering in nginx-style proxies
+    })
+
+# API endpoint for min/max/mean history of one sensor over a time range
+@app.route('/api/history', methods=['GET'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/api/history', methods=['GET'])
+def sensor_history(device_id):
+    try:
+        # Defaults: the last hour of temperature in one-minute buckets
+        sensor = request.args.get('sensor', 'temperature')
+        end = request.args.get('end', time.time(), type=float)
+        start = request.args.get('start', end - 3600, type=float)
+        resolution = request.args.get('resolution', 60, type=float)
+
+        buckets = history.query(device_id, sensor, start, end, resolution)
+
+        # Return one entry per non-empty bucket
+        return jsonify({
+            "device_id": device_id,
+            "sensor": sensor,
+            "start": start,
+            "end": end,
+            "resolution": resolution,
+            "buckets": [
+                {"start": t, "min": low, "max": high, "mean": mean, "count": count}
+                for t, low, high, mean, count in buckets
+            ]
+        })
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# API endpoint to read or replace the automation rules of a device
+@app.route('/api/rules', methods=['GET', 'PUT', 'DELETE'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/api/rules', methods=['GET', 'PUT', 'DELETE'])
+def device_rules(device_id):
+    try:
+        if request.method == 'PUT':
+            # Replace the rules with {"rules": [...]}; they are compiled before installing
+            definitions = request.get_json()["rules"]
+            rule_engine.set_rules(device_id, definitions)
+            share_config("rules", {device_id: definitions})
+        elif request.method == 'DELETE':
+            # Go back to the built-in rules
+            rule_engine.set_rules(device_id, None)
+            share_config("rules", {device_id: None})
+
+        ruleset = rule_engine.rules_for(device_id)
+        return jsonify({
+            "device_id": device_id,
+            "custom": ruleset is not rule_engine.default,
+            "rules": ruleset.definitions
+        })
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# API endpoint to read or set where a device is installed
+@app.route('/api/location', methods=['GET', 'PUT'], defaults={'device_id': DEFAULT_DEVICE_ID})
+@app.route('/devices/<device:device_id>/api/location', methods=['GET', 'PUT'])
+def device_location(device_id):
+    try:
+        if request.method == 'PUT':
+            # {"building": ..., "floor": ..., "room": ...}; missing parts are unassigned
+            data = request.get_json()
+            location = {part: data.get(part) for part in ('building', 'floor', 'room')}
+            fleet.set_location(device_id, **location)
+            share_config("locations", {device_id: location})
+            # Settings of the new building, floor and room now apply
+            config.invalidate(device_id)
+            apply_config(device_id)
+        return jsonify({"device_id": device_id, **fleet.location(device_id)})
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Streaming export of readings and control changes from the durable log
+@app.route('/api/export', methods=['GET'], defaults={'device_id': None})
+@app.route('/devices/<device:device_id>/api/export', methods=['GET'])
+def export_log(device_id):
+    try:
+        # ?format=csv|ndjson&devices=a,b&start=<ts>&end=<ts>&events=reading,controls
+        fmt = request.args.get('format', 'ndjson')
+        device_ids = [device_id] if device_id else [d for d in request.args.get('devices', '').split(',') if d]
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        events = request.args.get('events')
+        kinds = log_export.event_kinds(events.split(',')) if events else None
+        chunks = log_export.export(reading_log, fmt, device_ids, start, end, kinds)
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+    # Chunks are produced while the response is sent, so memory stays flat
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="smartroom-export.{fmt}"',
+        'X-Accel-Buffering': 'no'
+    })
+
+# API endpoint to read or change settings per building, floor, room and device
+@app.route('/api/config', methods=['GET', 'POST'])
+@control_priority
+def bulk_config():
+    try:
+        if request.method == 'POST':
+            # {"changes": [{"scope": {"building": ..., "floor": ...}, "values": {...}}, ...]};
+            # every change is validated before any is applied
+            updated = configure(request.get_json()["changes"])
+            return jsonify({"status": "success", "generation": config.generation, "devices_updated": updated})
+        return jsonify({"generation": config.generation, "entries": list(config.entries().values())})
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# API endpoint showing a device's effective settings and the levels they come from
+@app.route('/devices/<device:device_id>/api/config', methods=['GET'])
+def device_config(device_id):
+    location = fleet.location(device_id)
+    return jsonify({
+        "device_id": device_id,
+        "location": location,
+        "effective": config.resolve(device_id, location),
+        "layers": config.layers(device_id, location)
+    })
+
+# API endpoint for building-level aggregates over every device
+@app.route('/api/fleet/summary', methods=['GET'])
+def fleet_summary():
+    try:
+        # ?group_by=floor|building&percentiles=50,90,99&max_age=<seconds>
+        group_by = request.args.get('group_by', 'floor')
+        percentiles = [float(p) for p in request.args.get('percentiles', '50,90,99').split(',')]
+        max_age = request.args.get('max_age', type=float)
+        if shared_store is not None:
+            # Other workers' updates only reach this process through shared memory
+            fleet.load(*registry.columns())
+        return jsonify(fleet.summary(group_by, percentiles, max_age))
+    except Exception as e:
+        # Return error response if something goes wrong
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metric_registry.render(), content_type=metrics.CONTENT_TYPE)
+
+# API endpoint listing every registered device
+@app.route('/api/devices', methods=['GET'])
+def list_devices():
+    # Return the IDs of all devices that have reported or been configured
+    return jsonify({"devices": sorted(registry.device_ids())})
 
 # Main entry point for the application
 if __name__ == '__main__':
+    # Start the UDP listener in the serving process, not in the reloader's file watcher
+    if not RELOADER_WATCHER:
+        start_udp_ingest()
     # Run the Flask app on all network interfaces, port 5000, with debug mode on
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,322 @@
+# Load generator and benchmark for the backend: a simulated ESP32 fleet,
+# polling dashboards and bursts of app updates, reported as JSON
+#
+# Usage: python bench.py --devices 200 --dashboards 50 --duration 10
+#        python bench.py --url http://127.0.0.1:5000 --output run.json --baseline previous.json
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.parse import urlsplit
+
+SCENARIOS = ("ingest", "polling", "control_burst", "mixed")
+
+
+class InProcessTransport:
+    """Calls the Flask app directly through its test client (no network)"""
+
+    # The app runs in this process, so its memory can be measured here
+    measures_memory = True
+
+    def __init__(self):
+        # Keep benchmark writes out of the real reading log
+        os.environ.setdefault("READING_LOG_DIR", tempfile.mkdtemp(prefix="bench-log-"))
+        # Simulated devices report far faster than the per-device rate limit allows
+        os.environ.setdefault("INGEST_RATE", "0")
+        import backend
+        self.app = backend.app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers or {})
+        return response.status_code, response.headers.get("ETag")
+
+
+class HttpTransport:
+    """Sends requests to a running server over one keep-alive connection per thread"""
+
+    # Server memory isn't visible from the client
+    measures_memory = False
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        for attempt in (1, 2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                connection.request(method, path, payload, headers)
+                response = connection.getresponse()
+                response.read()
+                return response.status, response.getheader("ETag")
+            except (OSError, http.client.HTTPException):
+                # Reconnect once (the server may have closed an idle connection)
+                connection.close()
+                self._local.connection = None
+                if attempt == 2:
+                    raise
+
+
+class Recorder:
+    """Latencies and errors per route label, collected from all threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.shed = {}
+
+    def call(self, transport, label, method, path, body=None, headers=None):
+        started = time.perf_counter()
+        try:
+            status, etag = transport.request(method, path, body, headers)
+        except Exception:
+            status, etag = None, None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            # 429/503 are admission control turning readings away: counted on their
+            # own and left out of throughput and latencies
+            if status in (429, 503):
+                self.shed[label] = self.shed.get(label, 0) + 1
+                return etag
+            self.latencies.setdefault(label, []).append(elapsed)
+            # 304 answers to conditional polls are successes
+            if status is None or status >= 400:
+                self.errors[label] = self.errors.get(label, 0) + 1
+        return etag
+
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def device_ids(count):
+    return [f"bench-{i:05d}" for i in range(count)]
+
+
+# ----- actors: each runs in its own thread until the deadline -----
+
+def ingest_actor(transport, recorder, deadline, devices):
+    # Every device posts a reading in turn, as fast as the server answers
+    while time.monotonic() < deadline:
+        for device_id in devices:
+            recorder.call(transport, "esp_update", "POST", f"/devices/{device_id}/esp/update", {
+                "light_level": random.randint(0, 4095),
+                "motion_detected": random.random() < 0.3,
+                "temperature": round(random.uniform(18, 30), 1)
+            })
+            if time.monotonic() >= deadline:
+                return
+
+
+def dashboard_actor(transport, recorder, deadline, rooms):
+    # Each dashboard polls its room conditionally, like the web dashboard and the Flet app
+    etags = [None] * len(rooms)
+    while time.monotonic() < deadline:
+        for index, room in enumerate(rooms):
+            path = f"/devices/{room}/api/system_status"
+            headers = {"If-None-Match": etags[index]} if etags[index] else None
+            etag = recorder.call(transport, "system_status", "GET", path, headers=headers)
+            if etag:
+                etags[index] = etag
+            recorder.call(transport, "esp_control", "GET", f"/devices/{room}/esp/control")
+            if time.monotonic() >= deadline:
+                return
+
+
+def burst_actor(transport, recorder, deadline, devices, burst_size, burst_interval):
+    # Back-to-back control and threshold changes, then a pause
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        for _ in range(burst_size):
+            device_id = random.choice(devices)
+            if random.random() < 0.5:
+                recorder.call(transport, "flet_update", "POST", f"/devices/{device_id}/flet/update", {
+                    "auto_mode": False,
+                    "led_on": random.random() < 0.5,
+                    "servo_angle": random.randint(0, 180)
+                })
+            else:
+                recorder.call(transport, "flet_update_thresholds", "POST",
+                              f"/devices/{device_id}/flet/update_thresholds", {
+                                  "temp_threshold": round(random.uniform(20, 30), 1),
+                                  "light_threshold": random.randint(500, 3500)
+                              })
+        time.sleep(max(0.0, min(deadline, started + burst_interval) - time.monotonic()))
+
+
+def scenario_actors(name, args):
+    """Return (target, extra args) pairs for the threads of one scenario"""
+    devices = device_ids(args.devices)
+    rooms = devices[:max(1, min(args.dashboards, len(devices)))]
+    actors = []
+    if name in ("ingest", "mixed"):
+        # Split the fleet across the ingest threads
+        for k in range(args.concurrency):
+            share = devices[k::args.concurrency]
+            if share:
+                actors.append((ingest_actor, (share,)))
+    if name in ("polling", "mixed"):
+        # M dashboards, each watching one room, multiplexed over the polling threads
+        dashboards = [rooms[i % len(rooms)] for i in range(args.dashboards)]
+        for k in range(args.concurrency):
+            share = dashboards[k::args.concurrency]
+            if share:
+                actors.append((dashboard_actor, (share,)))
+    if name in ("control_burst", "mixed"):
+        actors.append((burst_actor, (devices, args.burst_size, args.burst_interval)))
+    return actors
+
+
+def memory_usage():
+    # Resident set size of this process in MB (Linux), None elsewhere
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return None
+
+
+def run_scenario(name, transport, args):
+    recorder = Recorder()
+    # Warm up: register every device so the scenario measures steady state
+    if name != "ingest":
+        for device_id in device_ids(args.devices):
+            transport.request("POST", f"/devices/{device_id}/esp/update", {"light_level": 0})
+
+    measure = transport.measures_memory
+    rss_before = memory_usage() if measure else None
+    if measure and args.tracemalloc:
+        tracemalloc.start()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=target, args=(transport, recorder, deadline) + extra, daemon=True)
+        for target, extra in scenario_actors(name, args)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    memory = {"rss_before_mb": rss_before, "rss_after_mb": memory_usage()} if measure else None
+    if measure and args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory.update(traced_current_mb=current / 1e6, traced_peak_mb=peak / 1e6)
+
+    routes = {}
+    total = 0
+    for label in sorted(set(recorder.latencies) | set(recorder.shed)):
+        latencies = sorted(recorder.latencies.get(label, []))
+        total += len(latencies)
+        # A route whose every request was shed has no latencies
+        milliseconds = (lambda p: percentile(latencies, p) * 1000) if latencies else (lambda p: None)
+        routes[label] = {
+            "requests": len(latencies),
+            "errors": recorder.errors.get(label, 0),
+            "shed": recorder.shed.get(label, 0),
+            "throughput_rps": len(latencies) / elapsed,
+            "p50_ms": milliseconds(50),
+            "p95_ms": milliseconds(95),
+            "p99_ms": milliseconds(99),
+            "max_ms": milliseconds(100),
+        }
+    return {
+        "duration_s": elapsed,
+        "requests": total,
+        "errors": sum(recorder.errors.values()),
+        "shed": sum(recorder.shed.values()),
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        "routes": routes,
+        "memory": memory,
+    }
+
+
+def compare(results, baseline):
+    """Relative change of throughput and p99 latency against an earlier run"""
+    changes = {}
+    for name, result in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        routes = {}
+        for label, route in result["routes"].items():
+            old = previous["routes"].get(label)
+            if old and old["throughput_rps"] and old["p99_ms"] and route["p99_ms"] is not None:
+                routes[label] = {
+                    "throughput_change": route["throughput_rps"] / old["throughput_rps"] - 1,
+                    "p99_change": route["p99_ms"] / old["p99_ms"] - 1,
+                }
+        changes[name] = {
+            "throughput_change": (result["throughput_rps"] / previous["throughput_rps"] - 1
+                                  if previous["throughput_rps"] else None),
+            "routes": routes,
+        }
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Smart Room Controller backend")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument("--devices", type=int, default=100, help="simulated ESP32 devices")
+    parser.add_argument("--dashboards", type=int, default=20, help="simulated polling dashboards")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads per client kind")
+    parser.add_argument("--burst-size", type=int, default=50, help="app updates per burst")
+    parser.add_argument("--burst-interval", type=float, default=1.0, help="seconds between bursts")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also trace Python allocations (in-process only; slows requests down)")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    transport = HttpTransport(args.url) if args.url else InProcessTransport()
+    results = {
+        "target": args.url or "in-process",
+        "started_at": time.time(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "scenarios": {},
+    }
+    for name in args.scenario or SCENARIOS:
+        results["scenarios"][name] = run_scenario(name, transport, args)
+        print(f"{name}: {results['scenarios'][name]['throughput_rps']:.0f} req/s", file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["comparison"] = compare(results, json.load(f))
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# Compact fixed-layout binary protocol for constrained ESP32 nodes
+import math
+import struct
+
+PROTOCOL_VERSION = 1
+
+# Reading (24 bytes, little-endian): version, device ID (NUL-padded, empty means
+# "the device in the URL"), light level, flags, temperature
+READING = struct.Struct("<B16sHBf")
+
+# Reading flag bits
+READING_MOTION = 1       # PIR sensor detected motion
+READING_HAS_TEMP = 2     # Temperature field holds a valid DHT11 reading
+
+# Control reply (3 bytes): version, flags, servo angle
+CONTROLS = struct.Struct("<BBB")
+
+# Control flag bits
+CONTROL_AUTO_MODE = 1
+CONTROL_LED_ON = 2
+
+BINARY_MIMETYPE = "application/octet-stream"
+
+
+def parse_reading(payload):
+    """Unpack a reading into (device_id or None, light_level, motion_detected, temperature)"""
+    if len(payload) != READING.size:
+        raise ValueError(f"expected {READING.size} bytes, got {len(payload)}")
+    version, raw_id, light_level, flags, temperature = READING.unpack(payload)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"unsupported protocol version {version}")
+    device_id = raw_id.rstrip(b"\0").decode("ascii") or None
+    # A failed DHT11 read is sent without the temperature flag (or as NaN)
+    if not flags & READING_HAS_TEMP or math.isnan(temperature):
+        temperature = None
+    else:
+        # float32 on the wire: keep one decimal, as the DHT11 reports
+        temperature = round(temperature, 1)
+    return device_id, light_level, bool(flags & READING_MOTION), temperature
+
+
+def pack_controls(state):
+    """Pack the control states a device should apply"""
+    flags = ((CONTROL_AUTO_MODE if state["auto_mode"] else 0)
+             | (CONTROL_LED_ON if state["led_on"] else 0))
+    return CONTROLS.pack(PROTOCOL_VERSION, flags, state["servo_angle"])
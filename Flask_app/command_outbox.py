@@ -0,0 +1,48 @@
+# Per-device outbox of control commands waiting to be delivered to the ESP32
+#
+# The outbox is kept in the device state itself (so it also works with the
+# shared-memory registry): one bit per control field with an undelivered
+# change, plus the sequence numbers of the latest command and acknowledgement.
+# Values are read from the state on delivery, so repeated changes to a field
+# coalesce into its latest value.
+
+# Control fields delivered as commands, and their bit in "pending_commands"
+COMMAND_FIELDS = ("auto_mode", "led_on", "servo_angle")
+FIELD_BITS = {field: 1 << bit for bit, field in enumerate(COMMAND_FIELDS)}
+
+# Outbox bookkeeping added to every device state
+OUTBOX_STATE = {
+    "command_seq": 0,        # Sequence number of the latest queued command
+    "acked_seq": 0,          # Latest sequence number acknowledged by the device
+    "pending_commands": 0    # Bit mask of control fields with undelivered changes
+}
+
+
+def enqueue(before, state):
+    """Queue the control fields that changed; the caller holds the device lock"""
+    mask = 0
+    for field in COMMAND_FIELDS:
+        if before[field] != state[field]:
+            mask |= FIELD_BITS[field]
+    if mask:
+        state["pending_commands"] |= mask
+        state["command_seq"] += 1
+
+
+def pending(state, full=False):
+    """Return (sequence number, {field: value}) of the commands to deliver"""
+    mask = state["pending_commands"]
+    # A full sync (device just booted) sends every control field
+    commands = {field: state[field] for field in COMMAND_FIELDS if full or mask & FIELD_BITS[field]}
+    return state["command_seq"], commands
+
+
+def acknowledge(state, seq):
+    """Drop the commands delivered up to seq; later ones stay queued"""
+    if not state["acked_seq"] < seq <= state["command_seq"]:
+        return
+    state["acked_seq"] = seq
+    # Fields aren't tracked per sequence number: anything queued after the
+    # delivery is sent again with its latest value, which is harmless
+    if seq == state["command_seq"]:
+        state["pending_commands"] = 0
@@ -0,0 +1,138 @@
+# Hierarchical configuration: settings set per building, floor, room or device,
+# resolved into the effective values of each device
+import threading
+
+import signal_filters
+
+# Settings that can be configured at any level, with their converters
+SETTINGS = {
+    "temp_threshold": float,
+    "light_threshold": int,
+    "auto_mode": bool,
+    **{key: type(value) for key, value in signal_filters.FILTER_SETTINGS.items()}
+}
+
+
+def scope_key(scope):
+    """Return the key of a scope such as {"building": "A", "floor": 2}"""
+    if not isinstance(scope, dict):
+        raise ValueError("scope must be an object")
+    if scope.get("device_id") is not None:
+        return f"device:{scope['device_id']}"
+    building, floor, room = (scope.get(part) for part in ("building", "floor", "room"))
+    if building is None:
+        raise ValueError("scope needs a device_id or a building")
+    if room is not None:
+        if floor is None:
+            raise ValueError("a room scope needs a floor")
+        return f"room:{building}/{floor}/{room}"
+    if floor is not None:
+        return f"floor:{building}/{floor}"
+    return f"building:{building}"
+
+
+def location_keys(device_id, location):
+    """Keys of every scope covering a device, from the most general to the device itself"""
+    keys = []
+    building, floor, room = location["building"], location["floor"], location["room"]
+    if building is not None:
+        keys.append(f"building:{building}")
+        if floor is not None:
+            keys.append(f"floor:{building}/{floor}")
+            if room is not None:
+                keys.append(f"room:{building}/{floor}/{room}")
+    keys.append(f"device:{device_id}")
+    return keys
+
+
+def validate_values(values):
+    """Return the settings in values converted and range-checked (None clears a setting)"""
+    if not isinstance(values, dict):
+        raise ValueError("values must be an object")
+    unknown = sorted(set(values) - set(SETTINGS))
+    if unknown:
+        raise ValueError(f"unknown settings: {', '.join(unknown)}")
+    present = {key: value for key, value in values.items() if value is not None}
+    updates = signal_filters.validate_settings(present)
+    for key in ("temp_threshold", "light_threshold", "auto_mode"):
+        if key in present:
+            updates[key] = SETTINGS[key](present[key])
+    updates.update((key, None) for key, value in values.items() if value is None)
+    return updates
+
+
+class ConfigTree:
+    """Settings per scope, with the resolved values of each device cached until a change"""
+
+    def __init__(self, defaults=None):
+        self.defaults = dict(defaults or {})  # Values of settings no scope sets
+        self._lock = threading.Lock()
+        self._entries = {}  # scope key -> {"scope": ..., "values": ...}
+        self._resolved = {}  # device_id -> effective settings
+        self.generation = 0
+
+    def entries(self):
+        with self._lock:
+            return dict(self._entries)
+
+    def update(self, changes):
+        """Apply [(scope, values or None)] together and return the updated entries by key"""
+        # Check every scope before changing anything
+        keyed = [(scope_key(scope), scope, values) for scope, values in changes]
+        with self._lock:
+            updated = {}
+            for key, scope, values in keyed:
+                entry = self._entries.get(key)
+                merged = dict(entry["values"]) if entry is not None and values is not None else {}
+                for name, value in (values or {}).items():
+                    if value is None:
+                        merged.pop(name, None)
+                    else:
+                        merged[name] = value
+                if merged:
+                    if key.startswith("device:"):
+                        scope = {"device_id": scope["device_id"]}
+                    else:
+                        scope = {part: scope[part] for part in ("building", "floor", "room")
+                                 if scope.get(part) is not None}
+                    self._entries[key] = updated[key] = {"scope": scope, "values": merged}
+                else:
+                    # Nothing left at this scope
+                    self._entries.pop(key, None)
+                    updated[key] = None
+            self._changed()
+            return updated
+
+    def load(self, entries):
+        """Replace every entry, e.g. with the configuration shared by another worker"""
+        with self._lock:
+            self._entries = {key: entry for key, entry in entries.items() if entry is not None}
+            self._changed()
+
+    def invalidate(self, device_id):
+        """Drop the cached values of a device whose location changed"""
+        with self._lock:
+            self._resolved.pop(device_id, None)
+
+    def _changed(self):
+        # Caller holds the lock
+        self.generation += 1
+        self._resolved.clear()
+
+    def resolve(self, device_id, location):
+        """Effective settings of a device: the defaults and every level covering it, most specific last"""
+        with self._lock:
+            values = self._resolved.get(device_id)
+            if values is None:
+                values = dict(self.defaults)
+                for key in location_keys(device_id, location):
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        values.update(entry["values"])
+                self._resolved[device_id] = values
+            return values
+
+    def layers(self, device_id, location):
+        """The entries covering a device, from the most general to the device itself"""
+        with self._lock:
+            return [self._entries[key] for key in location_keys(device_id, location) if key in self._entries]
@@ -0,0 +1,105 @@
+# Device registry: keeps the state of every ESP32 room keyed by device ID
+import json
+import threading
+import zlib
+from contextlib import contextmanager
+
+# Device ID used by the original single-room endpoints
+DEFAULT_DEVICE_ID = "default"
+
+# Number of lock stripes (devices hashing to different stripes never contend)
+DEFAULT_STRIPES = 64
+
+
+class DeviceRegistry:
+    """Sharded store of per-device state dictionaries with striped locking"""
+
+    def __init__(self, template, stripes=DEFAULT_STRIPES):
+        # Template copied into every newly seen device
+        self._template = dict(template)
+        self._stripes = stripes
+        # One dictionary and one lock per stripe
+        self._shards = [{} for _ in range(stripes)]
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # Conditions on the stripe locks wake long-polls when a device changes
+        self._changed = [threading.Condition(lock) for lock in self._locks]
+        # Per-stripe state versions and (version, JSON bytes) caches
+        self._versions = [{} for _ in range(stripes)]
+        self._json_cache = [{} for _ in range(stripes)]
+        self._template_json = json.dumps(self._template).encode("utf-8")
+
+    def _stripe(self, device_id):
+        # crc32 is stable across processes, unlike the built-in hash()
+        return zlib.crc32(device_id.encode("utf-8")) % self._stripes
+
+    @contextmanager
+    def locked(self, device_id):
+        """Yield the mutable state of a device while holding its stripe lock"""
+        index = self._stripe(device_id)
+        with self._locks[index]:
+            shard = self._shards[index]
+            state = shard.get(device_id)
+            if state is None:
+                # First time this device is seen: start from the template
+                state = shard[device_id] = dict(self._template)
+            yield state
+
+    def snapshot(self, device_id):
+        """Return a copy of the current state of a device"""
+        index = self._stripe(device_id)
+        with self._locks[index]:
+            # Unknown devices read as the template without being registered
+            return dict(self._shards[index].get(device_id, self._template))
+
+    def mark_changed(self, device_id):
+        """Bump the version of a device; the caller must hold its lock"""
+        index = self._stripe(device_id)
+        versions = self._versions[index]
+        versions[device_id] = versions.get(device_id, 0) + 1
+        self._changed[index].notify_all()
+
+    def version(self, device_id):
+        """Return the current state version of a device (0 if never changed)"""
+        index = self._stripe(device_id)
+        with self._locks[index]:
+            return self._versions[index].get(device_id, 0)
+
+    def versioned_json(self, device_id):
+        """Return (version, serialized state), serializing at most once per version"""
+        index = self._stripe(device_id)
+        with self._locks[index]:
+            version = self._versions[index].get(device_id, 0)
+            cached = self._json_cache[index].get(device_id)
+            if cached is not None and cached[0] == version:
+                return cached
+            state = self._shards[index].get(device_id)
+            if state is None:
+                return version, self._template_json
+            cached = self._json_cache[index][device_id] = (version, json.dumps(state).encode("utf-8"))
+            return cached
+
+    def wait_for_change(self, device_id, since, timeout):
+        """Block until the device version differs from `since` or the timeout passes"""
+        index = self._stripe(device_id)
+        versions = self._versions[index]
+        with self._changed[index]:
+            return self._changed[index].wait_for(
+                lambda: versions.get(device_id, 0) != since, timeout
+            )
+
+    def exists(self, device_id):
+        """Check whether a device has been registered"""
+        index = self._stripe(device_id)
+        with self._locks[index]:
+            return device_id in self._shards[index]
+
+    def device_ids(self):
+        """Return the IDs of all registered devices"""
+        ids = []
+        for lock, shard in zip(self._locks, self._shards):
+            with lock:
+                ids.extend(shard)
+        return ids
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
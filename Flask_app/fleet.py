@@ -0,0 +1,154 @@
+# Columnar (NumPy) copy of the latest state of every device for fleet-wide analytics
+import threading
+import time
+
+import numpy as np
+
+# Rows allocated up front; columns double when they fill up
+INITIAL_ROWS = 1024
+
+# Label used for devices without a location
+UNASSIGNED = "unassigned"
+
+# Columns and their dtypes
+COLUMNS = {
+    "temperature": np.float64,
+    "light_level": np.float64,
+    "light_threshold": np.float64,
+    "motion_detected": np.bool_,
+    "led_on": np.bool_,
+    "servo_angle": np.int16,
+    "auto_mode": np.bool_,
+    "updated_at": np.float64,
+    "building": np.int32,   # Code into the building labels
+    "floor": np.int32,      # Code into the floor labels ("building/floor")
+}
+
+
+class FleetColumns:
+    """One row per device, one NumPy array per field"""
+
+    def __init__(self, rows=INITIAL_ROWS):
+        self._lock = threading.Lock()
+        self._rows = {}        # device_id -> row
+        self._device_ids = []  # row -> device_id
+        self._columns = {name: np.zeros(rows, dtype=dtype) for name, dtype in COLUMNS.items()}
+        # Label tables for the location columns (code 0 is "unassigned")
+        self._labels = {"building": [UNASSIGNED], "floor": [UNASSIGNED]}
+        self._codes = {"building": {UNASSIGNED: 0}, "floor": {UNASSIGNED: 0}}
+        self._locations = {}   # device_id -> {"building", "floor", "room"}
+
+    def _row(self, device_id):
+        # Caller holds the lock
+        row = self._rows.get(device_id)
+        if row is None:
+            row = self._rows[device_id] = len(self._device_ids)
+            self._device_ids.append(device_id)
+            capacity = len(self._columns["temperature"])
+            if row >= capacity:
+                for name, column in self._columns.items():
+                    grown = np.zeros(capacity * 2, dtype=column.dtype)
+                    grown[:capacity] = column
+                    self._columns[name] = grown
+        return row
+
+    def _code(self, kind, label):
+        codes = self._codes[kind]
+        if label not in codes:
+            codes[label] = len(self._labels[kind])
+            self._labels[kind].append(label)
+        return codes[label]
+
+    def update(self, device_id, state):
+        """Copy the latest state of a device into its row"""
+        with self._lock:
+            row = self._row(device_id)
+            columns = self._columns
+            columns["temperature"][row] = state["temperature"]
+            columns["light_level"][row] = state["light_level"]
+            columns["light_threshold"][row] = state["light_threshold"]
+            columns["motion_detected"][row] = state["motion_detected"]
+            columns["led_on"][row] = state["led_on"]
+            columns["servo_angle"][row] = state["servo_angle"]
+            columns["auto_mode"][row] = state["auto_mode"]
+            columns["updated_at"][row] = time.time()
+
+    def load(self, device_ids, columns):
+        """Overwrite the state columns from per-device arrays kept elsewhere (shared memory)"""
+        with self._lock:
+            rows = np.fromiter((self._row(d) for d in device_ids), dtype=np.int64, count=len(device_ids))
+            for name in COLUMNS:
+                if name in columns:
+                    self._columns[name][rows] = columns[name]
+
+    def set_location(self, device_id, building=None, floor=None, room=None):
+        """Assign a device to a building, floor and room"""
+        with self._lock:
+            row = self._row(device_id)
+            building_label = str(building) if building is not None else UNASSIGNED
+            floor_label = f"{building_label}/{floor}" if floor is not None else UNASSIGNED
+            self._columns["building"][row] = self._code("building", building_label)
+            self._columns["floor"][row] = self._code("floor", floor_label)
+            self._locations[device_id] = {"building": building, "floor": floor, "room": room}
+
+    def location(self, device_id):
+        return self._locations.get(device_id, {"building": None, "floor": None, "room": None})
+
+    def locations(self):
+        """Location of every device that has one"""
+        with self._lock:
+            return dict(self._locations)
+
+    def summary(self, group_by="floor", percentiles=(50, 90, 99), max_age=None):
+        """Fleet-wide and per-group aggregates computed with vectorized operations"""
+        if group_by not in self._labels:
+            raise ValueError(f"cannot group by {group_by!r}")
+        with self._lock:
+            count = len(self._device_ids)
+            # Copy the used rows so aggregation runs without holding the lock
+            columns = {name: column[:count].copy() for name, column in self._columns.items()}
+            device_ids = np.array(self._device_ids, dtype=object)
+            labels = list(self._labels[group_by])
+
+        # Only devices that reported recently (and have reported at all)
+        mask = columns["updated_at"] > 0
+        if max_age is not None:
+            mask &= columns["updated_at"] >= time.time() - max_age
+        temperature = columns["temperature"][mask]
+        motion = columns["motion_detected"][mask]
+        # LED on although the room is brighter than its light threshold
+        daylight_led = (columns["led_on"] & (columns["light_level"] >= columns["light_threshold"]))[mask]
+        codes = columns[group_by][mask]
+        ids = device_ids[mask]
+
+        def aggregate(temps, motions, wasted):
+            n = len(temps)
+            return {
+                "devices": int(n),
+                "temperature_mean": float(temps.mean()) if n else None,
+                "temperature_percentiles": (
+                    {f"{p:g}": float(v) for p, v in zip(percentiles, np.percentile(temps, percentiles))}
+                    if n else {}
+                ),
+                "motion_share": float(motions.mean()) if n else None,
+                "led_on_in_daylight": int(wasted.sum()),
+            }
+
+        result = aggregate(temperature, motion, daylight_led)
+        result["led_on_in_daylight_devices"] = sorted(ids[daylight_led].tolist())
+
+        # Group rows by sorting on the group code once, then slice each group
+        groups = {}
+        if len(codes):
+            order = np.argsort(codes, kind="stable")
+            sorted_codes = codes[order]
+            starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+            ends = np.r_[starts[1:], len(sorted_codes)]
+            for start, end in zip(starts, ends):
+                rows = order[start:end]
+                groups[labels[sorted_codes[start]]] = aggregate(
+                    temperature[rows], motion[rows], daylight_led[rows]
+                )
+        result["group_by"] = group_by
+        result["groups"] = groups
+        return result
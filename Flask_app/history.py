@@ -0,0 +1,314 @@
+# Sensor history: in-memory ring buffers, or answered from the reading log
+# when several worker processes serve the same devices
+import bisect
+import threading
+from array import array
+
+import numpy as np
+
+import reading_log as rlog
+
+# Sensors recorded for every device
+SENSORS = ("light_level", "motion_detected", "temperature")
+
+# One day of samples at the ESP32's 2-second reporting interval
+DEFAULT_CAPACITY = 43200
+
+# Total memory available for all series (timestamps and values)
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Samples allocated when a series is created; storage doubles up to the capacity
+INITIAL_ALLOCATION = 16
+
+# Trimming frees space down to this share of the budget, so it runs rarely
+EVICTION_TARGET = 0.9
+
+# Upper limit on buckets returned by a single query
+MAX_BUCKETS = 10000
+
+
+def check_query(sensor, start, end, resolution):
+    if sensor not in SENSORS:
+        raise ValueError(f"unknown sensor: {sensor}")
+    if resolution <= 0:
+        raise ValueError("resolution must be positive")
+    if (end - start) / resolution > MAX_BUCKETS:
+        raise ValueError(f"too many buckets (max {MAX_BUCKETS})")
+
+
+class RingSeries:
+    """Bounded series of (timestamp, value) samples in two float arrays"""
+
+    def __init__(self, capacity, on_grow=None):
+        self.capacity = capacity
+        # Storage starts small and doubles until it reaches the capacity
+        size = min(INITIAL_ALLOCATION, capacity)
+        self.times = array("d", bytes(8 * size))
+        self.values = array("d", bytes(8 * size))
+        self.head = 0    # Physical index of the next write
+        self.count = 0   # Number of valid samples
+        self.lock = threading.Lock()
+        # Called (without the lock) with the number of bytes added whenever the storage grows
+        self._on_grow = on_grow
+
+    def nbytes(self):
+        return 16 * len(self.times)
+
+    def append(self, timestamp, value):
+        with self.lock:
+            grown = self._append(timestamp, value)
+        # The owner may trim other series in turn, so it is told after the lock is released
+        if grown and self._on_grow is not None:
+            self._on_grow(grown)
+
+    def _append(self, timestamp, value):
+        # Caller holds the lock; returns the bytes the storage grew by
+        size = len(self.times)
+        extra = 0
+        if self.count == size < self.capacity:
+            # Full but never wrapped past the oldest sample: samples sit in order
+            # at 0..size-1 (head has wrapped to 0), so extend and continue at the end
+            extra = min(size, self.capacity - size)
+            self.times.frombytes(bytes(8 * extra))
+            self.values.frombytes(bytes(8 * extra))
+            self.head = size
+            size += extra
+        # Keep timestamps sorted so queries can binary search
+        if self.count and timestamp < self.last_time():
+            self._insert(timestamp, value)
+            return 16 * extra
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % size
+        if self.count < size:
+            self.count += 1
+        return 16 * extra
+
+    def _ordered(self, storage):
+        # Copy of the valid samples of one array, oldest first
+        ordered = array("d")
+        for a, b in self._segments(0, self.count):
+            ordered.extend(storage[a:b])
+        return ordered
+
+    def _insert(self, timestamp, value):
+        # Caller holds the lock: a backdated sample is put in its place in time
+        # by rebuilding the arrays in order, O(n) but only for late readings
+        size = len(self.times)
+        times, values = self._ordered(self.times), self._ordered(self.values)
+        position = bisect.bisect_right(times, timestamp)
+        times.insert(position, timestamp)
+        values.insert(position, value)
+        if len(times) > size:
+            # Full: the oldest sample gives way
+            del times[0]
+            del values[0]
+        self.count = len(times)
+        self.head = self.count % size
+        times.frombytes(bytes(8 * (size - self.count)))
+        values.frombytes(bytes(8 * (size - self.count)))
+        self.times, self.values = times, values
+
+    def load(self, times, values):
+        """Replace the samples with float64 buffers sorted by time; return the bytes added"""
+        with self.lock:
+            old = self.nbytes()
+            self._fill(times, values)
+            return self.nbytes() - old
+
+    def shrink(self, capacity):
+        """Lower the capacity, dropping the oldest samples beyond it; return the bytes freed"""
+        with self.lock:
+            old = self.nbytes()
+            self.capacity = min(self.capacity, capacity)
+            if len(self.times) > self.capacity:
+                self._fill(self._ordered(self.times), self._ordered(self.values))
+            return old - self.nbytes()
+
+    def _fill(self, times, values):
+        # Caller holds the lock; keep the newest samples, with room left for more when not full
+        count = min(len(times), self.capacity)
+        size = min(self.capacity, max(INITIAL_ALLOCATION, count))
+        for name, source in (("times", times), ("values", values)):
+            storage = array("d")
+            storage.frombytes(memoryview(source[len(source) - count:]).cast("B"))
+            storage.frombytes(bytes(8 * (size - count)))
+            setattr(self, name, storage)
+        self.count = count
+        self.head = count % size
+
+    def last_time(self):
+        if not self.count:
+            return 0.0
+        return self.times[(self.head - 1) % len(self.times)]
+
+    def _physical(self, logical):
+        # Logical index 0 is the oldest sample
+        return (self.head - self.count + logical) % len(self.times)
+
+    def _bisect(self, timestamp):
+        # First logical index whose timestamp is >= the given timestamp
+        lo, hi = 0, self.count
+        times = self.times
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[self._physical(mid)] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _segments(self, lo, hi):
+        # Split a logical range into at most two contiguous physical slices
+        if lo >= hi:
+            return []
+        size = len(self.times)
+        start = self._physical(lo)
+        length = hi - lo
+        if start + length <= size:
+            return [(start, start + length)]
+        return [(start, size), (0, start + length - size)]
+
+    def buckets(self, start, end, resolution):
+        """Return (bucket_start, min, max, mean, count) for each non-empty bucket"""
+        result = []
+        with self.lock:
+            # The view is released before the lock, so the array can still grow later
+            values = memoryview(self.values)
+            lo = self._bisect(start)
+            bucket_start = start
+            while bucket_start < end and lo < self.count:
+                bucket_end = min(bucket_start + resolution, end)
+                hi = self._bisect(bucket_end)
+                if hi > lo:
+                    # Aggregate directly over zero-copy slices of the value array
+                    low = high = None
+                    total = 0.0
+                    for a, b in self._segments(lo, hi):
+                        view = values[a:b]
+                        seg_min, seg_max = min(view), max(view)
+                        low = seg_min if low is None else min(low, seg_min)
+                        high = seg_max if high is None else max(high, seg_max)
+                        total += sum(view)
+                    result.append((bucket_start, low, high, total / (hi - lo), hi - lo))
+                lo = hi
+                bucket_start += resolution
+            values.release()
+        return result
+
+
+class SensorHistory:
+    """Per-device, per-sensor ring buffers kept within a fixed memory budget"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.capacity = capacity
+        self.memory_budget = memory_budget
+        # Samples each series may keep: lowered as series are added, so the
+        # budget is shared evenly by every device sensor
+        self.series_capacity = capacity
+        self._series = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def memory_used(self):
+        """Return the bytes allocated by all series"""
+        return self._bytes
+
+    def _allocated(self, nbytes):
+        # Track allocations and trim the series once the budget is exceeded
+        with self._lock:
+            self._bytes += nbytes
+            if self._bytes <= self.memory_budget:
+                return
+            # Give every series an even share of the budget, dropping the oldest
+            # samples of those holding more
+            target = self.memory_budget * EVICTION_TARGET
+            share = int(target // (16 * len(self._series)))
+            self.series_capacity = min(self.capacity, max(INITIAL_ALLOCATION, share))
+            for series in self._series.values():
+                self._bytes -= series.shrink(self.series_capacity)
+            # Too many series for even the smallest share: evict those updated least recently
+            if self._bytes <= self.memory_budget:
+                return
+            for key in sorted(self._series, key=lambda k: self._series[k].last_time()):
+                if self._bytes <= target or len(self._series) <= 1:
+                    break
+                self._bytes -= self._series.pop(key).nbytes()
+
+    def _get_series(self, device_id, sensor):
+        key = (device_id, sensor)
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = RingSeries(self.series_capacity, self._allocated)
+            self._allocated(series.nbytes())
+        return series
+
+    def record(self, device_id, timestamp, light_level=None, motion_detected=None, temperature=None):
+        """Append every sensor value present in a reading"""
+        if light_level is not None:
+            self._get_series(device_id, "light_level").append(timestamp, float(light_level))
+        if motion_detected is not None:
+            self._get_series(device_id, "motion_detected").append(timestamp, float(motion_detected))
+        if temperature is not None:
+            self._get_series(device_id, "temperature").append(timestamp, float(temperature))
+
+    def load(self, device_id, sensor, times, values):
+        """Fill one device sensor at once, e.g. with the readings rebuilt from the log"""
+        series = self._get_series(device_id, sensor)
+        self._allocated(series.load(times, values))
+
+    def query(self, device_id, sensor, start, end, resolution):
+        """Return min/max/mean buckets for one device sensor over a time range"""
+        check_query(sensor, start, end, resolution)
+        series = self._series.get((device_id, sensor))
+        if series is None:
+            return []
+        return series.buckets(start, end, resolution)
+
+
+class LogHistory:
+    """SensorHistory interface answered from the reading log, so every worker
+    process sharing the log gives the same answer"""
+
+    # Sensor -> flag of the readings that carried it
+    PRESENT_FLAGS = {
+        "light_level": rlog.FLAG_HAS_LIGHT,
+        "motion_detected": rlog.FLAG_HAS_MOTION,
+        "temperature": rlog.FLAG_HAS_TEMPERATURE,
+    }
+
+    def __init__(self, log):
+        self.log = log
+
+    def record(self, device_id, timestamp, light_level=None, motion_detected=None, temperature=None):
+        # Every reading is already appended to the log
+        pass
+
+    def load(self, device_id, sensor, times, values):
+        pass
+
+    def query(self, device_id, sensor, start, end, resolution):
+        """Return min/max/mean buckets for one device sensor over a time range"""
+        check_query(sensor, start, end, resolution)
+        readings = self.log.device_readings(device_id, start, end)
+        readings = readings[(readings["flags"] & self.PRESENT_FLAGS[sensor]) != 0]
+        if not len(readings):
+            return []
+        if sensor == "motion_detected":
+            values = ((readings["flags"] & rlog.FLAG_MOTION) != 0).astype(np.float64)
+        else:
+            values = readings[sensor].astype(np.float64)
+        # Samples are sorted by time, so each bucket is one contiguous run
+        buckets = ((readings["timestamp"] - start) // resolution).astype(np.int64)
+        firsts = np.r_[0, np.flatnonzero(np.diff(buckets)) + 1]
+        counts = np.diff(np.r_[firsts, len(values)])
+        return list(zip(
+            (start + buckets[firsts] * resolution).tolist(),
+            np.minimum.reduceat(values, firsts).tolist(),
+            np.maximum.reduceat(values, firsts).tolist(),
+            (np.add.reduceat(values, firsts) / counts).tolist(),
+            counts.tolist(),
+        ))
@@ -0,0 +1,99 @@
+# Push-based live updates: per-device subscriptions receiving coalesced state diffs
+import json
+import threading
+import time
+
+# Seconds between keep-alive comments on idle streams
+KEEPALIVE_INTERVAL = 15
+
+# How often streams check for changes made by other worker processes (seconds)
+SHARED_POLL_INTERVAL = 0.25
+
+
+class Subscription:
+    """Pending changes for one client, merged until the client reads them"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = {}
+
+    def push(self, changes):
+        with self._cond:
+            # A slow client only ever holds the latest value of each field
+            self._pending.update(changes)
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """Return the changes accumulated since the last call (empty on timeout)"""
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+            changes, self._pending = self._pending, {}
+            return changes
+
+
+class StateBroadcaster:
+    """Fan-out of per-device state changes to live subscribers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # device_id -> tuple of subscriptions, replaced on every (un)subscribe
+        self._subscribers = {}
+
+    def subscribe(self, device_id):
+        subscription = Subscription()
+        with self._lock:
+            self._subscribers[device_id] = self._subscribers.get(device_id, ()) + (subscription,)
+        return subscription
+
+    def unsubscribe(self, device_id, subscription):
+        with self._lock:
+            remaining = tuple(s for s in self._subscribers.get(device_id, ()) if s is not subscription)
+            if remaining:
+                self._subscribers[device_id] = remaining
+            else:
+                self._subscribers.pop(device_id, None)
+
+    def publish(self, device_id, changes):
+        # Lock-free read: the tuple is never mutated in place
+        for subscription in self._subscribers.get(device_id, ()):
+            subscription.push(changes)
+
+    def subscriber_count(self):
+        return sum(len(subs) for subs in self._subscribers.values())
+
+    def stream(self, device_id, snapshot, version=None):
+        """Yield Server-Sent Events: the full state first, then every change
+
+        With version(device_id) given (multi-process servers), changes made by
+        other processes are found by comparing versions and diffing snapshots.
+        """
+        subscription = self.subscribe(device_id)
+        try:
+            # Subscribe before reading the snapshot so no change is missed
+            seen = version(device_id) if version else None
+            current = snapshot()
+            yield f"data: {json.dumps(current)}\n\n"
+            last_sent = time.monotonic()
+            while True:
+                if version is None:
+                    changes = subscription.wait(KEEPALIVE_INTERVAL)
+                else:
+                    # Local pushes still wake the stream at once
+                    subscription.wait(SHARED_POLL_INTERVAL)
+                    changes = {}
+                    latest = version(device_id)
+                    if latest != seen:
+                        seen = latest
+                        state = snapshot()
+                        changes = {key: value for key, value in state.items() if current.get(key) != value}
+                        current = state
+                if changes:
+                    yield f"data: {json.dumps(changes)}\n\n"
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= KEEPALIVE_INTERVAL:
+                    # Comment line keeps proxies from closing the idle connection
+                    yield ": keepalive\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            self.unsubscribe(device_id, subscription)
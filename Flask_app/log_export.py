@@ -0,0 +1,104 @@
+# Streaming export of the reading log as CSV or NDJSON, one generator stage at a time
+import csv
+import io
+import json
+
+import reading_log as rlog
+
+# Event names of the record kinds
+KIND_NAMES = {
+    rlog.KIND_READING: "reading",
+    rlog.KIND_CONTROLS: "controls",
+    rlog.KIND_THRESHOLDS: "thresholds",
+    rlog.KIND_SNAPSHOT: "snapshot",
+}
+
+# Exported columns, in CSV order
+COLUMNS = ("timestamp", "device_id", "event", "light_level", "motion_detected", "temperature",
+           "led_on", "servo_angle", "auto_mode", "light_threshold", "temp_threshold")
+
+FORMATS = ("csv", "ndjson")
+
+# Lines are sent in chunks of about this many bytes
+CHUNK_BYTES = 64 * 1024
+
+
+def event_kinds(names):
+    """Record kinds of a list of event names"""
+    kinds = {name: kind for kind, name in KIND_NAMES.items()}
+    unknown = [name for name in names if name not in kinds]
+    if unknown:
+        raise ValueError(f"unknown events: {', '.join(unknown)}")
+    return {kinds[name] for name in names}
+
+
+def select_records(log, device_ids=None, start=None, end=None, kinds=None):
+    """Yield the log records of some devices, events and time range, oldest segment first"""
+    wanted = {d.encode("utf-8").ljust(32, b"\0") for d in device_ids} if device_ids else None
+    log.flush()
+    for index in log.segment_indexes():
+        try:
+            # Segments are only roughly in time order, so every one of them is checked
+            for record in log.iter_segment(index, start, end):
+                if wanted is not None and record[1] not in wanted:
+                    continue
+                if kinds is not None and record[2] not in kinds:
+                    continue
+                yield record
+        except FileNotFoundError:
+            # Folded into the next segment by compaction since it was listed
+            continue
+
+
+def to_rows(records):
+    """Turn records into tuples of the exported columns"""
+    for timestamp, raw_id, kind, flags, servo_angle, light_level, light_threshold, temperature, \
+            temp_threshold in records:
+        yield (timestamp, raw_id.rstrip(b"\0").decode("utf-8"), KIND_NAMES.get(kind, str(kind)),
+               light_level, bool(flags & rlog.FLAG_MOTION), temperature, bool(flags & rlog.FLAG_LED_ON),
+               servo_angle, bool(flags & rlog.FLAG_AUTO_MODE), light_threshold, temp_threshold)
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    while True:
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        row = next(rows, None)
+        if row is None:
+            return
+        writer.writerow(row)
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMNS, row))) + "\n"
+
+
+def chunked(lines, size=CHUNK_BYTES):
+    """Join lines into chunks of about size bytes; the first line is sent at once"""
+    pending = []
+    pending_bytes = 0
+    first = True
+    for line in lines:
+        pending.append(line)
+        pending_bytes += len(line)
+        if first or pending_bytes >= size:
+            yield "".join(pending).encode("utf-8")
+            pending = []
+            pending_bytes = 0
+            first = False
+    if pending:
+        yield "".join(pending).encode("utf-8")
+
+
+def export(log, fmt="ndjson", device_ids=None, start=None, end=None, kinds=None):
+    """Return an iterator of encoded chunks covering the selected records"""
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    rows = to_rows(select_records(log, device_ids, start, end, kinds))
+    lines = csv_lines(rows) if fmt == "csv" else ndjson_lines(rows)
+    return chunked(lines)
@@ -0,0 +1,396 @@
+# Durable append-only log of readings and control changes, replayed through mmap
+import atexit
+import contextlib
+import logging
+import math
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+# Record kinds
+KIND_READING = 1      # Sensor reading from /esp/update
+KIND_CONTROLS = 2     # Mode/LED/servo change from /flet/update
+KIND_THRESHOLDS = 3   # Threshold change from /flet/update_thresholds
+KIND_SNAPSHOT = 4     # Latest state of a device written by compaction
+
+# Flag bits: boolean state fields and which sensors a reading carried
+FLAG_MOTION = 1
+FLAG_LED_ON = 2
+FLAG_AUTO_MODE = 4
+FLAG_HAS_LIGHT = 8
+FLAG_HAS_MOTION = 16
+FLAG_HAS_TEMPERATURE = 32
+
+# Fixed record layout: timestamp, device ID, kind, flags, servo angle,
+# light level, light threshold, temperature, temperature threshold
+RECORD = struct.Struct("<d32sBBhiidd")
+
+# The same layout as a NumPy dtype, for reading segments as memory-mapped arrays
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"), ("device_id", "S32"), ("kind", "u1"), ("flags", "u1"),
+    ("servo_angle", "<i2"), ("light_level", "<i4"), ("light_threshold", "<i4"),
+    ("temperature", "<f8"), ("temp_threshold", "<f8"),
+])
+assert RECORD_DTYPE.itemsize == RECORD.size
+
+# Default segment size and number of segments kept on disk
+DEFAULT_SEGMENT_RECORDS = 1_000_000
+DEFAULT_MAX_SEGMENTS = 8
+
+# How often buffered records are flushed to the operating system (seconds),
+# and how many bytes may be buffered before flushing early
+FLUSH_INTERVAL = 0.5
+MAX_PENDING_BYTES = 64 * 1024
+
+# Records unpacked at a time when iterating over a segment
+UNPACK_BLOCK = 4096
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+
+
+def pack_record(timestamp, device_id, kind, state, present=0):
+    """Pack the state of a device after a change into one fixed-size record"""
+    flags = present
+    if state["motion_detected"]:
+        flags |= FLAG_MOTION
+    if state["led_on"]:
+        flags |= FLAG_LED_ON
+    if state["auto_mode"]:
+        flags |= FLAG_AUTO_MODE
+    return RECORD.pack(
+        timestamp, device_id.encode("utf-8"), kind, flags,
+        int(state["servo_angle"]), int(state["light_level"]), int(state["light_threshold"]),
+        float(state["temperature"]), float(state["temp_threshold"])
+    )
+
+
+def record_state(record):
+    """Rebuild a device state dictionary from an unpacked record"""
+    _, _, _, flags, servo_angle, light_level, light_threshold, temperature, temp_threshold = record
+    return {
+        "light_level": light_level,
+        "motion_detected": bool(flags & FLAG_MOTION),
+        "temperature": temperature,
+        "led_on": bool(flags & FLAG_LED_ON),
+        "servo_angle": servo_angle,
+        "auto_mode": bool(flags & FLAG_AUTO_MODE),
+        "temp_threshold": temp_threshold,
+        "light_threshold": light_threshold
+    }
+
+
+def record_device_id(record):
+    # Device IDs are NUL-padded to 32 bytes
+    return record[1].rstrip(b"\0").decode("utf-8")
+
+
+def device_keys(records):
+    """Padded device IDs of a record array as big-endian words, most significant first"""
+    # Words compare like the bytes, but much faster; words no device ID reaches
+    # (short IDs leave the last ones zero) are left out
+    words = np.ascontiguousarray(records["device_id"]).view(">u8").reshape(-1, 4)
+    return [words[:, k] for k in range(4) if k == 0 or words[:, k].any()]
+
+
+def device_order(keys, *minor_keys):
+    """Indexes sorting records by device, then by minor_keys; ties keep append order"""
+    return np.lexsort((*minor_keys, *reversed(keys)))
+
+
+def device_ends(keys, order):
+    """Positions in order where each device's run ends"""
+    if not len(order):
+        return np.zeros(0, dtype=np.intp)
+    changes = np.zeros(len(order) - 1, dtype=bool)
+    for key in keys:
+        sorted_key = key[order]
+        changes |= sorted_key[1:] != sorted_key[:-1]
+    return np.r_[np.flatnonzero(changes), len(order) - 1]
+
+
+def take_records(records, indexes):
+    """records[indexes] for a contiguous record array, copied as raw rows (several times faster)"""
+    rows = records.view(np.uint8).reshape(-1, RECORD.size)
+    return np.take(rows, indexes, axis=0).view(RECORD_DTYPE).reshape(-1)
+
+
+def newest_per_device(records, keys=None, order=None):
+    """The last record of every device in a record array, in append order"""
+    # Record times come from clients and may run ahead of the clock, so a later
+    # append wins even over a record with a newer timestamp
+    if order is None:
+        keys = device_keys(records)
+        order = device_order(keys)
+    return take_records(records, np.sort(order[device_ends(keys, order)]))
+
+
+def unpack_records(records):
+    """Unpack a record array into record tuples"""
+    return RECORD.iter_unpack(records.tobytes())
+
+
+class ReadingLog:
+    """Segmented fixed-record log with rotation and compaction"""
+
+    def __init__(self, directory, segment_records=DEFAULT_SEGMENT_RECORDS,
+                 max_segments=DEFAULT_MAX_SEGMENTS, process_lock=None):
+        self.directory = directory
+        self.segment_bytes = segment_records * RECORD.size
+        self.max_segments = max(2, max_segments)
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Held while touching segment files when several processes share the log
+        self._shared = process_lock is not None
+        self._process_lock = process_lock if self._shared else contextlib.nullcontext()
+        # Replay keeps the last record of each device in append order, so records of
+        # a shared log are written as they come rather than buffered per process
+        self._write_through = self._shared
+        self._fd = None
+        self._pending = bytearray()
+        self._active_index = 0
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._bounds = {}  # segment index -> ((size, mtime), (earliest, latest timestamp))
+
+    # ----- segment files -----
+
+    def segment_path(self, index):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{index:08d}{SEGMENT_SUFFIX}")
+
+    def segment_indexes(self):
+        """Return the indexes of all segments on disk, oldest first"""
+        indexes = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                indexes.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(indexes)
+
+    def _open_active(self, index):
+        # Caller holds the process lock; O_APPEND keeps concurrent appenders from overlapping
+        fd = os.open(self.segment_path(index), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # Drop a partially written trailing record left by a crash
+        size = os.fstat(fd).st_size
+        if size % RECORD.size:
+            os.ftruncate(fd, size - size % RECORD.size)
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = fd
+        self._active_index = index
+
+    def open(self):
+        """Open the newest segment for appending and start the background flusher"""
+        with self._process_lock:
+            indexes = self.segment_indexes()
+            self._open_active(indexes[-1] if indexes else 1)
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            if self._fd is not None:
+                self._flush_pending()
+                os.close(self._fd)
+                self._fd = None
+
+    # ----- writing -----
+
+    def append(self, device_id, kind, state, present=0, timestamp=None):
+        """Append the state of a device after a change"""
+        with self._lock:
+            if self._fd is None:
+                return
+            # Records keep their real times: backdated readings and worker processes
+            # flushing in turn leave segments only roughly in time order
+            timestamp = timestamp or time.time()
+            self._pending += pack_record(timestamp, device_id, kind, state, present)
+            if self._write_through:
+                try:
+                    self._flush_pending()
+                except OSError:
+                    # As in the background flusher: the record is lost, the change stands
+                    logger.exception("reading log write failed")
+            elif len(self._pending) >= MAX_PENDING_BYTES:
+                self._flush_pending()
+
+    def _flush_pending(self):
+        # Caller holds self._lock; buffered records go out in a single write
+        if not self._pending:
+            return
+        with self._process_lock:
+            if self._shared and os.fstat(self._fd).st_size >= self.segment_bytes:
+                # Follow a rotation made by another process
+                self._open_active(self.segment_indexes()[-1])
+            data = bytes(self._pending)
+            self._pending.clear()
+            written = 0
+            try:
+                while written < len(data):
+                    written += os.write(self._fd, data[written:])
+            except OSError:
+                # e.g. disk full: the buffered records are lost, but a partially
+                # written one must not shift every record after it
+                size = os.fstat(self._fd).st_size
+                os.ftruncate(self._fd, size - size % RECORD.size)
+                raise
+            if os.fstat(self._fd).st_size >= self.segment_bytes:
+                # Rotate to a fresh segment
+                self._open_active(self._active_index + 1)
+
+    def flush(self):
+        with self._lock:
+            if self._fd is not None:
+                self._flush_pending()
+
+    def _flush_loop(self):
+        while not self._stopped.wait(FLUSH_INTERVAL):
+            # A failed flush or compaction is retried on the next round
+            try:
+                self.flush()
+                # Fold old segments until the disk budget is respected again
+                while self.compact():
+                    pass
+            except Exception:
+                logger.exception("reading log flush or compaction failed")
+
+    # ----- reading -----
+
+    def segment_records(self, index):
+        """Map one segment read-only as an array of RECORD_DTYPE records"""
+        path = self.segment_path(index)
+        count = os.path.getsize(path) // RECORD.size
+        if count == 0:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(count,))
+
+    def iter_segment(self, index, start=None, end=None):
+        """Yield unpacked records of one segment, optionally only those inside a time range"""
+        records = self.segment_records(index)
+        if start is not None or end is not None:
+            # Segments are not sorted by time, so every timestamp is checked
+            times = records["timestamp"]
+            mask = np.ones(len(records), dtype=bool)
+            if start is not None:
+                mask &= times >= start
+            if end is not None:
+                mask &= times <= end
+            records = records[mask]
+        for first in range(0, len(records), UNPACK_BLOCK):
+            yield from unpack_records(records[first:first + UNPACK_BLOCK])
+
+    def time_bounds(self, index):
+        """Earliest and latest timestamp of a segment, cached until the segment changes"""
+        info = os.stat(self.segment_path(index))
+        version = (info.st_size, info.st_mtime_ns)
+        cached = self._bounds.get(index)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        times = self.segment_records(index)["timestamp"]
+        bounds = (float(times.min()), float(times.max())) if len(times) else (math.inf, -math.inf)
+        self._bounds[index] = (version, bounds)
+        return bounds
+
+    def device_readings(self, device_id, start, end):
+        """Readings of one device taken from start up to (not including) end, sorted by time"""
+        self.flush()
+        raw_id = device_id.encode("utf-8")
+        indexes = self.segment_indexes()
+        for index in set(self._bounds) - set(indexes):
+            # Folded away by compaction
+            self._bounds.pop(index, None)
+        parts = [np.zeros(0, dtype=RECORD_DTYPE)]
+        for index in indexes:
+            try:
+                earliest, latest = self.time_bounds(index)
+                if latest < start or earliest >= end:
+                    continue
+                records = self.segment_records(index)
+            except FileNotFoundError:
+                continue
+            times = records["timestamp"]
+            mask = ((records["kind"] == KIND_READING) & (times >= start) & (times < end)
+                    & (records["device_id"] == raw_id))
+            parts.append(records[mask])
+            del records
+        readings = np.concatenate(parts)
+        return readings[np.argsort(readings["timestamp"], kind="stable")]
+
+    def iter_records(self, start=None, end=None):
+        """Yield every record on disk in append order"""
+        self.flush()
+        for index in self.segment_indexes():
+            yield from self.iter_segment(index, start, end)
+
+    def read_records(self):
+        """Read every segment on disk into one contiguous record array, in append order"""
+        self.flush()
+        with self._process_lock:
+            paths = [self.segment_path(index) for index in self.segment_indexes()]
+            counts = [os.path.getsize(path) // RECORD.size for path in paths]
+            records = np.zeros(sum(counts), dtype=RECORD_DTYPE)
+            rows = records.view(np.uint8)
+            offset = 0
+            for path, count in zip(paths, counts):
+                with open(path, "rb") as f:
+                    f.readinto(rows[offset:offset + count * RECORD.size])
+                offset += count * RECORD.size
+        return records
+
+    def replay(self, history_start=None):
+        """Return the latest state of every device and the readings since history_start"""
+        records = self.read_records()
+        # One stable sort by device serves both the latest states and the readings
+        keys = device_keys(records)
+        order = device_order(keys)
+        newest = newest_per_device(records, keys, order)
+        states = {record_device_id(r): record_state(r) for r in unpack_records(newest)}
+        if history_start is None:
+            return states, np.zeros(0, dtype=RECORD_DTYPE)
+        # Readings come back as one record array sorted by device, then time
+        wanted = (records["kind"] == KIND_READING) & (records["timestamp"] >= history_start)
+        order = order[wanted[order]]
+        readings = take_records(records, order)
+        # Readings of one device are appended almost always in time order: only sort
+        # by time as well when some of them are not
+        times = readings["timestamp"]
+        backwards = times[1:] < times[:-1]
+        backwards[device_ends(keys, order)[:-1]] = False
+        if backwards.any():
+            keys = device_keys(readings)
+            readings = take_records(readings, device_order(keys, times))
+        return states, readings
+
+    # ----- compaction -----
+
+    def compact(self):
+        """Fold the two oldest segments into one segment of per-device snapshots"""
+        with self._process_lock:
+            indexes = self.segment_indexes()
+            if len(indexes) <= self.max_segments:
+                return False
+            older, newer = indexes[0], indexes[1]
+            if newer == self._active_index:
+                return False
+            self._fold(older, newer)
+            return True
+
+    def _fold(self, older, newer):
+        latest = newest_per_device(np.concatenate([self.segment_records(older), self.segment_records(newer)]))
+        latest = latest[np.argsort(latest["timestamp"], kind="stable")]
+        latest["kind"] = KIND_SNAPSHOT
+        # Write the snapshots next to the newer segment, then swap them in atomically
+        target = self.segment_path(newer)
+        temp_path = target + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(latest.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, target)
+        os.remove(self.segment_path(older))
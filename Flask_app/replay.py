@@ -0,0 +1,352 @@
+# Offline what-if replay of recorded readings through the auto-mode logic:
+# how often would the LED and servo have switched, and for how long would they
+# have been on, with other thresholds?
+#
+# Usage: python replay.py --log-dir data/log --light-thresholds 1500:2500:100 --temp-thresholds 24:28:0.5
+#        python replay.py --export export.csv --light-hysteresis 0,100,200 --min-dwell 30
+import argparse
+import csv
+import json
+import sys
+import time
+
+import numpy as np
+
+import reading_log as rlog
+import signal_filters
+
+# Candidates evaluated together are limited so candidates x samples stays under this
+BLOCK_ELEMENTS = 8_000_000
+
+
+# ----- loading traces -----
+
+def load_log(directory, devices=None, start=None, end=None):
+    """Read the readings of a log directory into column arrays"""
+    log = rlog.ReadingLog(directory)
+    parts = []
+    for index in log.segment_indexes():
+        records = log.segment_records(index)
+        mask = records["kind"] == rlog.KIND_READING
+        if devices:
+            mask &= np.isin(records["device_id"], [d.encode("utf-8") for d in devices])
+        if start is not None:
+            mask &= records["timestamp"] >= start
+        if end is not None:
+            mask &= records["timestamp"] <= end
+        # Only the selected records are copied out of the mapping
+        parts.append(records[mask])
+        del records
+    records = np.concatenate(parts) if parts else np.zeros(0, dtype=rlog.RECORD_DTYPE)
+    flags = records["flags"]
+    return {
+        "device_id": records["device_id"],
+        "timestamp": records["timestamp"],
+        "light_level": records["light_level"].astype(np.float64),
+        "motion_detected": (flags & rlog.FLAG_MOTION) != 0,
+        "temperature": records["temperature"],
+        "has_light": (flags & rlog.FLAG_HAS_LIGHT) != 0,
+        "has_temperature": (flags & rlog.FLAG_HAS_TEMPERATURE) != 0,
+        "auto_mode": (flags & rlog.FLAG_AUTO_MODE) != 0,
+        "led_on": (flags & rlog.FLAG_LED_ON) != 0,
+        "servo_open": records["servo_angle"] > 0,
+    }
+
+
+def load_export(path, devices=None, start=None, end=None):
+    """Read the readings of a CSV or NDJSON file written by /api/export into column arrays"""
+    columns = {name: [] for name in ("device_id", "timestamp", "light_level", "motion_detected",
+                                     "temperature", "auto_mode", "led_on", "servo_open")}
+    wanted = set(devices) if devices else None
+
+    def truth(value):
+        return value is True or value == "True"
+
+    with open(path, newline="") as f:
+        ndjson = f.read(1) == "{"
+        f.seek(0)
+        rows = (json.loads(line) for line in f if line.strip()) if ndjson else csv.DictReader(f)
+        for row in rows:
+            if row["event"] != "reading" or (wanted is not None and row["device_id"] not in wanted):
+                continue
+            timestamp = float(row["timestamp"])
+            if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+            columns["device_id"].append(row["device_id"].encode("utf-8"))
+            columns["timestamp"].append(timestamp)
+            columns["light_level"].append(float(row["light_level"]))
+            columns["motion_detected"].append(truth(row["motion_detected"]))
+            columns["temperature"].append(float(row["temperature"]))
+            columns["auto_mode"].append(truth(row["auto_mode"]))
+            columns["led_on"].append(truth(row["led_on"]))
+            columns["servo_open"].append(int(row["servo_angle"]) > 0)
+    trace = {name: np.array(values) for name, values in columns.items()}
+    trace["device_id"] = trace["device_id"].astype("S32")
+    trace["timestamp"] = trace["timestamp"].astype(np.float64)
+    # Exports don't record which sensors a reading carried
+    trace["has_light"] = np.ones(len(trace["timestamp"]), dtype=bool)
+    trace["has_temperature"] = trace["has_light"]
+    return trace
+
+
+# ----- signal conditioning (same filters as signal_filters.SignalConditioner) -----
+
+def condition(values, present, median_window, smoothing, default):
+    """Filtered value after every sample of one device, like the live conditioner"""
+    samples = values[present]
+    if len(samples) and median_window > 1:
+        medians = np.empty_like(samples)
+        # Growing window for the first samples, then a sliding window of median_window
+        for i in range(min(median_window - 1, len(samples))):
+            window = np.sort(samples[:i + 1])
+            medians[i] = window[len(window) // 2]
+        if len(samples) >= median_window:
+            windows = np.lib.stride_tricks.sliding_window_view(samples, median_window)
+            medians[median_window - 1:] = np.sort(windows, axis=1)[:, median_window // 2]
+        samples = medians
+    if len(samples) and smoothing < 1:
+        # The rounding makes the EWMA non-linear, so it runs sample by sample
+        smoothed = np.empty_like(samples)
+        value = round(float(samples[0]), 2)
+        smoothed[0] = value
+        for i, sample in enumerate(samples[1:].tolist(), 1):
+            value = round(value + smoothing * (sample - value), 2)
+            smoothed[i] = value
+        samples = smoothed
+    else:
+        samples = np.round(samples, 2)
+    # Between samples of this sensor the filtered value stays put
+    last = np.cumsum(present) - 1
+    filtered = np.full(len(values), default, dtype=np.float64)
+    filtered[last >= 0] = samples[last[last >= 0]]
+    return filtered
+
+
+# ----- evaluating candidates -----
+
+def hold_forward(events):
+    """Replace -1 ("keep the previous outcome") by the last decided outcome of each row"""
+    positions = np.where(events >= 0, np.arange(events.shape[1]), 0)
+    np.maximum.accumulate(positions, axis=1, out=positions)
+    return np.take_along_axis(events, positions, axis=1).astype(bool)
+
+
+def led_outcomes(light, reset, thresholds, bands):
+    # The LED turns on below the threshold and, once on, stays on until the
+    # light reaches threshold + band; at a reset no previous outcome is known
+    thresholds = thresholds[:, None]
+    on = light < thresholds
+    events = np.where(on, 1, np.where(light >= thresholds + bands[:, None], 0, -1)).astype(np.int8)
+    events[:, reset] = on[:, reset]
+    return hold_forward(events)
+
+
+def servo_outcomes(temperature, motion, reset, thresholds, bands):
+    # The servo opens with motion above the threshold and, once open, stays open
+    # until motion stops or the temperature falls to threshold - band
+    thresholds = thresholds[:, None]
+    on = motion & (temperature > thresholds)
+    off = ~motion | (temperature <= thresholds - bands[:, None])
+    events = np.where(on, 1, np.where(off, 0, -1)).astype(np.int8)
+    events[:, reset] = on[:, reset]
+    return hold_forward(events)
+
+
+def dwell_ends(timestamps, starts, min_dwell):
+    """First position of the same device at least min_dwell after each reading"""
+    # Depends only on the timestamps, so it is computed once for every candidate
+    ends = np.empty(len(timestamps), dtype=np.intp)
+    bounds = np.r_[starts, len(timestamps)]
+    for first, stop in zip(bounds[:-1], bounds[1:]):
+        times = timestamps[first:stop]
+        ends[first:stop] = first + np.searchsorted(times, times + min_dwell)
+    return ends
+
+
+def apply_dwell(desired, ends, starts):
+    """Hold each output min_dwell seconds after it changed, like SignalConditioner.hold_outputs"""
+    n = len(desired)
+    if not n:
+        return desired.copy()
+    positions = np.arange(n)
+    bounds = np.r_[starts, n]
+    stops = np.repeat(bounds[1:], np.diff(bounds))
+    # Where the run of equal values holding each position ends (a device's runs end at its stop)
+    run_ends = np.r_[desired[1:] != desired[:-1], True]
+    run_ends[bounds[1:] - 1] = True
+    run_ends = np.minimum.accumulate(np.where(run_ends, positions + 1, n)[::-1])[::-1]
+
+    def next_change(at, earliest):
+        # First position from earliest on wanting the opposite of the value taken at `at`
+        earliest = np.minimum(earliest, stops[at])
+        inside = np.minimum(earliest, n - 1)
+        following = np.where(desired[inside] != desired[at], inside, run_ends[inside])
+        return np.where(earliest < stops[at], following, stops[at])
+
+    # After a change at c the output holds desired[c] until the next change, which
+    # only depends on c: the chain of changes is followed one switch at a time
+    after = next_change(positions, np.maximum(ends, positions + 1)).tolist()
+    changed = np.zeros(n, dtype=bool)
+    changed[starts] = True
+    # The first change of a device isn't held back
+    for change, stop in zip(next_change(starts, starts + 1).tolist(), bounds[1:].tolist()):
+        while change < stop:
+            changed[change] = True
+            change = after[change]
+    # Every reading takes the value set at the last change before it
+    return desired[np.maximum.accumulate(np.where(changed, positions, 0))]
+
+
+def actuation_stats(outputs, durations, continues):
+    """Switch count and time on of each row of outputs"""
+    switches = ((outputs[:, 1:] != outputs[:, :-1]) & continues[1:]).sum(axis=1)
+    on_time = (outputs * durations).sum(axis=1)
+    return switches, on_time
+
+
+def sweep(outcomes, values, grid, timestamps, starts, durations, continues, min_dwell):
+    """Evaluate every (threshold, band) candidate of one output, a block at a time"""
+    thresholds = np.array([t for t, _ in grid], dtype=np.float64)
+    bands = np.array([b for _, b in grid], dtype=np.float64)
+    block = max(1, BLOCK_ELEMENTS // max(1, len(timestamps)))
+    ends = dwell_ends(timestamps, starts, min_dwell) if min_dwell else None
+    results = []
+    for i in range(0, len(grid), block):
+        outputs = outcomes(thresholds[i:i + block], bands[i:i + block])
+        if min_dwell:
+            outputs = np.array([apply_dwell(row, ends, starts) for row in outputs])
+        switches, on_time = actuation_stats(outputs, durations, continues)
+        results.extend(zip(switches.tolist(), on_time.tolist()))
+    total = float(durations.sum())
+    return [
+        {values[0]: threshold, values[1]: band, "switches": switches, "on_time_s": on_time,
+         "on_share": on_time / total if total else None}
+        for (threshold, band), (switches, on_time) in zip(grid, results)
+    ]
+
+
+def replay(trace, light_grid, temp_grid, median_window=1, light_smoothing=1.0, temp_smoothing=1.0,
+           min_dwell=0.0, max_gap=60.0):
+    """Replay a trace for every candidate and report actuations and on-time"""
+    # Group by device, in time order
+    devices, codes = np.unique(trace["device_id"], return_inverse=True)
+    order = np.lexsort((trace["timestamp"], codes))
+    trace = {name: column[order] for name, column in trace.items()}
+    codes = codes[order]
+    timestamps = trace["timestamp"]
+    n = len(timestamps)
+    same_device = np.r_[False, codes[1:] == codes[:-1]]
+
+    # Filtered sensor values, per device
+    light = trace["light_level"].copy()
+    temperature = trace["temperature"].copy()
+    defaults = signal_filters.FILTERED_STATE
+    for first, stop in zip(*device_bounds(same_device)):
+        part = slice(first, stop)
+        light[part] = condition(trace["light_level"][part], trace["has_light"][part], median_window,
+                                light_smoothing, defaults["light_filtered"])
+        temperature[part] = condition(trace["temperature"][part], trace["has_temperature"][part],
+                                      median_window, temp_smoothing, defaults["temperature_filtered"])
+
+    # Each reading's outputs last until the device's next reading (gaps are capped)
+    durations = np.zeros(n)
+    if n:
+        durations[:-1] = np.where(same_device[1:], np.minimum(np.diff(timestamps), max_gap), 0)
+
+    # Only readings taken in auto mode are decided by the rules; rules start
+    # afresh for a new device and after manual mode
+    auto = trace["auto_mode"]
+    reset = (~same_device | ~np.r_[False, auto[:-1]])[auto]
+    timestamps, durations = timestamps[auto], durations[auto]
+    light, temperature, motion = light[auto], temperature[auto], trace["motion_detected"][auto]
+    # (cut to length: no reading at all may have been taken in auto mode)
+    continues = np.r_[False, (codes[auto][1:] == codes[auto][:-1])][:len(timestamps)]
+    starts = np.flatnonzero(~continues)
+
+    recorded = {}
+    for name, column in (("led", "led_on"), ("servo", "servo_open")):
+        switches, on_time = actuation_stats(trace[column][auto][None, :], durations, continues)
+        recorded[name] = {"switches": int(switches[0]), "on_time_s": float(on_time[0])}
+
+    return {
+        "devices": len(devices),
+        "samples": int(auto.sum()),
+        "duration_s": float(durations.sum()),
+        "recorded": recorded,
+        "led": sweep(lambda t, b: led_outcomes(light, reset, t, b),
+                     ("light_threshold", "light_hysteresis"), light_grid,
+                     timestamps, starts, durations, continues, min_dwell),
+        "servo": sweep(lambda t, b: servo_outcomes(temperature, motion, reset, t, b),
+                       ("temp_threshold", "temp_hysteresis"), temp_grid,
+                       timestamps, starts, durations, continues, min_dwell),
+    }
+
+
+def device_bounds(same_device):
+    # (starts, stops) of each device's run of samples
+    starts = np.flatnonzero(~same_device)
+    return starts, np.r_[starts[1:], len(same_device)]
+
+
+def parse_values(text, kind):
+    """Parse "1500,2000" or an inclusive range "1500:2500:100" """
+    if ":" in text:
+        low, high, step = (kind(part) for part in text.split(":"))
+        count = int(round((high - low) / step)) + 1
+        return [kind(round(low + i * step, 6)) for i in range(count)]
+    return [kind(part) for part in text.split(",")]
+
+
+def main():
+    defaults = {**signal_filters.FILTER_SETTINGS, "temp_threshold": 25.0, "light_threshold": 2000}
+    parser = argparse.ArgumentParser(description="Replay recorded readings with other auto-mode thresholds")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--log-dir", help="reading log directory (segment files)")
+    source.add_argument("--export", help="CSV or NDJSON file from /api/export")
+    parser.add_argument("--devices", help="comma-separated device IDs (default: all)")
+    parser.add_argument("--start", type=float, help="first timestamp to replay")
+    parser.add_argument("--end", type=float, help="last timestamp to replay")
+    parser.add_argument("--light-thresholds", default=str(defaults["light_threshold"]),
+                        help='candidates, e.g. "1500:2500:100" or "1800,2000"')
+    parser.add_argument("--light-hysteresis", default="0", help="candidate light hysteresis bands")
+    parser.add_argument("--temp-thresholds", default=str(defaults["temp_threshold"]),
+                        help='candidates, e.g. "24:28:0.5"')
+    parser.add_argument("--temp-hysteresis", default="0", help="candidate temperature hysteresis bands")
+    parser.add_argument("--median-window", type=int, default=defaults["median_window"])
+    parser.add_argument("--light-smoothing", type=float, default=defaults["light_smoothing"])
+    parser.add_argument("--temp-smoothing", type=float, default=defaults["temp_smoothing"])
+    parser.add_argument("--min-dwell", type=float, default=defaults["min_dwell"],
+                        help="seconds an output is held after it changed")
+    parser.add_argument("--max-gap", type=float, default=60.0,
+                        help="longest time a reading's outputs are counted for (device offline)")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    devices = args.devices.split(",") if args.devices else None
+    started = time.perf_counter()
+    if args.log_dir:
+        trace = load_log(args.log_dir, devices, args.start, args.end)
+    else:
+        trace = load_export(args.export, devices, args.start, args.end)
+    loaded = time.perf_counter()
+
+    light_grid = [(t, b) for t in parse_values(args.light_thresholds, int)
+                  for b in parse_values(args.light_hysteresis, int)]
+    temp_grid = [(t, b) for t in parse_values(args.temp_thresholds, float)
+                 for b in parse_values(args.temp_hysteresis, float)]
+    results = replay(trace, light_grid, temp_grid, args.median_window, args.light_smoothing,
+                     args.temp_smoothing, args.min_dwell, args.max_gap)
+    results["load_s"] = loaded - started
+    results["replay_s"] = time.perf_counter() - loaded
+    print(f"{results['samples']} readings, {len(light_grid) + len(temp_grid)} candidates "
+          f"in {results['replay_s']:.2f}s", file=sys.stderr)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
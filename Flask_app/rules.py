@@ -0,0 +1,216 @@
+# Declarative automation rules compiled once and evaluated incrementally
+import operator
+import threading
+import time
+
+# Comparison operators allowed in conditions
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+# Virtual fields computed at evaluation time rather than read from the state
+VIRTUAL_FIELDS = {
+    "hour": lambda state: time.localtime().tm_hour,
+}
+
+# Built-in rules reproducing the original auto mode, on the filtered readings
+# and with the device's hysteresis bands (see signal_filters.py)
+DEFAULT_RULES = [
+    {
+        # Turn LED on if light level below threshold
+        "name": "lighting",
+        "when": {"field": "light_filtered", "op": "<", "value": {"field": "light_threshold"},
+                 "hysteresis": {"field": "light_hysteresis"}},
+        "then": {"led_on": True},
+        "else": {"led_on": False}
+    },
+    {
+        # Set servo to 90° if motion detected and temperature above threshold
+        "name": "ventilation",
+        "when": {"all": [
+            {"field": "motion_detected", "op": "==", "value": True},
+            {"field": "temperature_filtered", "op": ">", "value": {"field": "temp_threshold"},
+             "hysteresis": {"field": "temp_hysteresis"}}
+        ]},
+        "then": {"servo_angle": 90},
+        "else": {"servo_angle": 0}
+    },
+]
+
+# Fields a rule may set
+OUTPUT_FIELDS = {"led_on": bool, "servo_angle": int}
+
+
+class CompiledRule:
+    """A rule turned into a predicate plus the fields it reads and the actions it takes"""
+
+    def __init__(self, definition, known_fields=None):
+        if not isinstance(definition, dict):
+            raise ValueError("rules must be objects")
+        self.name = definition.get("name", "")
+        self.known_fields = known_fields
+        self.fields = set()
+        self.volatile = False  # Reads virtual fields that change without a reading
+        if "when" not in definition:
+            raise ValueError(f"rule {self.name!r} has no 'when' condition")
+        self.predicate = self._compile(definition["when"])
+        self.then = self._actions(definition.get("then", {}))
+        self.otherwise = self._actions(definition.get("else", {}))
+
+    def _actions(self, actions):
+        if not isinstance(actions, dict):
+            raise ValueError(f"rule {self.name!r}: actions must be an object")
+        compiled = {}
+        for field, value in actions.items():
+            if field not in OUTPUT_FIELDS:
+                raise ValueError(f"rule {self.name!r}: cannot set {field!r}")
+            compiled[field] = OUTPUT_FIELDS[field](value)
+        if "servo_angle" in compiled:
+            # Constrain servo angle between 0 and 180
+            compiled["servo_angle"] = max(0, min(180, compiled["servo_angle"]))
+        return compiled
+
+    def _operand(self, value):
+        # Operands are constants or {"field": name} references
+        if isinstance(value, dict):
+            return self._getter(value["field"])
+        return lambda state: value
+
+    def _getter(self, field):
+        if field in VIRTUAL_FIELDS:
+            self.volatile = True
+            return VIRTUAL_FIELDS[field]
+        if self.known_fields is not None and field not in self.known_fields:
+            raise ValueError(f"rule {self.name!r}: unknown field {field!r}")
+        self.fields.add(field)
+        return operator.itemgetter(field)
+
+    def _compile(self, condition):
+        # Returns predicate(state, was_true) -> bool
+        if not isinstance(condition, dict):
+            raise ValueError(f"rule {self.name!r}: conditions must be objects")
+        if "all" in condition:
+            parts = [self._compile(c) for c in condition["all"]]
+            return lambda state, was_true: all(p(state, was_true) for p in parts)
+        if "any" in condition:
+            parts = [self._compile(c) for c in condition["any"]]
+            return lambda state, was_true: any(p(state, was_true) for p in parts)
+        if "not" in condition:
+            inner = self._compile(condition["not"])
+            return lambda state, was_true: not inner(state, was_true)
+
+        left = self._getter(condition["field"])
+        op = condition.get("op", "==")
+        if op == "between":
+            low, high = (self._operand(v) for v in condition["value"])
+            return lambda state, was_true: low(state) <= left(state) <= high(state)
+        if op not in OPERATORS:
+            raise ValueError(f"rule {self.name!r}: unknown operator {op!r}")
+        compare = OPERATORS[op]
+        right = self._operand(condition["value"])
+
+        # Hysteresis band: a constant or a {"field": name} reference
+        hysteresis = condition.get("hysteresis", 0)
+        if not isinstance(hysteresis, dict):
+            hysteresis = float(hysteresis)
+        if not hysteresis or op not in ("<", "<=", ">", ">="):
+            return lambda state, was_true: compare(left(state), right(state))
+        # Once true, the condition holds until the value crosses the threshold by the band
+        band = self._operand(hysteresis)
+        sign = 1 if op in ("<", "<=") else -1
+        return lambda state, was_true: compare(
+            left(state), right(state) + (sign * band(state) if was_true else 0)
+        )
+
+
+class RuleSet:
+    """Compiled rules indexed by the fields they read"""
+
+    def __init__(self, definitions, known_fields=None):
+        if not isinstance(definitions, list):
+            raise ValueError("rules must be a list")
+        self.definitions = definitions
+        self.rules = [CompiledRule(d, known_fields) for d in definitions]
+        # field -> indexes of the rules reading it
+        self.index = {}
+        for i, rule in enumerate(self.rules):
+            for field in rule.fields:
+                self.index.setdefault(field, []).append(i)
+        self.volatile = [i for i, rule in enumerate(self.rules) if rule.volatile]
+
+
+class DeviceRuleState:
+    """What the rules saw and decided at the last evaluation of one device"""
+
+    def __init__(self, ruleset):
+        self.ruleset = ruleset
+        self.inputs = {}  # Indexed field values at the last evaluation
+        self.outcomes = [None] * len(ruleset.rules)
+        self.actions = {}  # Merged actions of all rules
+
+
+class RuleEngine:
+    """Per-device rule sets evaluated only where their inputs changed"""
+
+    def __init__(self, definitions=DEFAULT_RULES, known_fields=None):
+        self.known_fields = known_fields
+        self.default = RuleSet(definitions, known_fields)
+        self._custom = {}  # device_id -> RuleSet
+        self._states = {}  # device_id -> DeviceRuleState
+        self._lock = threading.Lock()
+
+    def rules_for(self, device_id):
+        return self._custom.get(device_id, self.default)
+
+    def set_rules(self, device_id, definitions):
+        """Compile and install rules for one device (None restores the defaults)"""
+        ruleset = RuleSet(definitions, self.known_fields) if definitions is not None else None
+        with self._lock:
+            if ruleset is None:
+                self._custom.pop(device_id, None)
+            else:
+                self._custom[device_id] = ruleset
+            # Force a full evaluation with the new rules
+            self._states.pop(device_id, None)
+
+    def reset(self, device_id):
+        """Forget previous outcomes, e.g. when a device returns to auto mode"""
+        self._states.pop(device_id, None)
+
+    def evaluate(self, device_id, state):
+        """Re-run the rules whose inputs changed and apply the merged actions to the state"""
+        ruleset = self.rules_for(device_id)
+        memo = self._states.get(device_id)
+        if memo is None or memo.ruleset is not ruleset:
+            memo = self._states[device_id] = DeviceRuleState(ruleset)
+            dirty = range(len(ruleset.rules))
+        else:
+            # Only rules reading a changed field (or a virtual field) are re-evaluated
+            dirty = set(ruleset.volatile)
+            inputs = memo.inputs
+            for field, rule_indexes in ruleset.index.items():
+                if state.get(field) != inputs.get(field):
+                    dirty.update(rule_indexes)
+
+        changed = False
+        outcomes = memo.outcomes
+        for i in dirty:
+            outcome = ruleset.rules[i].predicate(state, bool(outcomes[i]))
+            if outcome != outcomes[i]:
+                outcomes[i] = outcome
+                changed = True
+        for field in ruleset.index:
+            memo.inputs[field] = state.get(field)
+
+        if changed:
+            # Later rules win when several set the same field
+            actions = {}
+            for rule, outcome in zip(ruleset.rules, outcomes):
+                actions.update(rule.then if outcome else rule.otherwise)
+            memo.actions = actions
+        state.update(memo.actions)
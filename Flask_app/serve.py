@@ -0,0 +1,63 @@
+# Production server: several worker processes sharing device state through shared memory
+#
+# Usage: python serve.py --workers 4 --threads 16 --port 5000
+# Requires gunicorn (pip install gunicorn); the development server is still `python backend.py`
+import argparse
+import os
+
+from gunicorn.app.base import BaseApplication  # type: ignore
+
+from shared_state import DEFAULT_CAPACITY
+
+
+def post_fork(server, worker):
+    # Threads and sockets of the master are not inherited: start them per worker
+    import backend
+    backend.after_fork()
+
+
+class ProductionServer(BaseApplication):
+    """Gunicorn application loading backend.py once in the master, then forking workers"""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import backend
+        return backend.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Smart Room Controller backend with several workers")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="worker processes")
+    parser.add_argument("--threads", type=int, default=16, help="request threads per worker")
+    parser.add_argument("--capacity", type=int, default=DEFAULT_CAPACITY,
+                        help="maximum number of devices held in shared memory")
+    args = parser.parse_args()
+
+    # backend.py creates the shared segment on import when this is set
+    os.environ["SHARED_STATE_CAPACITY"] = str(args.capacity)
+    # Telemetry waiting for admission holds a request thread: leave a quarter
+    # of the threads free for control changes and dashboards
+    os.environ.setdefault("INGEST_MAX_INFLIGHT", str(max(1, args.threads // 2)))
+    os.environ.setdefault("INGEST_MAX_QUEUE", str(args.threads // 4))
+    ProductionServer({
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        # Import the app (and restore the log into shared memory) before forking
+        "preload_app": True,
+        "post_fork": post_fork,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
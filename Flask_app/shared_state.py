@@ -0,0 +1,265 @@
+# Device state in a shared-memory segment, for multi-process production servers
+#
+# The segment and its locks are created in the server's master process before
+# workers are forked (see serve.py); every worker inherits them and sees the
+# same state.
+import json
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Default number of device slots and of lock stripes shared by all processes
+DEFAULT_CAPACITY = 10000
+DEFAULT_STRIPES = 64
+
+# Bytes reserved for the shared configuration document (rules, locations, ...)
+DEFAULT_CONFIG_BYTES = 4 * 1024 * 1024
+
+# How often long-polls re-check the version written by other processes (seconds)
+POLL_INTERVAL = 0.05
+
+# Segment header: capacity, number of devices, configuration generation, configuration length
+HEADER = struct.Struct("<QQQQ")
+
+# Every slot starts with the device ID, the state version and the time of the
+# last write, followed by one field per state key
+SLOT_ID = struct.Struct("<32s")
+SLOT_VERSION = struct.Struct("<Q")
+SLOT_UPDATED = struct.Struct("<d")
+
+# Struct codes and converters for the value types a state template may hold
+FIELD_TYPES = {bool: ("?", bool), int: ("q", int), float: ("d", float)}
+
+class SharedStateStore:
+    """Fixed-capacity table of device slots plus a shared configuration document"""
+
+    def __init__(self, template, capacity=DEFAULT_CAPACITY, stripes=DEFAULT_STRIPES, config_bytes=DEFAULT_CONFIG_BYTES):
+        # Slot layout is derived from the template: one struct field per state key
+        self.keys = list(template)
+        codes, converters = [], []
+        for key, value in template.items():
+            if type(value) not in FIELD_TYPES:
+                raise TypeError(f"state field {key!r} cannot be stored in shared memory")
+            code, convert = FIELD_TYPES[type(value)]
+            codes.append(code)
+            converters.append(convert)
+        self.codes = codes
+        self.fields = struct.Struct("<" + "".join(codes))
+        self.converters = converters
+        self.version_offset = SLOT_ID.size
+        self.updated_offset = self.version_offset + SLOT_VERSION.size
+        self.fields_offset = self.updated_offset + SLOT_UPDATED.size
+        # Round slots up to 8 bytes so versions stay aligned
+        self.slot_size = (self.fields_offset + self.fields.size + 7) // 8 * 8
+        self.capacity = capacity
+
+        self.slots_offset = HEADER.size
+        self.config_offset = self.slots_offset + capacity * self.slot_size
+        self.config_bytes = config_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=self.config_offset + config_bytes)
+        HEADER.pack_into(self.shm.buf, 0, capacity, 0, 0, 0)
+        # Only the creating process removes the segment; workers inherit atexit hooks too
+        self._owner_pid = os.getpid()
+
+        # Process-shared locks, inherited by forked workers
+        self.stripe_locks = [multiprocessing.Lock() for _ in range(stripes)]
+        self.alloc_lock = multiprocessing.Lock()
+        self.config_lock = multiprocessing.Lock()
+        # Serializes reading log flushes, rotation and compaction between workers
+        self.log_lock = multiprocessing.Lock()
+        # Serializes saving the configuration document to disk
+        self.snapshot_lock = multiprocessing.Lock()
+
+    def close(self):
+        if os.getpid() == self._owner_pid:
+            self.shm.close()
+            self.shm.unlink()
+
+    # ----- header -----
+
+    def count(self):
+        return HEADER.unpack_from(self.shm.buf, 0)[1]
+
+    def _set_count(self, count):
+        struct.pack_into("<Q", self.shm.buf, 8, count)
+
+    def slot_offset(self, slot):
+        return self.slots_offset + slot * self.slot_size
+
+    # ----- configuration document -----
+
+    def config_generation(self):
+        return HEADER.unpack_from(self.shm.buf, 0)[2]
+
+    def read_config(self):
+        """Return (generation, document) of the shared configuration"""
+        with self.config_lock:
+            _, _, generation, length = HEADER.unpack_from(self.shm.buf, 0)
+            raw = bytes(self.shm.buf[self.config_offset:self.config_offset + length])
+        return generation, (json.loads(raw) if raw else {})
+
+    def update_config(self, change):
+        """Apply change(document) atomically for every process"""
+        with self.config_lock:
+            _, _, generation, length = HEADER.unpack_from(self.shm.buf, 0)
+            raw = bytes(self.shm.buf[self.config_offset:self.config_offset + length])
+            document = json.loads(raw) if raw else {}
+            change(document)
+            encoded = json.dumps(document).encode("utf-8")
+            if len(encoded) > self.config_bytes:
+                raise ValueError("shared configuration is full")
+            self.shm.buf[self.config_offset:self.config_offset + len(encoded)] = encoded
+            struct.pack_into("<QQ", self.shm.buf, 16, generation + 1, len(encoded))
+            return document
+
+
+class SharedDeviceRegistry:
+    """DeviceRegistry interface backed by a SharedStateStore"""
+
+    def __init__(self, store, template):
+        self.store = store
+        self._template = dict(template)
+        self._template_json = json.dumps(self._template).encode("utf-8")
+        # Per-process caches: device ID -> slot, and (version, JSON bytes)
+        self._slots = {}
+        self._scanned = 0
+        self._json_cache = {}
+
+    def _stripe_lock(self, device_id):
+        # crc32 is stable across processes, unlike the built-in hash()
+        locks = self.store.stripe_locks
+        return locks[zlib.crc32(device_id.encode("utf-8")) % len(locks)]
+
+    def _scan(self):
+        # Learn about devices added by other processes
+        store, buf = self.store, self.store.shm.buf
+        count = store.count()
+        for slot in range(self._scanned, count):
+            raw_id = SLOT_ID.unpack_from(buf, store.slot_offset(slot))[0]
+            self._slots[raw_id.rstrip(b"\0").decode("utf-8")] = slot
+        self._scanned = count
+
+    def _find(self, device_id, create):
+        slot = self._slots.get(device_id)
+        if slot is None:
+            self._scan()
+            slot = self._slots.get(device_id)
+        if slot is None and create:
+            store = self.store
+            with store.alloc_lock:
+                # Another process may have added it since the last scan
+                self._scan()
+                slot = self._slots.get(device_id)
+                if slot is None:
+                    slot = store.count()
+                    if slot >= store.capacity:
+                        raise RuntimeError("shared state is full; raise --capacity")
+                    offset = store.slot_offset(slot)
+                    SLOT_ID.pack_into(store.shm.buf, offset, device_id.encode("utf-8"))
+                    SLOT_VERSION.pack_into(store.shm.buf, offset + store.version_offset, 0)
+                    SLOT_UPDATED.pack_into(store.shm.buf, offset + store.updated_offset, 0.0)
+                    self._write(slot, self._template)
+                    store._set_count(slot + 1)
+                    self._slots[device_id] = slot
+                    self._scanned = slot + 1
+        return slot
+
+    def _read(self, slot):
+        store = self.store
+        values = store.fields.unpack_from(store.shm.buf, store.slot_offset(slot) + store.fields_offset)
+        return dict(zip(store.keys, values))
+
+    def _write(self, slot, state):
+        store = self.store
+        values = [convert(state[key]) for key, convert in zip(store.keys, store.converters)]
+        store.fields.pack_into(store.shm.buf, store.slot_offset(slot) + store.fields_offset, *values)
+
+    def _version_at(self, slot):
+        store = self.store
+        return SLOT_VERSION.unpack_from(store.shm.buf, store.slot_offset(slot) + store.version_offset)[0]
+
+    @contextmanager
+    def locked(self, device_id):
+        """Yield the state of a device while holding its stripe lock; changes are written back"""
+        with self._stripe_lock(device_id):
+            slot = self._find(device_id, create=True)
+            state = self._read(slot)
+            yield state
+            self._write(slot, state)
+            SLOT_UPDATED.pack_into(self.store.shm.buf, self.store.slot_offset(slot) + self.store.updated_offset,
+                                   time.time())
+
+    def snapshot(self, device_id):
+        with self._stripe_lock(device_id):
+            slot = self._find(device_id, create=False)
+            return dict(self._template) if slot is None else self._read(slot)
+
+    def mark_changed(self, device_id):
+        """Bump the version of a device; the caller must hold its lock"""
+        slot = self._find(device_id, create=True)
+        offset = self.store.slot_offset(slot) + self.store.version_offset
+        SLOT_VERSION.pack_into(self.store.shm.buf, offset, self._version_at(slot) + 1)
+
+    def version(self, device_id):
+        slot = self._find(device_id, create=False)
+        return 0 if slot is None else self._version_at(slot)
+
+    def versioned_json(self, device_id):
+        with self._stripe_lock(device_id):
+            slot = self._find(device_id, create=False)
+            if slot is None:
+                return 0, self._template_json
+            version = self._version_at(slot)
+            cached = self._json_cache.get(device_id)
+            if cached is not None and cached[0] == version:
+                return cached
+            cached = self._json_cache[device_id] = (version, json.dumps(self._read(slot)).encode("utf-8"))
+            return cached
+
+    def wait_for_change(self, device_id, since, timeout):
+        # Other processes can't notify this one, so poll the shared version
+        deadline = time.monotonic() + timeout
+        while self.version(device_id) == since:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(POLL_INTERVAL, remaining))
+        return True
+
+    def exists(self, device_id):
+        return self._find(device_id, create=False) is not None
+
+    def device_ids(self):
+        self._scan()
+        return list(self._slots)
+
+    def __len__(self):
+        return self.store.count()
+
+    def columns(self):
+        """Return (device IDs in slot order, {field: NumPy array}), plus an "updated_at" column"""
+        store = self.store
+        self._scan()
+        count = self._scanned
+        device_ids = [None] * count
+        for device_id, slot in self._slots.items():
+            device_ids[slot] = device_id
+        # Structured dtype overlaying one slot; "<" formats have no padding,
+        # so each field starts where the previous one ends
+        names, formats, offsets = ["updated_at"], ["<f8"], [store.updated_offset]
+        offset = store.fields_offset
+        for key, code in zip(store.keys, store.codes):
+            names.append(key)
+            formats.append("<" + code)
+            offsets.append(offset)
+            offset += struct.calcsize("<" + code)
+        dtype = np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": store.slot_size})
+        table = np.frombuffer(store.shm.buf, dtype=dtype, count=count, offset=store.slots_offset)
+        # Copy out so the result doesn't pin the shared buffer
+        return device_ids, {name: table[name].copy() for name in names}
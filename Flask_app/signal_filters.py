@@ -0,0 +1,102 @@
+# Per-device streaming filters applied to readings before the auto-mode decision
+from collections import deque
+
+# Filter settings kept in the device state next to the thresholds; the
+# defaults leave readings and outputs untouched
+FILTER_SETTINGS = {
+    "median_window": 1,          # Median of the last k samples, to drop spikes (1 = off)
+    "light_smoothing": 1.0,      # EWMA weight of a new light sample (1 = no smoothing)
+    "temp_smoothing": 1.0,       # EWMA weight of a new temperature sample
+    "light_hysteresis": 0,       # Light must rise this far above the threshold to switch the LED off
+    "temp_hysteresis": 0.0,      # Temperature must fall this far below the threshold to close the vent
+    "min_dwell": 0.0             # Seconds an output keeps its value before auto mode may change it
+}
+
+# Conditioned values written to the state (read by the default rules)
+FILTERED_STATE = {
+    "light_filtered": 0.0,
+    "temperature_filtered": 20.0
+}
+
+# Raw sensor -> (filtered field, smoothing setting)
+FILTERED_SENSORS = {
+    "light_level": ("light_filtered", "light_smoothing"),
+    "temperature": ("temperature_filtered", "temp_smoothing"),
+}
+
+# Outputs protected by the minimum dwell time -> state field holding the time
+# auto mode last changed them (0 = never); kept in the state so worker
+# processes sharing it enforce one dwell time
+DWELL_OUTPUTS = {
+    "led_on": "led_changed_at",
+    "servo_angle": "servo_changed_at",
+}
+DWELL_STATE = {field: 0.0 for field in DWELL_OUTPUTS.values()}
+
+# Largest median window (the window is sorted on every sample)
+MAX_MEDIAN_WINDOW = 15
+
+
+def validate_settings(data):
+    """Return the filter settings in data, converted and range-checked"""
+    updates = {}
+    if "median_window" in data:
+        window = int(data["median_window"])
+        if not 1 <= window <= MAX_MEDIAN_WINDOW:
+            raise ValueError(f"median_window must be between 1 and {MAX_MEDIAN_WINDOW}")
+        updates["median_window"] = window
+    for key in ("light_smoothing", "temp_smoothing"):
+        if key in data:
+            weight = float(data[key])
+            if not 0 < weight <= 1:
+                raise ValueError(f"{key} must be in (0, 1]")
+            updates[key] = weight
+    for key in ("light_hysteresis", "temp_hysteresis", "min_dwell"):
+        if key in data:
+            value = type(FILTER_SETTINGS[key])(data[key])
+            if value < 0:
+                raise ValueError(f"{key} must not be negative")
+            updates[key] = value
+    return updates
+
+
+class SignalConditioner:
+    """Median and EWMA filters per device and sensor, plus output dwell times
+
+    Callers hold the device lock, so each device's entries are only touched
+    by one thread at a time.
+    """
+
+    def __init__(self):
+        self._windows = {}  # (device_id, sensor) -> recent raw samples
+
+    def condition(self, device_id, state, sensor, value):
+        """Filter a raw sample into the sensor's filtered state field"""
+        key = (device_id, sensor)
+        size = state["median_window"]
+        window = self._windows.get(key)
+        first = window is None
+        if first or window.maxlen != size:
+            window = self._windows[key] = deque(window or (), maxlen=size)
+        window.append(value)
+        median = sorted(window)[len(window) // 2] if size > 1 else value
+
+        field, smoothing = FILTERED_SENSORS[sensor]
+        if first:
+            # Nothing to smooth against yet (new device or restarted server)
+            filtered = float(median)
+        else:
+            filtered = state[field] + state[smoothing] * (median - state[field])
+        # Rounded so a steady signal settles instead of creeping by tiny amounts
+        state[field] = round(filtered, 2)
+
+    def hold_outputs(self, before, state, min_dwell, now):
+        """Undo output changes made less than min_dwell seconds after the previous one"""
+        for field, changed_at in DWELL_OUTPUTS.items():
+            if state[field] == before[field]:
+                continue
+            last = state[changed_at]
+            if min_dwell and last and now - last < min_dwell:
+                state[field] = before[field]
+            else:
+                state[changed_at] = now
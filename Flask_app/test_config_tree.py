@@ -0,0 +1,172 @@
+# Tests for the hierarchical configuration and its restore at startup
+# (run from Flask_app: python -m unittest)
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import config_tree
+import reading_log as rlog
+from config_tree import ConfigTree
+
+LOCATION = {"building": "A", "floor": "1", "room": "101"}
+NO_LOCATION = {"building": None, "floor": None, "room": None}
+
+
+class ConfigTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = ConfigTree({"temp_threshold": 25.0, "median_window": 1, "min_dwell": 0.0})
+        self.tree.update([
+            ({"building": "A"}, {"temp_threshold": 24.0, "median_window": 5}),
+            ({"building": "A", "floor": "1"}, {"temp_threshold": 23.0}),
+            ({"building": "A", "floor": "1", "room": "101"}, {"median_window": 3}),
+            ({"device_id": "room-1"}, {"min_dwell": 10.0}),
+        ])
+
+    def test_most_specific_level_wins(self):
+        self.assertEqual(self.tree.resolve("room-1", LOCATION),
+                         {"temp_threshold": 23.0, "median_window": 3, "min_dwell": 10.0})
+        # Another room on the same floor only shares the floor and building
+        self.assertEqual(self.tree.resolve("room-2", {**LOCATION, "room": "102"}),
+                         {"temp_threshold": 23.0, "median_window": 5, "min_dwell": 0.0})
+        self.assertEqual(self.tree.resolve("room-3", {"building": "A", "floor": "2", "room": None}),
+                         {"temp_threshold": 24.0, "median_window": 5, "min_dwell": 0.0})
+
+    def test_device_without_location_gets_defaults_and_its_own_values(self):
+        self.assertEqual(self.tree.resolve("room-1", NO_LOCATION),
+                         {"temp_threshold": 25.0, "median_window": 1, "min_dwell": 10.0})
+        self.assertEqual(self.tree.resolve("elsewhere", NO_LOCATION),
+                         {"temp_threshold": 25.0, "median_window": 1, "min_dwell": 0.0})
+
+    def test_layers_from_general_to_specific(self):
+        keys = [config_tree.scope_key(entry["scope"]) for entry in self.tree.layers("room-1", LOCATION)]
+        self.assertEqual(keys, ["building:A", "floor:A/1", "room:A/1/101", "device:room-1"])
+
+    def test_update_merges_and_clears_values(self):
+        self.tree.resolve("room-1", LOCATION)
+        generation = self.tree.generation
+        updated = self.tree.update([({"building": "A"}, {"temp_threshold": None, "min_dwell": 5.0})])
+        self.assertEqual(updated["building:A"]["values"], {"median_window": 5, "min_dwell": 5.0})
+        self.assertGreater(self.tree.generation, generation)
+        # The cached values were dropped; the device still overrides min_dwell
+        self.assertEqual(self.tree.resolve("room-2", {**LOCATION, "room": "102"}),
+                         {"temp_threshold": 23.0, "median_window": 5, "min_dwell": 5.0})
+        self.assertEqual(self.tree.resolve("room-1", LOCATION)["min_dwell"], 10.0)
+        # Clearing every value removes the scope
+        updated = self.tree.update([({"device_id": "room-1"}, None)])
+        self.assertEqual(updated, {"device:room-1": None})
+        self.assertEqual(self.tree.resolve("room-1", LOCATION)["min_dwell"], 5.0)
+
+    def test_load_replaces_every_entry(self):
+        other = ConfigTree(self.tree.defaults)
+        other.load(self.tree.entries())
+        self.assertEqual(other.resolve("room-1", LOCATION), self.tree.resolve("room-1", LOCATION))
+        other.load({})
+        self.assertEqual(other.resolve("room-1", LOCATION), self.tree.defaults)
+
+    def test_scope_keys(self):
+        self.assertEqual(config_tree.scope_key({"building": "A", "floor": 2}), "floor:A/2")
+        self.assertEqual(config_tree.scope_key({"device_id": "x", "building": "A"}), "device:x")
+        for scope in ({}, {"floor": 1}, {"building": "A", "room": "101"}, "A"):
+            with self.assertRaises(ValueError):
+                config_tree.scope_key(scope)
+
+    def test_validate_values(self):
+        self.assertEqual(config_tree.validate_values({"temp_threshold": "26.5", "auto_mode": 0, "min_dwell": None}),
+                         {"temp_threshold": 26.5, "auto_mode": False, "min_dwell": None})
+        for values in ({"humidity": 1}, {"median_window": 0}, ["temp_threshold"]):
+            with self.assertRaises(ValueError):
+                config_tree.validate_values(values)
+
+
+# Imports the backend (which restores config.json and the log at import) with
+# READING_LOG_DIR set, sends the given requests, then prints the given GETs
+BACKEND_RUN = """
+import json, sys
+import backend
+client = backend.app.test_client()
+for method, path, body in json.loads(sys.argv[1]):
+    response = client.open(path, method=method, json=body)
+    assert response.status_code == 200, (path, response.get_json())
+print(json.dumps({path: client.get(path).get_json() for path in json.loads(sys.argv[2])}))
+"""
+
+
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def run_backend(self, requests=(), gets=()):
+        env = {**os.environ, "READING_LOG_DIR": self.directory.name}
+        env.pop("SHARED_STATE_CAPACITY", None)
+        result = subprocess.run(
+            [sys.executable, "-c", BACKEND_RUN, json.dumps(list(requests)), json.dumps(list(gets))],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout.splitlines()[-1])
+
+    def test_configuration_is_restored_before_the_log(self):
+        # The log only knows the device; its location and settings are in config.json
+        with open(os.path.join(self.directory.name, "config.json"), "w") as f:
+            json.dump({
+                "locations": {"room-1": LOCATION},
+                "config": {
+                    "building:A": {"scope": {"building": "A"}, "values": {"median_window": 5, "min_dwell": 10.0}},
+                    "room:A/1/101": {"scope": LOCATION, "values": {"median_window": 3}},
+                },
+            }, f)
+        log = rlog.ReadingLog(self.directory.name)
+        log.open()
+        state = {"light_level": 1200, "motion_detected": True, "temperature": 22.5, "led_on": True,
+                 "servo_angle": 90, "auto_mode": False, "temp_threshold": 27.0, "light_threshold": 1500}
+        log.append("room-1", rlog.KIND_READING, state, rlog.FLAG_HAS_LIGHT)
+        log.close()
+
+        status = self.run_backend(gets=["/devices/room-1/api/system_status"])["/devices/room-1/api/system_status"]
+        # Settings the log doesn't record resolve through the restored location...
+        self.assertEqual((status["median_window"], status["min_dwell"]), (3, 10.0))
+        # ...while everything the log recorded comes back as logged
+        self.assertEqual({key: status[key] for key in state}, state)
+        self.assertEqual((status["light_filtered"], status["temperature_filtered"]), (1200.0, 22.5))
+
+    def test_changes_survive_a_restart(self):
+        gets = ["/devices/room-1/api/system_status", "/devices/room-1/api/config",
+                "/devices/room-1/api/rules", "/devices/room-1/api/location"]
+        rules = [{"name": "night", "when": {"field": "light_level", "op": "<", "value": 500},
+                  "then": {"led_on": True}, "else": {"led_on": False}}]
+        before = self.run_backend([
+            ["PUT", "/devices/room-1/api/location", LOCATION],
+            ["POST", "/api/config", {"changes": [
+                {"scope": {"building": "A"}, "values": {"median_window": 5, "min_dwell": 10}},
+                {"scope": LOCATION, "values": {"median_window": 3}},
+            ]}],
+            ["POST", "/devices/room-1/esp/update", {"light_level": 1200, "motion_detected": False,
+                                                    "temperature": 22.0}],
+            ["POST", "/devices/room-1/flet/update_thresholds", {"temp_threshold": 27}],
+            ["PUT", "/devices/room-1/api/rules", {"rules": rules}],
+            # The last change goes out just before the process exits
+            ["POST", "/devices/room-1/flet/update", {"auto_mode": False, "led_on": True, "servo_angle": 120}],
+        ], gets)
+        after = self.run_backend(gets=gets)
+
+        config = after["/devices/room-1/api/config"]
+        self.assertEqual(config["location"], LOCATION)
+        self.assertEqual(config["effective"], before["/devices/room-1/api/config"]["effective"])
+        self.assertEqual((config["effective"]["median_window"], config["effective"]["min_dwell"],
+                          config["effective"]["temp_threshold"], config["effective"]["auto_mode"]),
+                         (3, 10.0, 27.0, False))
+        self.assertEqual(after["/devices/room-1/api/rules"], before["/devices/room-1/api/rules"])
+        status = after["/devices/room-1/api/system_status"]
+        for key in ("light_level", "temperature", "auto_mode", "led_on", "servo_angle", "temp_threshold",
+                    "median_window", "min_dwell"):
+            self.assertEqual(status[key], before["/devices/room-1/api/system_status"][key], key)
+
+
+if __name__ == "__main__":
+    unittest.main()
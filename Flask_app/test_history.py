@@ -0,0 +1,129 @@
+# Tests for the in-memory sensor history (run from Flask_app: python -m unittest)
+import unittest
+from array import array
+
+import history
+from history import RingSeries, SensorHistory
+
+
+def samples(series):
+    # Valid (timestamp, value) pairs of a series, oldest first
+    return list(zip(series._ordered(series.times), series._ordered(series.values)))
+
+
+def fill(series, times):
+    for t in times:
+        series.append(float(t), float(t) * 10)
+
+
+class RingSeriesTest(unittest.TestCase):
+
+    def test_storage_grows_up_to_the_capacity(self):
+        grown = []
+        series = RingSeries(40, on_grow=grown.append)
+        fill(series, range(30))
+        self.assertEqual(len(series.times), 32)
+        self.assertEqual(sum(grown), 16 * 16)
+        fill(series, range(30, 50))
+        # Growth stops at the capacity, whatever the doubling would give
+        self.assertEqual(len(series.times), 40)
+        self.assertEqual(sum(grown), 16 * 24)
+        self.assertEqual(samples(series), [(float(t), t * 10.0) for t in range(10, 50)])
+
+    def test_wraparound_keeps_the_newest_samples_in_order(self):
+        series = RingSeries(16)
+        fill(series, range(1, 41))
+        self.assertEqual(series.count, 16)
+        self.assertEqual(samples(series), [(float(t), t * 10.0) for t in range(25, 41)])
+        self.assertEqual(series.last_time(), 40.0)
+        # Buckets spanning the physical end of the ring
+        self.assertEqual(series.buckets(25, 41, 8), [
+            (25, 250.0, 320.0, 285.0, 8),
+            (33, 330.0, 400.0, 365.0, 8),
+        ])
+
+    def test_backdated_sample_is_put_in_its_place(self):
+        series = RingSeries(100)
+        fill(series, [1, 2, 4, 5])
+        series.append(3.0, 30.0)
+        self.assertEqual([t for t, _ in samples(series)], [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(series.last_time(), 5.0)
+        # Appending continues after the newest sample
+        series.append(6.0, 60.0)
+        self.assertEqual(samples(series)[-1], (6.0, 60.0))
+
+    def test_backdated_sample_into_a_full_wrapped_series(self):
+        series = RingSeries(16)
+        fill(series, range(0, 40, 2))
+        series.append(31.0, 310.0)
+        times = [t for t, _ in samples(series)]
+        # The oldest sample gives way; order and capacity are kept
+        self.assertEqual(len(times), 16)
+        self.assertEqual(times, sorted(times))
+        self.assertIn(31.0, times)
+        self.assertNotIn(8.0, times)
+        series.append(40.0, 400.0)
+        self.assertEqual([t for t, _ in samples(series)][-2:], [38.0, 40.0])
+
+    def test_load_keeps_the_newest_samples(self):
+        series = RingSeries(50)
+        times = array("d", range(100))
+        values = array("d", range(0, 1000, 10))
+        self.assertEqual(series.load(times, values), 16 * 50 - 16 * 16)
+        self.assertEqual(samples(series), [(float(t), t * 10.0) for t in range(50, 100)])
+        series.append(100.0, 1000.0)
+        self.assertEqual(samples(series)[0], (51.0, 510.0))
+
+    def test_shrink_drops_the_oldest_samples(self):
+        series = RingSeries(64)
+        fill(series, range(60))
+        freed = series.shrink(20)
+        self.assertEqual(freed, 16 * (64 - 20))
+        self.assertEqual(series.capacity, 20)
+        self.assertEqual(samples(series), [(float(t), t * 10.0) for t in range(40, 60)])
+        # The lower capacity holds from now on
+        fill(series, range(60, 70))
+        self.assertEqual(len(series.times), 20)
+        self.assertEqual(samples(series)[0], (50.0, 500.0))
+
+
+class SensorHistoryTest(unittest.TestCase):
+
+    def test_budget_is_shared_evenly_between_series(self):
+        budget = 256 * 1024
+        h = SensorHistory(capacity=43200, memory_budget=budget)
+        t = 0.0
+        for i in range(20000):
+            t += 1
+            h.record(f"dev-{i % 200}", t, light_level=i, temperature=20.0)
+        counts = [series.count for series in h._series.values()]
+        self.assertEqual(len(counts), 400)
+        # Every series keeps about the same number of the newest samples
+        self.assertLessEqual(max(counts) - min(counts), 1)
+        self.assertLessEqual(h.memory_used(), budget)
+        self.assertEqual(h.memory_used(), sum(series.nbytes() for series in h._series.values()))
+        newest = h.query("dev-199", "light_level", t - 10, t + 1, 100)
+        self.assertEqual(newest[0][1:], (19999.0, 19999.0, 19999.0, 1))
+
+    def test_too_many_series_evict_the_idlest(self):
+        # Not even the minimum allocation fits every series
+        h = SensorHistory(capacity=1000, memory_budget=16 * history.INITIAL_ALLOCATION * 10)
+        for i in range(30):
+            h.record(f"dev-{i}", float(i), light_level=i)
+        self.assertLessEqual(h.memory_used(), h.memory_budget)
+        self.assertIn(("dev-29", "light_level"), h._series)
+        self.assertNotIn(("dev-0", "light_level"), h._series)
+
+    def test_query_checks(self):
+        h = SensorHistory()
+        with self.assertRaises(ValueError):
+            h.query("dev", "humidity", 0, 10, 1)
+        with self.assertRaises(ValueError):
+            h.query("dev", "temperature", 0, 10, 0)
+        with self.assertRaises(ValueError):
+            h.query("dev", "temperature", 0, 10 * history.MAX_BUCKETS, 0.5)
+        self.assertEqual(h.query("unknown", "temperature", 0, 10, 1), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
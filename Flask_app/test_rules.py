@@ -0,0 +1,165 @@
+# Tests for the automation rules (run from Flask_app: python -m unittest)
+import unittest
+
+from rules import CompiledRule, RuleEngine, RuleSet
+import signal_filters
+
+
+def room_state(**values):
+    # Device state with the fields the default rules read
+    state = {
+        "light_level": 3000, "motion_detected": False, "temperature": 20.0,
+        "led_on": False, "servo_angle": 0, "auto_mode": True,
+        "temp_threshold": 25.0, "light_threshold": 2000,
+        **signal_filters.FILTER_SETTINGS, **signal_filters.FILTERED_STATE,
+    }
+    state.update(values)
+    return state
+
+
+class CountingPredicate:
+    # Wraps a compiled predicate to count how often it runs
+    def __init__(self, predicate):
+        self.predicate = predicate
+        self.calls = 0
+
+    def __call__(self, state, was_true):
+        self.calls += 1
+        return self.predicate(state, was_true)
+
+
+class DefaultRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = RuleEngine()
+
+    def test_light_hysteresis(self):
+        state = room_state(light_hysteresis=100, light_filtered=2500.0)
+        self.engine.evaluate("room", state)
+        self.assertFalse(state["led_on"])
+        # Below the threshold: on
+        state["light_filtered"] = 1999.0
+        self.engine.evaluate("room", state)
+        self.assertTrue(state["led_on"])
+        # Back above the threshold but inside the band: stays on
+        state["light_filtered"] = 2050.0
+        self.engine.evaluate("room", state)
+        self.assertTrue(state["led_on"])
+        # Past threshold + band: off, and the band no longer applies
+        state["light_filtered"] = 2100.0
+        self.engine.evaluate("room", state)
+        self.assertFalse(state["led_on"])
+        state["light_filtered"] = 2050.0
+        self.engine.evaluate("room", state)
+        self.assertFalse(state["led_on"])
+
+    def test_temperature_hysteresis_needs_motion(self):
+        state = room_state(temp_hysteresis=1.0, temperature_filtered=26.0)
+        self.engine.evaluate("room", state)
+        self.assertEqual(state["servo_angle"], 0)
+        state["motion_detected"] = True
+        self.engine.evaluate("room", state)
+        self.assertEqual(state["servo_angle"], 90)
+        # Cooling inside the band keeps the vent open; below it closes
+        state["temperature_filtered"] = 24.5
+        self.engine.evaluate("room", state)
+        self.assertEqual(state["servo_angle"], 90)
+        state["temperature_filtered"] = 23.9
+        self.engine.evaluate("room", state)
+        self.assertEqual(state["servo_angle"], 0)
+        # Motion stopping closes it whatever the temperature
+        state.update(temperature_filtered=30.0)
+        self.engine.evaluate("room", state)
+        self.assertEqual(state["servo_angle"], 90)
+        state["motion_detected"] = False
+        self.engine.evaluate("room", state)
+        self.assertEqual(state["servo_angle"], 0)
+
+    def test_set_rules_and_restore_defaults(self):
+        state = room_state(light_filtered=100.0)
+        self.engine.set_rules("room", [{"when": {"field": "light_level", "op": ">", "value": 0},
+                                        "then": {"servo_angle": 45}}])
+        self.engine.evaluate("room", state)
+        self.assertEqual((state["servo_angle"], state["led_on"]), (45, False))
+        self.engine.set_rules("room", None)
+        self.engine.evaluate("room", state)
+        self.assertEqual((state["servo_angle"], state["led_on"]), (0, True))
+
+
+class CompiledRuleTest(unittest.TestCase):
+
+    def test_fields_are_indexed_per_rule(self):
+        ruleset = RuleSet([
+            {"name": "a", "when": {"field": "light_level", "op": "<", "value": {"field": "light_threshold"}},
+             "then": {"led_on": True}},
+            {"name": "b", "when": {"any": [{"field": "temperature", "op": ">", "value": 30},
+                                           {"not": {"field": "motion_detected", "value": True}}]},
+             "then": {"servo_angle": 10}},
+            {"name": "c", "when": {"field": "hour", "op": "between", "value": [0, 23]},
+             "then": {"servo_angle": 20}},
+        ])
+        self.assertEqual(ruleset.index, {
+            "light_level": [0], "light_threshold": [0], "temperature": [1], "motion_detected": [1],
+        })
+        self.assertEqual(ruleset.volatile, [2])
+
+    def test_only_rules_reading_changed_fields_run(self):
+        engine = RuleEngine([
+            {"when": {"field": "light_level", "op": "<", "value": 1000}, "then": {"led_on": True},
+             "else": {"led_on": False}},
+            {"when": {"field": "temperature", "op": ">", "value": 25}, "then": {"servo_angle": 90},
+             "else": {"servo_angle": 0}},
+        ])
+        counters = []
+        for rule in engine.default.rules:
+            rule.predicate = CountingPredicate(rule.predicate)
+            counters.append(rule.predicate)
+        state = room_state(light_level=500, temperature=20.0)
+        engine.evaluate("room", state)
+        self.assertEqual([c.calls for c in counters], [1, 1])
+        state["temperature"] = 26.0
+        engine.evaluate("room", state)
+        self.assertEqual([c.calls for c in counters], [1, 2])
+        self.assertEqual((state["led_on"], state["servo_angle"]), (True, 90))
+        # Nothing the rules read changed: nothing runs, the actions stay applied
+        state["led_on"] = False
+        engine.evaluate("room", state)
+        self.assertEqual([c.calls for c in counters], [1, 2])
+        self.assertTrue(state["led_on"])
+        # A reset forces a full evaluation
+        engine.reset("room")
+        engine.evaluate("room", state)
+        self.assertEqual([c.calls for c in counters], [2, 3])
+
+    def test_later_rules_win(self):
+        engine = RuleEngine([
+            {"when": {"field": "light_level", "op": ">", "value": 0}, "then": {"servo_angle": 30}},
+            {"when": {"field": "light_level", "op": ">", "value": 100}, "then": {"servo_angle": 60}},
+        ])
+        state = room_state(light_level=50)
+        engine.evaluate("room", state)
+        self.assertEqual(state["servo_angle"], 30)
+        state["light_level"] = 500
+        engine.evaluate("room", state)
+        self.assertEqual(state["servo_angle"], 60)
+
+    def test_invalid_rules(self):
+        known = set(room_state())
+        for definition in (
+                [],
+                {"then": {"led_on": True}},
+                {"when": {"field": "humidity", "op": ">", "value": 1}},
+                {"when": {"field": "light_level", "op": "~", "value": 1}},
+                {"when": {"field": "light_level", "op": ">", "value": 1}, "then": {"auto_mode": False}},
+        ):
+            with self.assertRaises(ValueError):
+                CompiledRule(definition, known)
+
+    def test_servo_angle_is_clamped(self):
+        rule = CompiledRule({"when": {"field": "light_level", "op": ">", "value": 0},
+                             "then": {"servo_angle": 400}, "else": {"servo_angle": -5}})
+        self.assertEqual((rule.then, rule.otherwise), ({"servo_angle": 180}, {"servo_angle": 0}))
+
+
+if __name__ == "__main__":
+    unittest.main()
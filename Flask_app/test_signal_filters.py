@@ -0,0 +1,110 @@
+# Tests for the signal conditioning filters (run from Flask_app: python -m unittest)
+import unittest
+
+import signal_filters
+from signal_filters import SignalConditioner
+
+
+def filter_state(**settings):
+    state = {**signal_filters.FILTER_SETTINGS, **signal_filters.FILTERED_STATE,
+             **signal_filters.DWELL_STATE, "led_on": False, "servo_angle": 0}
+    state.update(settings)
+    return state
+
+
+class ConditionTest(unittest.TestCase):
+
+    def feed(self, state, sensor, values, conditioner=None):
+        conditioner = conditioner or SignalConditioner()
+        field = signal_filters.FILTERED_SENSORS[sensor][0]
+        filtered = []
+        for value in values:
+            conditioner.condition("room", state, sensor, value)
+            filtered.append(state[field])
+        return filtered
+
+    def test_defaults_pass_readings_through(self):
+        self.assertEqual(self.feed(filter_state(), "light_level", [100, 4000, 7]), [100.0, 4000.0, 7.0])
+
+    def test_median_drops_a_spike(self):
+        state = filter_state(median_window=3)
+        self.assertEqual(self.feed(state, "temperature", [21.0, 21.5, 85.0, 21.2, 21.4]),
+                         [21.0, 21.5, 21.5, 21.5, 21.4])
+
+    def test_ewma_starts_from_the_first_sample_and_rounds(self):
+        state = filter_state(temp_smoothing=0.5)
+        self.assertEqual(self.feed(state, "temperature", [20.0, 22.0, 22.0, 22.0]),
+                         [20.0, 21.0, 21.5, 21.75])
+        state = filter_state(light_smoothing=0.3)
+        filtered = self.feed(state, "light_level", [0, 1000, 1000])
+        self.assertEqual(filtered, [0.0, 300.0, 510.0])
+
+    def test_median_then_ewma(self):
+        state = filter_state(median_window=3, light_smoothing=0.5)
+        self.assertEqual(self.feed(state, "light_level", [100, 100, 5000, 100]), [100.0, 100.0, 100.0, 100.0])
+
+    def test_window_follows_a_new_size(self):
+        conditioner = SignalConditioner()
+        state = filter_state(median_window=5)
+        self.feed(state, "light_level", [1, 2, 3, 4, 5], conditioner)
+        # The newest samples are kept when the window shrinks
+        state["median_window"] = 3
+        self.assertEqual(self.feed(state, "light_level", [6], conditioner), [5.0])
+
+    def test_sensors_and_devices_are_filtered_separately(self):
+        conditioner = SignalConditioner()
+        state = filter_state(median_window=3)
+        self.feed(state, "light_level", [10, 10, 10], conditioner)
+        other = filter_state(median_window=3)
+        self.assertEqual(self.feed(other, "temperature", [30.0], conditioner), [30.0])
+        conditioner.condition("other-room", other, "light_level", 99)
+        self.assertEqual(other["light_filtered"], 99.0)
+
+
+class DwellTest(unittest.TestCase):
+
+    def decide(self, state, now, **outputs):
+        # Apply a rule decision at `now` through the dwell check
+        before = dict(state)
+        state.update(outputs)
+        SignalConditioner().hold_outputs(before, state, state["min_dwell"], now)
+        return state["led_on"], state["servo_angle"]
+
+    def test_changes_inside_the_dwell_time_are_undone(self):
+        state = filter_state(min_dwell=30.0)
+        # The first change is never held back
+        self.assertEqual(self.decide(state, 1000.0, led_on=True), (True, 0))
+        self.assertEqual(state["led_changed_at"], 1000.0)
+        self.assertEqual(self.decide(state, 1010.0, led_on=False), (True, 0))
+        self.assertEqual(state["led_changed_at"], 1000.0)
+        self.assertEqual(self.decide(state, 1030.0, led_on=False), (False, 0))
+        self.assertEqual(state["led_changed_at"], 1030.0)
+
+    def test_outputs_dwell_independently(self):
+        state = filter_state(min_dwell=30.0)
+        self.decide(state, 1000.0, led_on=True)
+        self.assertEqual(self.decide(state, 1005.0, servo_angle=90), (True, 90))
+        self.assertEqual(self.decide(state, 1031.0, led_on=False, servo_angle=0), (False, 90))
+
+    def test_no_dwell(self):
+        state = filter_state()
+        for now, led_on in ((1000.0, True), (1000.5, False), (1001.0, True)):
+            self.assertEqual(self.decide(state, now, led_on=led_on), (led_on, 0))
+
+
+class ValidateSettingsTest(unittest.TestCase):
+
+    def test_converts_known_settings(self):
+        self.assertEqual(signal_filters.validate_settings(
+            {"median_window": "5", "temp_smoothing": 0.2, "light_hysteresis": 50.0, "min_dwell": 3, "other": 1}),
+            {"median_window": 5, "temp_smoothing": 0.2, "light_hysteresis": 50, "min_dwell": 3.0})
+
+    def test_rejects_out_of_range(self):
+        for data in ({"median_window": 0}, {"median_window": signal_filters.MAX_MEDIAN_WINDOW + 1},
+                     {"light_smoothing": 0}, {"temp_smoothing": 1.5}, {"min_dwell": -1}):
+            with self.assertRaises(ValueError):
+                signal_filters.validate_settings(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
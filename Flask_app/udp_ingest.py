@@ -0,0 +1,83 @@
+# Optional fire-and-forget UDP listener for high-rate sensor telemetry
+import asyncio
+import json
+import socket
+import threading
+
+import binary_protocol
+
+DEFAULT_UDP_PORT = 5001
+
+# Kernel receive buffer, so bursts (e.g. a whole floor reporting at once) aren't dropped
+RECEIVE_BUFFER_BYTES = 4 * 1024 * 1024
+
+
+class ReadingProtocol(asyncio.DatagramProtocol):
+    """Turns each datagram into a reading and hands it to the ingest function"""
+
+    def __init__(self, ingest):
+        self.ingest = ingest  # ingest(device_id, light_level, motion_detected, temperature)
+        self.received = 0
+        self.errors = 0
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        try:
+            if data[:1] == b"{":
+                # JSON reading: {"device_id": ..., "light_level": ..., ...}
+                reading = json.loads(data)
+                device_id = reading.get("device_id")
+                light_level = reading.get("light_level")
+                motion_detected = reading.get("motion_detected")
+                temperature = reading.get("temperature")
+            else:
+                # Binary reading, same 24-byte packet as /esp/update_bin
+                device_id, light_level, motion_detected, temperature = binary_protocol.parse_reading(data)
+            if device_id is None:
+                raise ValueError("UDP readings must carry a device_id")
+            self.ingest(device_id, light_level, motion_detected, temperature)
+        except Exception:
+            # No reply channel: count the bad datagram and move on
+            self.errors += 1
+
+
+class UdpIngestServer:
+    """Runs the datagram endpoint on its own event loop in a background thread"""
+
+    def __init__(self, ingest, host="0.0.0.0", port=DEFAULT_UDP_PORT, reuse_port=False):
+        self.protocol = ReadingProtocol(ingest)
+        self.host = host
+        self.port = port
+        # Lets every worker of a multi-process server bind the same port; the kernel spreads datagrams
+        self.reuse_port = reuse_port
+        self._loop = None
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait(5)
+        return self
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTES)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        transport, _ = self._loop.run_until_complete(
+            self._loop.create_datagram_endpoint(lambda: self.protocol, sock=sock)
+        )
+        # Report the bound port (useful when started with port 0)
+        self.port = transport.get_extra_info("sockname")[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            transport.close()
+            self._loop.close()
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
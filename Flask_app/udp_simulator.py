@@ -0,0 +1,51 @@
+# Simulated ESP32 fleet sending readings to the UDP ingest listener
+#
+# Usage: python udp_simulator.py --devices 100 --interval 2 --port 5001
+import argparse
+import random
+import socket
+import time
+
+import binary_protocol
+
+
+def make_packet(device_id, light_level, motion_detected, temperature):
+    # Same 24-byte packet the ESP32 sketch sends to /esp/update_bin
+    flags = binary_protocol.READING_HAS_TEMP | (binary_protocol.READING_MOTION if motion_detected else 0)
+    return binary_protocol.READING.pack(
+        binary_protocol.PROTOCOL_VERSION, device_id.encode("ascii"), light_level, flags, temperature
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send simulated sensor readings over UDP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--devices", type=int, default=10, help="number of simulated devices")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between rounds")
+    parser.add_argument("--rounds", type=int, default=0, help="stop after this many rounds (0 = forever)")
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    device_ids = [f"sim-{i:05d}" for i in range(args.devices)]
+    # Each device drifts around its own base values
+    temperatures = {d: random.uniform(20, 28) for d in device_ids}
+    rounds = 0
+    while not args.rounds or rounds < args.rounds:
+        started = time.monotonic()
+        for device_id in device_ids:
+            temperatures[device_id] += random.uniform(-0.2, 0.2)
+            packet = make_packet(
+                device_id,
+                random.randint(0, 4095),
+                random.random() < 0.3,
+                temperatures[device_id]
+            )
+            sock.sendto(packet, (args.host, args.port))
+        rounds += 1
+        print(f"round {rounds}: sent {len(device_ids)} readings")
+        time.sleep(max(0.0, args.interval - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# Asyncio networking layer shared by every part of the Flet app
+import asyncio
+import json
+import random
+
+import httpx
+
+DEFAULT_DEVICE_ID = "default"
+
+REQUEST_TIMEOUT = 3  # Seconds for ordinary requests
+STREAM_READ_TIMEOUT = 30  # Seconds without data (including keep-alives) before the stream is dropped
+STREAM_RETRY_INTERVAL = 10  # Seconds of fallback polling before the stream is retried
+REFRESH_INTERVAL = 2  # Seconds between refreshes while polling
+BACKGROUND_REFRESH_INTERVAL = 10  # Seconds between conditional refreshes of rooms not on screen
+CONTROL_DEBOUNCE = 0.3  # Seconds of quiet before pending control changes are sent
+BACKOFF_BASE = 1  # First retry delay (seconds) when the backend is unreachable
+BACKOFF_MAX = 30  # Longest retry delay (seconds)
+MAX_STREAMS = 2  # Open event streams (one room is live; the previous stream may still be closing)
+
+
+def device_path(device_id, path):
+    # The default device keeps the original, unprefixed URLs
+    if device_id == DEFAULT_DEVICE_ID:
+        return path
+    return f"/devices/{device_id}{path}"
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter, so many clients don't retry in lockstep
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class BackendClient:
+    """Pooled keep-alive HTTP client for the Flask backend"""
+
+    def __init__(self, base_url):
+        # One connection pool shared by polls and control updates
+        self._http = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+        )
+        # Event streams hold their connection open, so they get a pool of their own
+        # and can never leave polls or control updates waiting for a connection
+        self._streams = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, read=STREAM_READ_TIMEOUT),
+            limits=httpx.Limits(max_connections=MAX_STREAMS)
+        )
+        # Last ETag and state per device for conditional GETs
+        self._etags = {}
+        self._states = {}
+
+    async def aclose(self):
+        await self._http.aclose()
+        await self._streams.aclose()
+
+    async def list_devices(self):
+        response = await self._http.get("/api/devices")
+        response.raise_for_status()
+        return response.json()["devices"]
+
+    async def fetch_state(self, device_id):
+        """Return the full state of a device, reusing the cached copy on 304"""
+        headers = {}
+        if device_id in self._etags:
+            headers["If-None-Match"] = self._etags[device_id]
+        response = await self._http.get(device_path(device_id, "/esp/control"), headers=headers)
+        if response.status_code == 304:
+            return self._states[device_id]
+        response.raise_for_status()
+        self._states[device_id] = response.json()
+        if "ETag" in response.headers:
+            self._etags[device_id] = response.headers["ETag"]
+        return self._states[device_id]
+
+    async def update_controls(self, device_id, payload):
+        response = await self._http.post(device_path(device_id, "/flet/update"), json=payload)
+        response.raise_for_status()
+
+    async def stream(self, device_id):
+        """Yield the full state, then every change pushed by the backend"""
+        async with self._streams.stream("GET", device_path(device_id, "/api/stream")) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                # Skip keep-alive comments and event separators
+                if line.startswith("data:"):
+                    yield json.loads(line[5:])
+
+
+class ControlSender:
+    """Debounce control changes and send only the latest value of each field"""
+
+    def __init__(self, send, delay=CONTROL_DEBOUNCE):
+        self._send = send
+        self._delay = delay
+        self._pending = {}
+        self._in_flight = {}
+        self._timer = None
+        self._send_lock = asyncio.Lock()  # Keeps requests in order, one at a time
+
+    def submit(self, changes):
+        # Later values replace earlier ones (e.g. every tick of a slider drag)
+        self._pending.update(changes)
+        # Restart the quiet period
+        if self._timer is not None:
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(self._delay, lambda: loop.create_task(self._flush()))
+
+    def busy_fields(self):
+        """Fields with changes not yet confirmed by the backend"""
+        return set(self._pending) | set(self._in_flight)
+
+    async def _flush(self):
+        async with self._send_lock:
+            payload, self._pending = self._pending, {}
+            self._in_flight = payload
+            self._timer = None
+            try:
+                if payload:
+                    await self._send(payload)
+            finally:
+                self._in_flight = {}
+
+
+class RoomWatcher:
+    """Keeps one device's state current: streamed while live (polling with backoff as
+    fallback), otherwise polled with conditional requests"""
+
+    def __init__(self, client, device_id, on_state, on_error, live=False):
+        self.client = client
+        self.device_id = device_id
+        self.live = live
+        self.state = {}
+        self._on_state = on_state  # Called with (device_id, state) after every change
+        self._on_error = on_error  # Called with (device_id, exception) on failures
+        self._task = None
+        self._refresh_task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        for task in (self._task, self._refresh_task):
+            if task is not None:
+                task.cancel()
+
+    def set_live(self, live):
+        """Stream the room (e.g. while it is on screen) or only poll it"""
+        if live != self.live:
+            self.live = live
+            if self._task is not None:
+                self._task.cancel()
+                self.start()
+
+    def refresh(self):
+        """Fetch the full state now, cancelling a refresh that is still in flight"""
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        self._refresh_task = asyncio.get_running_loop().create_task(self._refresh())
+        return self._refresh_task
+
+    async def _refresh(self):
+        self.state = dict(await self.client.fetch_state(self.device_id))
+        self._on_state(self.device_id, self.state)
+
+    async def _run(self):
+        attempt = 0
+        if not self.live:
+            # Spread the polls of many background rooms over the interval
+            await asyncio.sleep(random.uniform(0, BACKGROUND_REFRESH_INTERVAL))
+        while True:
+            if self.live:
+                try:
+                    async for changes in self.client.stream(self.device_id):
+                        attempt = 0
+                        self.state.update(changes)
+                        self._on_state(self.device_id, self.state)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._on_error(self.device_id, e)
+                # Fall back to polling for a while before retrying the stream
+                interval, duration = REFRESH_INTERVAL, STREAM_RETRY_INTERVAL
+            else:
+                # Background rooms hold no stream: an unchanged room costs one 304
+                interval = duration = BACKGROUND_REFRESH_INTERVAL
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + duration
+            while loop.time() < deadline:
+                try:
+                    # A newer refresh may cancel this one; wait() doesn't raise in that case
+                    task = self.refresh()
+                    await asyncio.wait({task})
+                    if not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+                    attempt = 0
+                    await asyncio.sleep(interval)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Backend unreachable: back off with jitter
+                    self._on_error(self.device_id, e)
+                    await asyncio.sleep(backoff_delay(attempt))
+                    attempt += 1
@@ -1,12 +1,10 @@
 import flet as ft
-import requests
-import threading
-import time
 from datetime import datetime
 
+from backend_client import BackendClient, ControlSender, RoomWatcher, DEFAULT_DEVICE_ID
+
 # Configuration constants
 BACKEND_URL = "http://192.168.0.149:5000"
-REFRESH_INTERVAL = 2  # Seconds between automatic refreshes
 
 # Custom color scheme - Using ft.Colors (UPPERCASE)
 PRIMARY_COLOR = ft.Colors.BLUE_700
@@ -15,7 +13,7 @@ BACKGROUND_COLOR = ft.Colors.GREY_50
 CARD_COLOR = ft.Colors.WHITE
 TEXT_COLOR = ft.Colors.GREY_800
 
-def main(page: ft.Page):
+async def main(page: ft.Page):
     # Configure the main page properties
     page.title = "Smart Room Controller"
     page.theme_mode = ft.ThemeMode.LIGHT
@@ -25,6 +23,10 @@ def main(page: ft.Page):
 
     # Status tracking
     last_update_time = None
+    selected_device = DEFAULT_DEVICE_ID  # Room shown on the dashboard
+    watchers = {}  # device_id -> RoomWatcher, all running on the UI event loop
+    senders = {}  # device_id -> ControlSender
+    client = BackendClient(BACKEND_URL)
     connection_status = ft.Text("Connecting...", color=ft.Colors.ORANGE_800)
 
     # UI elements
@@ -74,31 +76,42 @@ def main(page: ft.Page):
     led_switch = ft.Switch(label="Manual LED", value=False, disabled=True, active_color=PRIMARY_COLOR)
     servo_slider = ft.Slider(min=0, max=180, divisions=180, label="{value}°", disabled=True, active_color=PRIMARY_COLOR)
 
+    def control_sender(device_id):
+        # One debounced sender per room, created on first use
+        if device_id not in senders:
+            async def send_controls(payload):
+                # Runs once input settles, with the coalesced changes
+                try:
+                    await client.update_controls(device_id, payload)
+                    # The confirmed state arrives through the live update stream
+                    status_message.value = "Controls updated!"
+                    status_message.color = ft.Colors.GREEN_700
+                except Exception as e:
+                    status_message.value = f"Update failed: {str(e)}"
+                    status_message.color = ft.Colors.RED_700
+                status_message.update()
+            senders[device_id] = ControlSender(send_controls)
+        return senders[device_id]
+
     # Update controls function (defined before being referenced)
-    def update_controls(e):
-        try:
-            payload = {
-                "auto_mode": auto_switch.value,
-                "led_on": led_switch.value,
-                "servo_angle": int(servo_slider.value)
-            }
-            response = requests.post(f"{BACKEND_URL}/flet/update", json=payload, timeout=3)
-            if response.status_code == 200:
-                status_message.value = "Controls updated!"
-                status_message.color = ft.Colors.GREEN_700
-                fetch_state()  # Refresh to confirm changes
-            else:
-                status_message.value = f"Update failed: {response.text}"
-                status_message.color = ft.Colors.RED_700
-        except Exception as e:
-            status_message.value = f"Error: {str(e)}"
-            status_message.color = ft.Colors.RED_700
-        page.update()
+    async def update_controls(e):
+        # Queue all controls; only the latest values are sent once input settles
+        control_sender(selected_device).submit({
+            "auto_mode": auto_switch.value,
+            "led_on": led_switch.value,
+            "servo_angle": int(servo_slider.value)
+        })
+
+    def control_changed(field, convert=bool):
+        # Queue just the field the user touched (async, so it runs on the event loop)
+        async def handler(e):
+            control_sender(selected_device).submit({field: convert(e.control.value)})
+        return handler
 
     # Set up event handlers
-    auto_switch.on_change = update_controls
-    led_switch.on_change = update_controls
-    servo_slider.on_change = update_controls
+    auto_switch.on_change = control_changed("auto_mode")
+    led_switch.on_change = control_changed("led_on")
+    servo_slider.on_change = control_changed("servo_angle", lambda value: int(float(value)))
 
     # Update button (now placed after function definition)
     update_button = ft.ElevatedButton(
@@ -188,56 +201,112 @@ def main(page: ft.Page):
         )
     )
 
+    def set_if_changed(dirty, control, attr, value):
+        # Only touch controls whose value actually differs
+        if getattr(control, attr) != value:
+            setattr(control, attr, value)
+            if control not in dirty:
+                dirty.append(control)
+
     def update_display(data):
-        """Update all UI elements with new data"""
-        current_light.content.content.controls[2].value = f"{data.get('light_level', '--')}"
-        current_motion.content.content.controls[2].value = "YES" if data.get('motion_detected') else "NO"
-        current_temp.content.content.controls[2].value = f"{data.get('temperature', '--')}°C"
-        
+        """Update the UI elements whose values changed and send only those to the client"""
+        dirty = []
+        set_if_changed(dirty, current_light.content.content.controls[2], "value", f"{data.get('light_level', '--')}")
+        set_if_changed(dirty, current_motion.content.content.controls[2], "value", "YES" if data.get('motion_detected') else "NO")
+        set_if_changed(dirty, current_temp.content.content.controls[2], "value", f"{data.get('temperature', '--')}°C")
+
         led_status = "ON" if data.get('led_on') else "OFF"
-        current_led.content.content.controls[2].value = led_status
-        current_led.content.content.controls[0].name = ft.Icons.LIGHTBULB if data.get('led_on') else ft.Icons.LIGHTBULB_OUTLINE
-        
-        current_servo.content.content.controls[2].value = f"{data.get('servo_angle', '--')}°"
-        
-        auto_switch.value = data.get('auto_mode', True)
-        led_switch.value = data.get('led_on', False)
-        servo_slider.value = data.get('servo_angle', 0)
-        
-        led_switch.disabled = auto_switch.value
-        servo_slider.disabled = auto_switch.value
-        
+        set_if_changed(dirty, current_led.content.content.controls[2], "value", led_status)
+        set_if_changed(dirty, current_led.content.content.controls[0], "name",
+                       ft.Icons.LIGHTBULB if data.get('led_on') else ft.Icons.LIGHTBULB_OUTLINE)
+
+        set_if_changed(dirty, current_servo.content.content.controls[2], "value", f"{data.get('servo_angle', '--')}°")
+
+        # Leave inputs the user is still editing alone until the backend confirms them
+        busy = control_sender(selected_device).busy_fields()
+        if "auto_mode" not in busy:
+            set_if_changed(dirty, auto_switch, "value", data.get('auto_mode', True))
+        if "led_on" not in busy:
+            set_if_changed(dirty, led_switch, "value", data.get('led_on', False))
+        if "servo_angle" not in busy:
+            set_if_changed(dirty, servo_slider, "value", data.get('servo_angle', 0))
+
+        set_if_changed(dirty, led_switch, "disabled", auto_switch.value)
+        set_if_changed(dirty, servo_slider, "disabled", auto_switch.value)
+
         nonlocal last_update_time
         last_update_time = datetime.now()
-        connection_status.value = "Connected"
-        connection_status.color = ft.Colors.GREEN_700
-        status_message.value = f"Last update: {last_update_time.strftime('%H:%M:%S')}"
+        set_if_changed(dirty, connection_status, "value", "Connected")
+        set_if_changed(dirty, connection_status, "color", ft.Colors.GREEN_700)
+        set_if_changed(dirty, status_message, "value", f"Last update: {last_update_time.strftime('%H:%M:%S')}")
+        set_if_changed(dirty, status_message, "color", ft.Colors.BLUE_700)
 
-    def fetch_state():
-        try:
-            response = requests.get(f"{BACKEND_URL}/esp/control", timeout=3)
-            if response.status_code == 200:
-                update_display(response.json())
-                status_message.value = "Data refreshed successfully"
-                status_message.color = ft.Colors.BLUE_700
-            else:
-                raise Exception(f"HTTP {response.status_code}")
-        except Exception as e:
-            connection_status.value = f"Connection error: {str(e)}"
+        for control in dirty:
+            control.update()
+
+    def on_state(device_id, state):
+        # Every watched room reports here; only the selected one is drawn
+        if device_id == selected_device:
+            update_display(state)
+
+    def on_error(device_id, error):
+        if device_id == selected_device:
+            connection_status.value = f"Connection error: {str(error)}"
             connection_status.color = ft.Colors.RED_700
             status_message.value = "Could not fetch latest data"
             status_message.color = ft.Colors.RED_700
-        page.update()
+            page.update()
+
+    def watch(device_id):
+        # Polls and streams run as tasks on the pooled client, so many rooms need no
+        # extra threads; only the selected room holds a stream (and a server thread)
+        if device_id not in watchers:
+            watchers[device_id] = RoomWatcher(client, device_id, on_state, on_error,
+                                              live=device_id == selected_device)
+            watchers[device_id].start()
+        return watchers[device_id]
+
+    async def select_room(e):
+        nonlocal selected_device
+        watch(selected_device).set_live(False)
+        selected_device = e.control.value
+        # Show the room's last known state now; its stream starts with the full state
+        update_display(watch(selected_device).state)
+        watch(selected_device).set_live(True)
+
+    room_dropdown = ft.Dropdown(
+        label="Room",
+        value=DEFAULT_DEVICE_ID,
+        options=[ft.dropdown.Option(DEFAULT_DEVICE_ID)],
+        on_change=select_room,
+        width=250
+    )
+
+    async def load_rooms():
+        # Watch every room the backend knows about
+        try:
+            device_ids = await client.list_devices()
+        except Exception as e:
+            on_error(selected_device, e)
+            return
+        room_dropdown.options = [ft.dropdown.Option(device_id) for device_id in sorted(set(device_ids) | {DEFAULT_DEVICE_ID})]
+        room_dropdown.update()
+        for device_id in device_ids:
+            watch(device_id)
+
+    async def on_disconnect(e):
+        # Stop every watcher and release the connection pools
+        for watcher in watchers.values():
+            watcher.stop()
+        await client.aclose()
 
-    def auto_refresh():
-        while True:
-            fetch_state()
-            time.sleep(REFRESH_INTERVAL)
+    page.on_disconnect = on_disconnect
 
     # Build the page layout
     page.add(
         ft.Column([
             header,
+            room_dropdown,
             ft.Divider(),
             ft.Row([current_light, current_motion, current_temp], spacing=20),
             ft.Row([current_led, current_servo], spacing=20),
@@ -249,10 +318,8 @@ def main(page: ft.Page):
         ], spacing=10)
     )
 
-    # Initial data fetch
-    fetch_state()
-    
-    # Start background refresh thread
-    threading.Thread(target=auto_refresh, daemon=True).start()
+    # Start live updates for the default room (polling while the stream is down)
+    watch(DEFAULT_DEVICE_ID)
+    await load_rooms()
 
 ft.app(target=main)
\ No newline at end of file